@@ -0,0 +1,124 @@
+# Admission control for job-starting endpoints
+# Each client gets a token bucket, and each pool a bound on how many requests
+# may wait for a slot. Requests over either limit are turned away at once with
+# 429 and a Retry-After derived from the bucket refill time or the pool's
+# current drain rate, instead of holding a connection until something times out.
+
+import collections
+import functools
+import math
+import os
+import threading
+import time
+import logging
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+# Requests allowed to wait for a slot, per pool
+MAX_QUEUED = int(os.environ.get('FFMPEG_API_MAX_QUEUED', '16'))
+# Per-client sustained rate (requests per minute) and burst size; a rate of 0 disables the buckets
+CLIENT_RATE = float(os.environ.get('FFMPEG_API_CLIENT_RATE', '60'))
+CLIENT_BURST = float(os.environ.get('FFMPEG_API_CLIENT_BURST', '10'))
+# Identify clients by this header (e.g. an API key set by a gateway) instead of the remote address
+CLIENT_HEADER = os.environ.get('FFMPEG_API_CLIENT_HEADER', '')
+MAX_CLIENTS = 10000
+MAX_RETRY_AFTER = 3600
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token; returns 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    def __init__(self):
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'admitted': 0, 'rejected_queue_full': 0, 'rejected_rate_limited': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def client_id(self):
+        if CLIENT_HEADER and flask.request.headers.get(CLIENT_HEADER):
+            return f'{CLIENT_HEADER}:{flask.request.headers[CLIENT_HEADER]}'
+        return flask.request.remote_addr or 'unknown'
+
+    def _rate_wait(self, client):
+        if CLIENT_RATE <= 0:
+            return 0
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(CLIENT_RATE / 60, CLIENT_BURST)
+                while len(self._buckets) > MAX_CLIENTS:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(client)
+            return bucket.take()
+
+    def check(self, pool):
+        """None if the request may proceed, else a (reason, retry_after_seconds) pair."""
+        # The queue bound is checked first so a full pool does not also spend the client's tokens
+        if pool is not None and pool.queued >= MAX_QUEUED:
+            excess = pool.queued - MAX_QUEUED + 1
+            self._count('rejected_queue_full')
+            return 'queue_full', excess / pool.drain_rate()
+        wait = self._rate_wait(self.client_id())
+        if wait:
+            self._count('rejected_rate_limited')
+            return 'rate_limited', wait
+        self._count('admitted')
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.stats)
+            clients = len(self._buckets)
+        return {**counts, 'max_queued_per_pool': MAX_QUEUED, 'client_rate_per_minute': CLIENT_RATE,
+                'client_burst': CLIENT_BURST, 'clients_tracked': clients}
+
+
+admission = Admission()
+
+
+def limited(pool_for=None):
+    """Route decorator: 429 + Retry-After when the client or the job's pool is over its limit.
+
+    pool_for(data) returns the pool the request will wait in (None: rate limit only).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            data = flask.request.get_json(silent=True)
+            # Bodies that are not objects go through to the view, which rejects them with a 400
+            if not isinstance(data, dict):
+                data = {}
+            rejected = admission.check(pool_for(data) if pool_for else None)
+            if rejected is None:
+                return view(*args, **kwargs)
+            reason, wait = rejected
+            retry_after = min(max(math.ceil(wait), 1), MAX_RETRY_AFTER)
+            message = ('Too many jobs waiting for a slot' if reason == 'queue_full'
+                       else 'Request rate limit exceeded for this client')
+            logger.warning(f"Rejected {flask.request.path} from {admission.client_id()}: {reason}, "
+                           f"retry after {retry_after}s")
+            return ({'status': 'error', 'message': message, 'reason': reason, 'retry_after_seconds': retry_after},
+                    429, {'Retry-After': str(retry_after)})
+        return wrapper
+    return decorator
@@ -0,0 +1,229 @@
+# Single-pass media analysis with persistent results
+# loudnorm, cropdetect, silencedetect and scene detection run together in one
+# decode of the source. Results are stored per input identity, so a source is
+# analysed once and every later rendition reuses the measurements.
+
+import collections
+import contextlib
+import json
+import os
+import re
+import threading
+import logging
+
+import media_probe
+import ffmpeg_runner
+
+logger = logging.getLogger(__name__)
+
+DETECTORS = ('loudnorm', 'cropdetect', 'silencedetect', 'scene')
+AUDIO_DETECTORS = ('loudnorm', 'silencedetect')
+
+DEFAULT_PARAMS = {
+    'loudnorm': {'I': -23.0, 'TP': -1.0, 'LRA': 7.0},
+    'cropdetect': {'limit': 24, 'round': 2},
+    'silencedetect': {'noise': '-50dB', 'duration': 0.5},
+    'scene': {'threshold': 10.0},
+}
+
+_SILENCE_START = re.compile(r'silence_start: (-?[\d.]+)')
+_SILENCE_END = re.compile(r'silence_end: (-?[\d.]+) \| silence_duration: ([\d.]+)')
+_CROP = re.compile(r'crop=(\d+:\d+:\d+:\d+)')
+_SCENE = re.compile(r'lavfi\.scd\.score: ([\d.]+), lavfi\.scd\.time: ([\d.]+)')
+
+
+class AnalysisError(Exception):
+    pass
+
+
+def _params(detector, overrides):
+    params = dict(DEFAULT_PARAMS[detector])
+    params.update((overrides or {}).get(detector, {}))
+    return params
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(path, results):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp, path)
+
+
+def _build_command(input_file, detectors, params):
+    audio, video = [], []
+    if 'loudnorm' in detectors:
+        p = params['loudnorm']
+        audio.append(f"loudnorm=I={p['I']}:TP={p['TP']}:LRA={p['LRA']}:print_format=json")
+    if 'silencedetect' in detectors:
+        p = params['silencedetect']
+        audio.append(f"silencedetect=n={p['noise']}:d={p['duration']}")
+    if 'cropdetect' in detectors:
+        p = params['cropdetect']
+        video.append(f"cropdetect=limit={p['limit']}:round={p['round']}:reset=0")
+    if 'scene' in detectors:
+        video.append(f"scdet=threshold={params['scene']['threshold']}")
+
+    chains, maps = [], []
+    if audio:
+        chains.append(f"[0:a:0]{','.join(audio)}[a]")
+        maps += ['-map', '[a]']
+    if video:
+        chains.append(f"[0:v:0]{','.join(video)}[v]")
+        maps += ['-map', '[v]']
+    return ['ffmpeg', '-y', '-i', input_file, '-filter_complex', ';'.join(chains), *maps, '-f', 'null', '-']
+
+
+class _Parser:
+    """Collects detector output line by line; cropdetect logs every frame, so nothing is buffered."""
+
+    def __init__(self, detectors):
+        self.detectors = detectors
+        self.loudnorm_lines = None
+        self.loudnorm_json = None
+        self.silence = []
+        self.silence_start = None
+        self.crops = collections.Counter()
+        self.crop_frames = 0
+        self.scenes = []
+
+    def feed(self, line):
+        if self.loudnorm_lines is not None:
+            self.loudnorm_lines.append(line)
+            if line.strip() == '}':
+                self.loudnorm_json = ''.join(self.loudnorm_lines)
+                self.loudnorm_lines = None
+            return
+        if 'Parsed_loudnorm' in line:
+            # loudnorm prints its measurement as a JSON object at the end of the run
+            self.loudnorm_lines = []
+            return
+        m = _CROP.search(line)
+        if m:
+            self.crop_frames += 1
+            self.crops[m.group(1)] += 1
+            return
+        m = _SILENCE_START.search(line)
+        if m:
+            self.silence_start = max(float(m.group(1)), 0.0)
+            return
+        m = _SILENCE_END.search(line)
+        if m:
+            start = self.silence_start if self.silence_start is not None else 0.0
+            self.silence.append({'start': start, 'end': float(m.group(1)), 'duration': float(m.group(2))})
+            self.silence_start = None
+            return
+        m = _SCENE.search(line)
+        if m:
+            self.scenes.append({'time': float(m.group(2)), 'score': float(m.group(1))})
+
+    def results(self, duration):
+        results = {}
+        if 'loudnorm' in self.detectors:
+            if not self.loudnorm_json:
+                raise AnalysisError('loudnorm produced no measurement')
+            measured = json.loads(self.loudnorm_json[self.loudnorm_json.index('{'):])
+            results['loudnorm'] = {k: v if k == 'normalization_type' else float(v) for k, v in measured.items()}
+        if 'silencedetect' in self.detectors:
+            periods = list(self.silence)
+            if self.silence_start is not None and duration:
+                # Silence that runs to the end of the file never gets a silence_end line
+                periods.append({'start': self.silence_start, 'end': duration,
+                                'duration': round(duration - self.silence_start, 3)})
+            results['silencedetect'] = {'periods': periods}
+        if 'cropdetect' in self.detectors:
+            if self.crops:
+                # With reset=0 the detected area only grows, so the most common value is the stable one
+                crop = self.crops.most_common(1)[0][0]
+                w, h, x, y = map(int, crop.split(':'))
+                results['cropdetect'] = {'crop': crop, 'width': w, 'height': h, 'x': x, 'y': y,
+                                         'frames': self.crop_frames}
+            else:
+                results['cropdetect'] = {'crop': None}
+        if 'scene' in self.detectors:
+            results['scene'] = {'changes': self.scenes}
+        return results
+
+
+def analyze(input_file, detectors=DETECTORS, overrides=None, job_id=None, timeout=3600,
+            slot=contextlib.nullcontext):
+    """Return {detector: result} for input_file, running ffmpeg only for detectors not cached yet.
+
+    slot() is entered around the ffmpeg pass only (e.g. a pool slot), so cache hits never wait for one.
+    """
+    unknown = [d for d in detectors if d not in DETECTORS]
+    if unknown:
+        raise AnalysisError(f"Unknown detector(s): {', '.join(unknown)}")
+    key = media_probe.identity_key(input_file)
+    cache_file = media_probe.cache_path('analysis', key)
+    cached = _load(cache_file)
+
+    params = {d: _params(d, overrides) for d in detectors}
+    missing = [d for d in detectors if cached.get(d, {}).get('params') != params[d]]
+
+    has_audio = media_probe.audio_stream(input_file) is not None
+    has_video = media_probe.video_stream(input_file) is not None
+    runnable = [d for d in missing if (has_audio if d in AUDIO_DETECTORS else has_video)]
+    for d in missing:
+        if d not in runnable:
+            cached[d] = {'params': params[d], 'result': None, 'reason': 'stream not present'}
+
+    if runnable:
+        cmd = _build_command(input_file, runnable, params)
+        logger.info(f"Running analysis pass: {' '.join(cmd)}")
+        parser = _Parser(runnable)
+        with slot():
+            result = ffmpeg_runner.run_ffmpeg(cmd, job_id or f'analysis-{key[:12]}', timeout=timeout,
+                                              on_stderr=parser.feed)
+        if result.returncode != 0:
+            raise AnalysisError(f'ffmpeg analysis failed: {result.stderr[-1000:]}')
+        parsed = parser.results(media_probe.duration(input_file))
+        for d in runnable:
+            cached[d] = {'params': params[d], 'result': parsed[d]}
+        _save(cache_file, cached)
+
+    return {d: cached[d]['result'] for d in detectors}, [d for d in detectors if d not in missing]
+
+
+def loudnorm_filter(measured, params=None):
+    """Second-pass loudnorm filter using a first-pass measurement."""
+    p = {**DEFAULT_PARAMS['loudnorm'], **(params or {})}
+    return (f"loudnorm=I={p['I']}:TP={p['TP']}:LRA={p['LRA']}"
+            f":measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+            f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+            f":offset={measured['target_offset']}:linear=true")
+
+
+def apply_cached(data, input_file, slot=contextlib.nullcontext):
+    """Fold auto_loudnorm/auto_crop requests into the encode body using (cached) analysis.
+
+    slot() is entered around a fresh analysis pass, as for analyze().
+    """
+    wanted = []
+    loudnorm_params = data.get('auto_loudnorm')
+    if loudnorm_params and not data.get('video_only', False):
+        wanted.append('loudnorm')
+    if data.get('auto_crop') and not data.get('audio_only', False) and not data.get('crop'):
+        wanted.append('cropdetect')
+    if not wanted:
+        return data, {}
+
+    overrides = {'loudnorm': loudnorm_params} if isinstance(loudnorm_params, dict) else {}
+    results, reused = analyze(input_file, wanted, overrides, slot=slot)
+    data = dict(data)
+    applied = {'reused_cached_analysis': reused}
+    if results.get('loudnorm'):
+        second_pass = loudnorm_filter(results['loudnorm'], overrides.get('loudnorm'))
+        data['audio_filter'] = f"{second_pass},{data['audio_filter']}" if data.get('audio_filter') else second_pass
+        applied['loudnorm'] = second_pass
+    if results.get('cropdetect', {}) and results['cropdetect'].get('crop'):
+        data['crop'] = results['cropdetect']['crop']
+        applied['crop'] = data['crop']
+    return data, applied
@@ -0,0 +1,171 @@
+# Per-title quality selection
+# A few short segments spread over the input are encoded in parallel at several
+# quality settings and scored against the source. The resulting size/quality
+# curve picks the lowest-quality setting (smallest output) whose average score
+# still meets the target. Choices are cached per input and encode settings, so
+# each title is measured once.
+
+import concurrent.futures
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import logging
+
+import ffmpeg_runner
+import media_probe
+import quality
+
+logger = logging.getLogger(__name__)
+
+SAMPLES = int(os.environ.get('FFMPEG_API_AUTO_QUALITY_SAMPLES', '4'))
+SAMPLE_SECONDS = float(os.environ.get('FFMPEG_API_AUTO_QUALITY_SAMPLE_SECONDS', '2'))
+PARALLEL = int(os.environ.get('FFMPEG_API_AUTO_QUALITY_PARALLEL', '4'))
+
+# Encoder -> (quality option, values tried from best to worst, extra options for constant-quality mode)
+KNOBS = {
+    'libx264': ('-crf', (18, 22, 26, 30, 34), []),
+    'libx265': ('-crf', (20, 24, 28, 32, 36), []),
+    'libvpx-vp9': ('-crf', (24, 30, 36, 42, 48), ['-b:v', '0']),
+    'libaom-av1': ('-crf', (24, 30, 36, 42, 48), ['-b:v', '0']),
+    'h264_nvenc': ('-cq', (19, 23, 27, 31, 35), ['-rc', 'vbr', '-b:v', '0']),
+    'hevc_nvenc': ('-cq', (21, 25, 29, 33, 37), ['-rc', 'vbr', '-b:v', '0']),
+    'av1_nvenc': ('-cq', (24, 30, 36, 42, 48), ['-rc', 'vbr', '-b:v', '0']),
+}
+DEFAULT_TARGETS = {'vmaf': 93.0, 'ssim': 0.98, 'psnr': 40.0}
+
+
+class AutoQualityError(Exception):
+    pass
+
+
+def quality_args(video_codec, value):
+    flag, _, extra = KNOBS[video_codec]
+    return [flag, str(value), *extra]
+
+
+def settings(video_codec, options):
+    """Validated metric/target for an "auto_quality" value (true or {"metric", "target"})."""
+    if video_codec not in KNOBS:
+        raise AutoQualityError(f"auto_quality is not supported for '{video_codec}' "
+                               f"(supported: {', '.join(KNOBS)})")
+    options = options if isinstance(options, dict) else {}
+    metric = options.get('metric') or quality.default_metric()
+    if metric not in quality.METRICS or not quality.available(metric):
+        raise AutoQualityError(f"Unknown or unavailable metric '{metric}'")
+    try:
+        target = float(options.get('target', DEFAULT_TARGETS[metric]))
+    except (TypeError, ValueError):
+        raise AutoQualityError('auto_quality target must be a number')
+    return metric, target
+
+
+def sample_starts(duration):
+    count = max(min(SAMPLES, int(duration // SAMPLE_SECONDS)), 1)
+    length = min(SAMPLE_SECONDS, duration)
+    # Centred in equal slices of the title, so intros and credits do not dominate
+    return [max((i + 0.5) * duration / count - length / 2, 0) for i in range(count)], length
+
+
+def _encode_and_score(input_file, sample_cmd, start, length, value, video_codec, metric, size, reference_filter,
+                      path, job_id, timeout):
+    cmd = [*sample_cmd[:2], '-ss', f'{start:.6f}', '-t', f'{length:.6f}', *sample_cmd[2:],
+           *quality_args(video_codec, value), '-f', 'matroska', path]
+    result = ffmpeg_runner.run_ffmpeg(cmd, job_id, timeout)
+    if result.returncode != 0:
+        raise AutoQualityError(f'Sample encode at {value} failed: {result.stderr[-1000:]}')
+    score = quality.measure(path, input_file, metric, f'{job_id}-score', timeout, size=size, start=start,
+                            distorted_start=0, duration=length, reference_filter=reference_filter)
+    return {'bytes': os.path.getsize(path), 'score': score}
+
+
+def _choose(curve, target):
+    # Highest value (lowest quality) still meeting the target, interpolated towards the first miss
+    meeting = [p for p in curve if p['score'] >= target]
+    if not meeting:
+        return dict(curve[0], target_met=False)
+    best = meeting[-1]
+    following = [p for p in curve if p['value'] > best['value']]
+    if not following or following[0]['score'] >= best['score']:
+        return dict(best, target_met=True)
+    nxt = following[0]
+    fraction = (best['score'] - target) / (best['score'] - nxt['score'])
+    value = int(best['value'] + fraction * (nxt['value'] - best['value']))
+    if value == best['value']:
+        return dict(best, target_met=True)
+    share = (value - best['value']) / (nxt['value'] - best['value'])
+    return {'value': value, 'target_met': True,
+            'score': round(best['score'] + share * (nxt['score'] - best['score']), 3),
+            'kbps': round(best['kbps'] + share * (nxt['kbps'] - best['kbps']), 1)}
+
+
+def choose(input_file, video_codec, sample_cmd, options, crop=None, reference_filter=None, job_id='autoq',
+           timeout=600):
+    """Pick the quality setting for input_file; returns a summary with 'args' for the encode.
+
+    sample_cmd is the encode command without the input position, quality and
+    output: ['ffmpeg', '-y', '-i', input, ...codec, preset and filters...].
+    """
+    metric, target = settings(video_codec, options)
+    duration = media_probe.duration(input_file)
+    if not duration:
+        raise AutoQualityError('auto_quality needs an input with a known duration')
+    starts, length = sample_starts(duration)
+    size = quality.reference_size(input_file, crop)
+    values = KNOBS[video_codec][1]
+
+    key = hashlib.sha1(json.dumps([media_probe.identity_key(input_file), [a for a in sample_cmd if a != input_file],
+                                   metric, target, values, starts, length, reference_filter]).encode()).hexdigest()
+    cache_file = media_probe.cache_path('auto_quality', key)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        return {**cached, 'args': quality_args(video_codec, cached['value']), 'cached': True}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    work_dir = tempfile.mkdtemp(prefix=f'autoq_{job_id}_')
+    try:
+        # Every (segment, setting) pair is independent; each runs in the caller's context so its
+        # progress counts towards the caller's pool
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL) as pool:
+            futures = {(value, i): pool.submit(contextvars.copy_context().run, _encode_and_score, input_file,
+                                               sample_cmd, start, length, value, video_codec, metric, size,
+                                               reference_filter, os.path.join(work_dir, f'{value}_{i}.mkv'),
+                                               f'{job_id}-q{value}s{i}', timeout)
+                       for value in values for i, start in enumerate(starts)}
+            results = {k: f.result() for k, f in futures.items()}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    curve = []
+    for value in values:
+        points = [results[(value, i)] for i in range(len(starts))]
+        scores = [p['score'] for p in points]
+        curve.append({'value': value,
+                      'score': round(sum(scores) / len(scores), 3),
+                      'min_score': round(min(scores), 3),
+                      'kbps': round(sum(p['bytes'] for p in points) * 8 / (length * len(points)) / 1000, 1)})
+    chosen = _choose(curve, target)
+    summary = {
+        'option': KNOBS[video_codec][0],
+        'value': chosen['value'],
+        'metric': metric,
+        'target': target,
+        'target_met': chosen['target_met'],
+        'predicted_score': chosen['score'],
+        'predicted_kbps': chosen['kbps'],
+        'samples': len(starts),
+        'sample_seconds': length,
+        'curve': curve,
+    }
+    tmp = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(summary, f)
+    os.replace(tmp, cache_file)
+    logger.info(f"Auto quality for {input_file}: {summary['option']} {summary['value']} "
+                f"({metric} {chosen['score']} vs target {target}, ~{chosen['kbps']} kbps)")
+    return {**summary, 'args': quality_args(video_codec, chosen['value']), 'cached': False}
@@ -0,0 +1,264 @@
+# Cancellation of running jobs
+# Every job runs under a token registered by its job id; ffmpeg processes
+# started for the job (including sub-runs on executor threads, which inherit
+# the token through the context) attach to it. Cancelling asks each process to
+# stop the way a terminal user would ("q" on stdin, so outputs are finalized),
+# then escalates to SIGTERM and SIGKILL of its process group. Requests can also
+# be cancelled when the client hangs up.
+
+import contextlib
+import contextvars
+import io
+import os
+import select
+import signal
+import socket
+import ssl
+import subprocess
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after "q", and again after SIGTERM, before escalating
+GRACE_SECONDS = float(os.environ.get('FFMPEG_API_CANCEL_GRACE', '3'))
+CANCEL_ON_DISCONNECT = os.environ.get('FFMPEG_API_CANCEL_ON_DISCONNECT', '1') == '1'
+DISCONNECT_POLL_SECONDS = 1.0
+
+_current = contextvars.ContextVar('cancellation_token', default=None)
+
+
+class Cancelled(Exception):
+    def __init__(self, job_id, reason):
+        super().__init__(f'Job {job_id} cancelled ({reason})')
+        self.job_id = job_id
+        self.reason = reason
+
+
+class DuplicateJob(ValueError):
+    pass
+
+
+def popen_kwargs():
+    # Own session: signals reach ffmpeg and anything it spawns, and nothing else
+    return {'stdin': subprocess.PIPE, 'start_new_session': True}
+
+
+def terminate(process, grace=GRACE_SECONDS, ask=True):
+    """Stop process: "q" on stdin, then SIGTERM, then SIGKILL to its process group. Blocks until it exits.
+
+    ask=False skips the "q" for a process that is not reading its stdin (stuck in a blocking read).
+    """
+    steps = [('q', None), ('SIGTERM', signal.SIGTERM), ('SIGKILL', signal.SIGKILL)]
+    for name, sig in steps[0 if ask else 1:]:
+        if _exited(process, 0):
+            return
+        try:
+            if sig is None:
+                if process.stdin is None:
+                    continue
+                process.stdin.write('q' if isinstance(process.stdin, io.TextIOBase) else b'q')
+                process.stdin.flush()
+            else:
+                os.killpg(process.pid, sig)
+        except (OSError, ValueError):
+            # Already gone, stdin closed, or not a group leader
+            if sig is not None and not _exited(process, 0):
+                process.send_signal(sig)
+        if _exited(process, grace if sig != signal.SIGKILL else None):
+            logger.info(f"ffmpeg {process.pid} stopped after {name}")
+            return
+
+
+def _exited(process, timeout):
+    # Checked without reaping: the thread that owns the process collects its status (and rusage)
+    deadline = time.monotonic() + (timeout or 0)
+    while True:
+        if process.returncode is not None:
+            return True
+        try:
+            if os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+                return True
+        except ChildProcessError:
+            return True
+        if timeout is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+
+
+class Token:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.reason = None
+        self.cancelled_at = None
+        self._event = threading.Event()
+        self._processes = {}
+        self._stoppers = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def attach(self, process, grace=GRACE_SECONDS):
+        """Stop process when the job is cancelled; grace=0 for outputs not worth finishing."""
+        with self._lock:
+            self._processes[process] = grace
+            cancelled = self.cancelled
+        if cancelled:
+            # Cancelled while queued or between runs: stop this one straight away
+            self._stop(process, grace)
+
+    def detach(self, process):
+        with self._lock:
+            self._processes.pop(process, None)
+
+    def cancel(self, reason):
+        """Number of processes being stopped, or None if the job was already cancelled."""
+        with self._lock:
+            if self.cancelled:
+                return None
+            self.reason = reason
+            self.cancelled_at = time.time()
+            self._event.set()
+            processes = list(self._processes.items())
+        for process, grace in processes:
+            self._stop(process, grace)
+        return len(processes)
+
+    def _stop(self, process, grace):
+        stopper = threading.Thread(target=terminate, args=(process, grace), name=f'cancel-{self.job_id}',
+                                   daemon=True)
+        stopper.start()
+        with self._lock:
+            self._stoppers.append(stopper)
+
+    def wait_stopped(self, timeout=None):
+        with self._lock:
+            stoppers = list(self._stoppers)
+        for stopper in stoppers:
+            stopper.join(timeout)
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled(self.job_id, self.reason)
+
+
+class Registry:
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.stats = {'cancelled': 0, 'client_disconnects': 0}
+
+    def open(self, job_id):
+        with self._lock:
+            if job_id in self._tokens:
+                raise DuplicateJob(f'A job with id {job_id} is already running')
+            token = self._tokens[job_id] = Token(job_id)
+        return token
+
+    def close(self, token):
+        with self._lock:
+            if self._tokens.get(token.job_id) is token:
+                del self._tokens[token.job_id]
+
+    @contextlib.contextmanager
+    def scope(self, job_id, sock=None):
+        """Run the block as job_id: its ffmpeg runs can be cancelled, and so can it when sock hangs up."""
+        token = self.open(job_id)
+        try:
+            with self.running(token, sock):
+                yield token
+        finally:
+            self.close(token)
+
+    @contextlib.contextmanager
+    def running(self, token, sock=None):
+        """Run the block as the job of an already open token (one that outlives the block, like a stream's)."""
+        context_token = _current.set(token)
+        watcher = DisconnectWatcher(self, token, sock) if sock is not None and CANCEL_ON_DISCONNECT else None
+        try:
+            yield token
+        finally:
+            if watcher:
+                watcher.stop()
+            _current.reset(context_token)
+
+    def cancel(self, job_id, reason='requested'):
+        """Number of processes being stopped, or None if no such job is running here."""
+        with self._lock:
+            token = self._tokens.get(job_id)
+        if token is None:
+            return None
+        stopping = token.cancel(reason)
+        if stopping is None:
+            return 0
+        with self._lock:
+            self.stats['cancelled'] += 1
+            if reason == 'client_disconnected':
+                self.stats['client_disconnects'] += 1
+        logger.warning(f"Cancelling job {job_id} ({reason}), stopping {stopping} process(es)")
+        return stopping
+
+    def cancel_all(self, reason='shutdown', wait=False):
+        """Cancel every running job; with wait, return only once their processes have exited."""
+        with self._lock:
+            tokens = list(self._tokens.values())
+        cancelled = [token for token in tokens if token.cancel(reason) is not None]
+        with self._lock:
+            self.stats['cancelled'] += len(cancelled)
+        if wait:
+            for token in tokens:
+                token.wait_stopped(2 * GRACE_SECONDS + 5)
+        return len(cancelled)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, 'running_jobs': len(self._tokens), 'grace_seconds': GRACE_SECONDS,
+                    'cancel_on_disconnect': CANCEL_ON_DISCONNECT}
+
+
+class DisconnectWatcher:
+    """Cancels token when the client closes its connection while the response is still being prepared."""
+
+    def __init__(self, registry, token, sock):
+        self._registry = registry
+        self._token = token
+        self._sock = sock
+        self._stopped = threading.Event()
+        # TLS sockets cannot be peeked at without consuming records
+        if not isinstance(sock, ssl.SSLSocket):
+            threading.Thread(target=self._run, name=f'disconnect-{token.job_id}', daemon=True).start()
+
+    def _run(self):
+        while not self._stopped.is_set() and not self._token.cancelled:
+            try:
+                readable, _, _ = select.select([self._sock], [], [], DISCONNECT_POLL_SECONDS)
+                if not readable or self._stopped.is_set():
+                    continue
+                if self._sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT):
+                    # A pipelined next request, not a hang-up; nothing more to learn from this socket
+                    return
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                if self._stopped.is_set():
+                    return
+            self._registry.cancel(self._token.job_id, 'client_disconnected')
+            return
+
+    def stop(self):
+        self._stopped.set()
+
+
+registry = Registry()
+
+
+def current():
+    """The token of the job running in this context, or None."""
+    return _current.get()
+
+
+def client_socket(environ):
+    return environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
@@ -0,0 +1,210 @@
+# Capability discovery with a persisted snapshot
+# ffmpeg's version, hwaccels and encoders are probed concurrently and written to
+# a versioned snapshot file tied to the ffmpeg binary (size/mtime, confirmed by
+# SHA-256 when those differ), so they are discovered once per image instead of
+# on every start and every /info request. GPU details depend on the host and
+# are re-read at startup, in parallel with everything else.
+#
+#   python3 capabilities.py            # load or refresh the snapshot, print a startup summary
+#   python3 capabilities.py --refresh  # re-probe unconditionally (used at image build time)
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PATH = os.environ.get('FFMPEG_API_CAPABILITIES',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'capabilities.json'))
+WORKSPACE = '/workspace'
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+_snapshot = None
+
+
+def _run(cmd, timeout=10):
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout if result.returncode == 0 else None
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def binary_identity():
+    path = shutil.which('ffmpeg')
+    if not path:
+        return None
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return {'path': path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _probe_version():
+    out = _run(['ffmpeg', '-version'])
+    return out.split('\n')[0] if out else None
+
+
+def _probe_hwaccels():
+    out = _run(['ffmpeg', '-hide_banner', '-hwaccels'])
+    return [line.strip() for line in out.split('\n')[1:] if line.strip()] if out else []
+
+
+def _probe_nvenc_encoders():
+    out = _run(['ffmpeg', '-hide_banner', '-encoders'])
+    return [line.strip() for line in out.split('\n') if 'nvenc' in line.lower() and line.strip()] if out else []
+
+
+def probe_gpu():
+    """Name and memory of the first GPU, or None without nvidia-smi/GPU."""
+    out = _run(['nvidia-smi', '--query-gpu=name,memory.total,memory.used,driver_version',
+                '--format=csv,noheader,nounits'])
+    if not out:
+        return None
+    fields = [f.strip() for f in out.strip().split('\n')[0].split(',')]
+    if len(fields) < 4:
+        return None
+    total, used = int(fields[1]), int(fields[2])
+    return {'name': fields[0], 'memory_total_mb': total, 'memory_used_mb': used,
+            'memory_free_mb': total - used, 'driver_version': fields[3]}
+
+
+def count_workspace_videos():
+    try:
+        return sum(1 for e in os.scandir(WORKSPACE) if e.is_file() and e.name.lower().endswith(VIDEO_EXTENSIONS))
+    except OSError:
+        return None
+
+
+def _load_file():
+    try:
+        with open(SNAPSHOT_PATH) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return snapshot if snapshot.get('version') == SNAPSHOT_VERSION else None
+
+
+def _save(snapshot):
+    tmp = f'{SNAPSHOT_PATH}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp, SNAPSHOT_PATH)
+    except OSError as e:
+        logger.warning(f"Could not write capability snapshot {SNAPSHOT_PATH}: {e}")
+
+
+def _valid_for(snapshot, identity):
+    if not snapshot or not identity:
+        return False
+    stored = snapshot.get('binary', {})
+    if stored.get('path') != identity['path']:
+        return False
+    if stored.get('size') == identity['size'] and stored.get('mtime_ns') == identity['mtime_ns']:
+        return True
+    # Copied or touched binary: only the content hash can say whether it is the same build
+    return stored.get('size') == identity['size'] and stored.get('sha256') == _sha256(identity['path'])
+
+
+def discover(refresh=False, with_gpu=True):
+    """Return the capability snapshot, probing whatever is missing or stale concurrently."""
+    global _snapshot
+    start = time.monotonic()
+    identity = binary_identity()
+    if identity is None:
+        raise FileNotFoundError('ffmpeg not found on PATH')
+    cached = None if refresh else _load_file()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as pool:
+        gpu = pool.submit(probe_gpu) if with_gpu else None
+        if _valid_for(cached, identity):
+            snapshot, changed = cached, False
+        else:
+            futures = {name: pool.submit(fn) for name, fn in (
+                ('ffmpeg_version', _probe_version),
+                ('hardware_accelerators', _probe_hwaccels),
+                ('nvenc_encoders', _probe_nvenc_encoders),
+                ('sha256', lambda: _sha256(identity['path'])))}
+            results = {name: f.result() for name, f in futures.items()}
+            snapshot = {
+                'version': SNAPSHOT_VERSION,
+                'created_at': time.time(),
+                'binary': {**identity, 'sha256': results.pop('sha256')},
+                **results,
+            }
+            snapshot['cuda_available'] = 'cuda' in snapshot['hardware_accelerators']
+            changed = True
+        if gpu is not None:
+            gpu_info = gpu.result()
+            if gpu_info is not None:
+                snapshot['gpu'] = gpu_info
+                snapshot['gpu_probed_at'] = time.time()
+                changed = True
+        # A copy that was validated by hash gets the new stat so the next check is cheap
+        if snapshot['binary'].get('mtime_ns') != identity['mtime_ns']:
+            snapshot['binary'].update(identity)
+            changed = True
+    if changed:
+        _save(snapshot)
+    snapshot['discovery_ms'] = round((time.monotonic() - start) * 1000, 1)
+    _snapshot = snapshot
+    return snapshot
+
+
+def snapshot():
+    """The process-wide snapshot; loaded from file (or discovered) on first use."""
+    global _snapshot
+    if _snapshot is None:
+        cached = _load_file()
+        if _valid_for(cached, binary_identity()):
+            _snapshot = cached
+        else:
+            discover(with_gpu=False)
+    return _snapshot
+
+
+def _summary(refresh):
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            files = pool.submit(count_workspace_videos)
+            snap = discover(refresh=refresh)
+            file_count = files.result()
+    except FileNotFoundError:
+        print('🎬 FFmpeg Status:\n   ❌ FFmpeg not found')
+        return 1
+    print('🎬 FFmpeg Status:')
+    print(f"   ✅ FFmpeg found: {snap.get('ffmpeg_version')}")
+    print('🎮 GPU Status:')
+    if snap.get('gpu'):
+        print(f"   ✅ GPU: {snap['gpu']['name']} (driver {snap['gpu']['driver_version']})")
+    else:
+        print('   ⚠️  nvidia-smi not available (may work in container)')
+    print('🔧 Hardware Acceleration:')
+    print(f"   Available: {' '.join(snap.get('hardware_accelerators', []))}")
+    print('📁 Workspace:')
+    if file_count is None:
+        print(f'   ⚠️  Workspace not mounted: {WORKSPACE}')
+    else:
+        print(f'   ✅ Workspace: {WORKSPACE} ({file_count} video files)')
+    print(f"   Capabilities: {SNAPSHOT_PATH} ({snap['discovery_ms']} ms)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_summary('--refresh' in sys.argv[1:]))
@@ -0,0 +1,13 @@
+# Python client for the FFmpeg API server
+# Pooled keep-alive connections, typed request builders, batch submission,
+# retries with backoff, live progress and resumable downloads, in a
+# synchronous (Client) and an asyncio (AsyncClient) flavour. Standard library only.
+
+from .aio import AsyncClient
+from .builders import (AnalyzeRequest, EncodeRequest, FramesRequest, QualityRequest, StreamEncodeRequest,
+                       TrimRequest)
+from .client import Client
+from .retry import APIError, RetryPolicy
+
+__all__ = ['Client', 'AsyncClient', 'APIError', 'RetryPolicy', 'EncodeRequest', 'StreamEncodeRequest',
+           'TrimRequest', 'AnalyzeRequest', 'QualityRequest', 'FramesRequest']
@@ -0,0 +1,387 @@
+# asyncio client
+# The same API as client.Client over asyncio streams with a minimal HTTP/1.1
+# implementation (content-length, chunked and read-to-close bodies), so many
+# jobs can be driven from one event loop over a small pool of keep-alive
+# connections without a thread per request.
+
+import asyncio
+import json
+import os
+import ssl
+import struct
+import time
+import urllib.parse
+
+from .client import (DEFAULT_URL, DOWNLOAD_CHUNK, ENCODE_TIMEOUT, FRAME_BATCH_HEADER, FRAME_STREAM_HEADER,
+                     IDLE_SECONDS, body_of, decode, frame_batch, job_body)
+from .retry import APIError, RetryPolicy, check_job, parse_retry_after
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.released_at = time.monotonic()
+
+    def close(self):
+        self.writer.close()
+
+
+class _Response:
+    def __init__(self, conn, status, headers):
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+        self.keep_alive = headers.get('connection', '').lower() != 'close'
+
+    async def chunks(self):
+        """Yield the body; afterwards keep_alive says whether the connection can be reused."""
+        reader = self.conn.reader
+        if self.status in (204, 304):
+            return
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # Trailers end with an empty line
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining:
+                chunk = await reader.read(min(remaining, DOWNLOAD_CHUNK))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            self.keep_alive = False
+            while True:
+                chunk = await reader.read(DOWNLOAD_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    def exact(self):
+        """A read(n) coroutine returning exactly n body bytes (fewer only at the end of the body)."""
+        chunks = self.chunks()
+        pending = bytearray()
+
+        async def read(n):
+            while len(pending) < n:
+                try:
+                    pending.extend(await chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+            data = bytearray(pending[:n])
+            del pending[:n]
+            return data
+        return read
+
+    async def lines(self):
+        buffer = b''
+        async for chunk in self.chunks():
+            buffer += chunk
+            *complete, buffer = buffer.split(b'\n')
+            for line in complete:
+                yield line
+        if buffer:
+            yield buffer
+
+
+class AsyncClient:
+    """asyncio counterpart of ffmpeg_api_client.Client; use as `async with AsyncClient(url) as api:`."""
+
+    def __init__(self, base_url=DEFAULT_URL, pool_size=8, timeout=30, encode_timeout=ENCODE_TIMEOUT,
+                 retry=None, headers=None):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.prefix = url.path.rstrip('/')
+        self._ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self.host_header = url.netloc
+        self.timeout = timeout
+        self.encode_timeout = encode_timeout
+        self.retry = retry or RetryPolicy()
+        self.headers = {'Accept': 'application/json', **(headers or {})}
+        self.pool_size = pool_size
+        self._idle = []
+        self._slots = None
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # --- transport -------------------------------------------------------------------------
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self._ssl)
+        return _Connection(reader, writer)
+
+    def _take_idle(self):
+        while self._idle:
+            conn = self._idle.pop()
+            if time.monotonic() - conn.released_at < IDLE_SECONDS and not conn.reader.at_eof():
+                return conn
+            conn.close()
+        return None
+
+    def _release(self, conn, response):
+        if response.keep_alive and len(self._idle) < self.pool_size:
+            conn.released_at = time.monotonic()
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    async def _send(self, conn, method, path, body, headers):
+        payload = b'' if body is None else json.dumps(body).encode()
+        lines = [f'{method} {self.prefix}{path} HTTP/1.1', f'Host: {self.host_header}',
+                 *(f'{k}: {v}' for k, v in {**self.headers, **(headers or {})}.items())]
+        if body is not None:
+            lines += ['Content-Type: application/json', f'Content-Length: {len(payload)}']
+        conn.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+        await conn.writer.drain()
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Server closed the connection')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await conn.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        return _Response(conn, status, response_headers)
+
+    async def _attempt(self, method, path, body, headers):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+        async with self._slots:
+            conn = self._take_idle()
+            reused = conn is not None
+            conn = conn or await self._open()
+            try:
+                try:
+                    response = await self._send(conn, method, path, body, headers)
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server closed an idle keep-alive connection; one more try on a fresh one
+                    conn.close()
+                    conn = await self._open()
+                    response = await self._send(conn, method, path, body, headers)
+                data = await response.read()
+            except BaseException:
+                conn.close()
+                raise
+            self._release(conn, response)
+            return response.status, response.headers, data
+
+    async def request(self, method, path, body=None, headers=None, timeout=None, retry=None):
+        """(status, headers, decoded body) of a successful (< 400) response."""
+        retry = retry or self.retry
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                status, response_headers, data = await asyncio.wait_for(
+                    self._attempt(method, path, body, headers), timeout or self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if attempt >= retry.attempts:
+                    raise
+                await asyncio.sleep(retry.delay(attempt))
+                continue
+            if status < 400:
+                return status, response_headers, decode(response_headers, data)
+            retry_after = parse_retry_after(response_headers.get('retry-after'))
+            if not retry.retryable(status) or attempt >= retry.attempts:
+                raise APIError(status, decode(response_headers, data), retry_after)
+            await asyncio.sleep(retry.delay(attempt, retry_after))
+
+    async def _stream(self, method, path, body=None, headers=None):
+        # Long-lived responses get their own connection rather than tying up a pooled one
+        conn = await self._open()
+        try:
+            response = await self._send(conn, method, path, body, headers)
+            if response.status >= 400:
+                data = await response.read()
+                raise APIError(response.status, decode(response.headers, data),
+                               parse_retry_after(response.headers.get('retry-after')))
+        except BaseException:
+            conn.close()
+            raise
+        return conn, response
+
+    async def get(self, path, **kwargs):
+        return (await self.request('GET', path, **kwargs))[2]
+
+    async def post(self, path, body, **kwargs):
+        return (await self.request('POST', path, body, **kwargs))[2]
+
+    async def _run_job(self, path, body):
+        return check_job(await self.post(path, body, timeout=self.encode_timeout, retry=self.retry.for_jobs()))
+
+    # --- endpoints --------------------------------------------------------------------------
+
+    async def health(self):
+        return await self.get('/health')
+
+    async def info(self):
+        return await self.get('/info')
+
+    async def stats(self):
+        return await self.get('/stats')
+
+    async def files(self):
+        return await self.get('/files')
+
+    async def encode(self, request, on_progress=None):
+        """POST /encode; on_progress(sample) (a function or coroutine function) gets live progress."""
+        body = job_body(request)
+        if on_progress is None:
+            return await self._run_job('/encode', body)
+        watcher = asyncio.ensure_future(self._watch(body['job_id'], on_progress))
+        try:
+            return await self._run_job('/encode', body)
+        finally:
+            try:
+                await asyncio.wait_for(watcher, self.timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _watch(self, job_id, on_progress):
+        try:
+            async for event in self.progress(job_id):
+                if event.get('event') == 'progress':
+                    result = on_progress(event)
+                    if asyncio.iscoroutine(result):
+                        await result
+        except (OSError, asyncio.IncompleteReadError, APIError):
+            # Progress is best-effort; the encode's own response carries the outcome
+            pass
+
+    async def submit(self, request):
+        """POST /jobs (queued mode); returns the job id."""
+        return (await self.post('/jobs', job_body(request), retry=self.retry.for_jobs()))['job_id']
+
+    async def job(self, job_id):
+        return await self.get(f'/jobs/{urllib.parse.quote(job_id)}')
+
+    async def timeline(self, job_id):
+        return await self.get(f'/jobs/{urllib.parse.quote(job_id)}/timeline')
+
+    async def cancel(self, job_id):
+        """POST /jobs/<id>/cancel; the job's own request then ends with a 499 'cancelled' APIError."""
+        return await self.post(f'/jobs/{urllib.parse.quote(job_id)}/cancel', {})
+
+    async def trim(self, request):
+        return await self._run_job('/trim', job_body(request))
+
+    async def analyze(self, request):
+        return await self._run_job('/analyze', job_body(request))
+
+    async def quality(self, request):
+        return await self._run_job('/quality', job_body(request))
+
+    async def encode_many(self, requests, concurrency=4, return_exceptions=False):
+        """Encode a batch with at most concurrency requests in flight; results are in request order."""
+        limit = asyncio.Semaphore(concurrency)
+
+        async def run(request):
+            async with limit:
+                return await self.encode(request)
+        return await asyncio.gather(*(run(r) for r in requests), return_exceptions=return_exceptions)
+
+    async def encode_stream(self, request, out):
+        """POST /encode/stream, writing the encoded bytes to the file object out; returns bytes written."""
+        conn, response = await self._stream('POST', '/encode/stream', body_of(request))
+        written = 0
+        try:
+            async for chunk in response.chunks():
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            conn.close()
+        return written
+
+    async def frames(self, request):
+        """Async iterator over FrameBatch(frames, times) from POST /frames."""
+        conn, response = await self._stream('POST', '/frames', body_of(request))
+        try:
+            read = response.exact()
+            head = await read(FRAME_STREAM_HEADER.size)
+            if len(head) < FRAME_STREAM_HEADER.size:
+                raise asyncio.IncompleteReadError(bytes(head), FRAME_STREAM_HEADER.size)
+            _, width, height, channels = FRAME_STREAM_HEADER.unpack(head)
+            frame_bytes = width * height * channels
+            while True:
+                head = await read(FRAME_BATCH_HEADER.size)
+                if not head:
+                    return
+                _, count = FRAME_BATCH_HEADER.unpack(head)
+                times = struct.unpack(f'<{count}d', await read(8 * count))
+                data = await read(count * frame_bytes)
+                if len(data) < count * frame_bytes:
+                    raise asyncio.IncompleteReadError(bytes(data), count * frame_bytes)
+                yield frame_batch(data, count, (height, width, channels), times)
+        finally:
+            conn.close()
+
+    async def progress(self, job_id, wait=30):
+        """Async iterator over a running job's progress events, ending with 'finished' (or 'not_found')."""
+        conn, response = await self._stream('GET', f'/jobs/{urllib.parse.quote(job_id)}/progress?wait={wait}')
+        try:
+            async for line in response.lines():
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+    async def download(self, name, dest):
+        """Download a workspace file to dest, resuming from dest + '.part' after an interruption."""
+        partial = f'{dest}.part'
+        path = f'/files/{urllib.parse.quote(name)}'
+        attempt = 0
+        while True:
+            attempt += 1
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            try:
+                conn, response = await self._stream('GET', path, headers={'Range': f'bytes={offset}-'} if offset
+                                                     else None)
+            except APIError as e:
+                if e.status == 416:
+                    # Everything was already received
+                    break
+                raise
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if attempt >= self.retry.attempts:
+                    raise
+                await asyncio.sleep(self.retry.delay(attempt))
+                continue
+            try:
+                # 200 instead of 206 means the server sent the whole file again
+                with open(partial, 'ab' if response.status == 206 else 'wb') as f:
+                    async for chunk in response.chunks():
+                        f.write(chunk)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if attempt >= self.retry.attempts:
+                    raise
+                await asyncio.sleep(self.retry.delay(attempt))
+            finally:
+                conn.close()
+        os.replace(partial, dest)
+        return dest
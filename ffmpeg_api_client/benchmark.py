@@ -0,0 +1,72 @@
+# Connection reuse benchmark
+# Sends the same batch of requests three ways: one urllib call per request (a
+# new connection each time), the pooled synchronous client, and the asyncio
+# client, and prints the wall time and request rate of each.
+#
+#   python -m ffmpeg_api_client.benchmark http://localhost:15959 [--requests 200] [--concurrency 8]
+#       [--path /health | --encode body.json]
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import time
+import urllib.request
+
+from .aio import AsyncClient
+from .client import Client
+from .retry import NO_RETRY
+
+
+def naive(base_url, path, body, count, concurrency):
+    def call(_):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(base_url + path, data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=3600) as response:
+            return response.read()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(count)))
+
+
+def pooled(base_url, path, body, count, concurrency):
+    with Client(base_url, pool_size=concurrency, retry=NO_RETRY) as client:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda _: client.request('POST' if body is not None else 'GET', path, body,
+                                                       timeout=3600), range(count)))
+
+
+def pooled_async(base_url, path, body, count, concurrency):
+    async def main():
+        async with AsyncClient(base_url, pool_size=concurrency, retry=NO_RETRY) as client:
+            await asyncio.gather(*(client.request('POST' if body is not None else 'GET', path, body, timeout=3600)
+                                   for _ in range(count)))
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-request connections with the pooled clients')
+    parser.add_argument('url', nargs='?', default='http://localhost:15959')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--path', default='/health', help='GET endpoint to call (default /health)')
+    parser.add_argument('--encode', metavar='BODY_JSON', help='POST this JSON body to /encode instead')
+    args = parser.parse_args()
+
+    body = None
+    path = args.path
+    if args.encode:
+        with open(args.encode) as f:
+            body = json.load(f)
+        path = '/encode'
+    base_url = args.url.rstrip('/')
+    print(f'{args.requests} x {"POST" if body else "GET"} {path}, concurrency {args.concurrency}')
+    for name, run in (('urllib, new connection per request', naive), ('Client (pooled)', pooled),
+                      ('AsyncClient (pooled)', pooled_async)):
+        started = time.perf_counter()
+        run(base_url, path, body, args.requests, args.concurrency)
+        elapsed = time.perf_counter() - started
+        print(f'{name:38} {elapsed:8.3f}s  {args.requests / elapsed:8.1f} req/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Typed request bodies
+# Each class mirrors the JSON fields one endpoint accepts; unset (None) fields
+# are left out so the server's defaults apply.
+
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Union
+
+
+class _Body:
+    def to_dict(self) -> dict:
+        return {k: v for k, v in asdict(self).items() if v is not None}
+
+
+@dataclass
+class EncodeRequest(_Body):
+    """Body of POST /encode (and /jobs)."""
+    input: str
+    output: str
+    input2: Optional[str] = None
+    video_codec: Optional[str] = None
+    preset: Optional[str] = None
+    crf: Optional[Union[int, str]] = None
+    bitrate: Optional[str] = None
+    target_size: Optional[Union[int, str]] = None
+    two_pass: Optional[bool] = None
+    auto_quality: Optional[Union[bool, Dict[str, Union[str, float]]]] = None
+    scale: Optional[str] = None
+    crop: Optional[str] = None
+    auto_crop: Optional[bool] = None
+    video_filter: Optional[str] = None
+    complex_filter: Optional[str] = None
+    audio_codec: Optional[str] = None
+    audio_bitrate: Optional[str] = None
+    audio_filter: Optional[str] = None
+    auto_loudnorm: Optional[Union[bool, Dict[str, float]]] = None
+    audio_only: Optional[bool] = None
+    video_only: Optional[bool] = None
+    job_id: Optional[str] = None
+    callback_url: Optional[str] = None
+    callback_events: Optional[List[str]] = None
+    progress_milestones: Optional[List[float]] = None
+
+
+@dataclass
+class StreamEncodeRequest(EncodeRequest):
+    """Body of POST /encode/stream; output is not used."""
+    output: str = ''
+    format: Optional[str] = None
+
+
+@dataclass
+class TrimRequest(_Body):
+    """Body of POST /trim; give end or duration."""
+    input: str
+    output: str
+    start: float
+    end: Optional[float] = None
+    duration: Optional[float] = None
+    job_id: Optional[str] = None
+
+
+@dataclass
+class AnalyzeRequest(_Body):
+    """Body of POST /analyze."""
+    input: str
+    detectors: Optional[List[str]] = None
+    params: Optional[Dict[str, Dict[str, Union[str, float]]]] = None
+
+
+@dataclass
+class QualityRequest(_Body):
+    """Body of POST /quality."""
+    source: str
+    output: str
+    metrics: List[str] = field(default_factory=lambda: ['vmaf'])
+    crop: Optional[str] = None
+    chunks: Optional[int] = None
+    per_frame: Optional[bool] = None
+    job_id: Optional[str] = None
+
+
+@dataclass
+class FramesRequest(_Body):
+    """Body of POST /frames; give at most one of fps, keyframes_only and timestamps."""
+    input: str
+    pix_fmt: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    fps: Optional[float] = None
+    keyframes_only: Optional[bool] = None
+    timestamps: Optional[List[float]] = None
+    start: Optional[float] = None
+    duration: Optional[float] = None
+    max_frames: Optional[int] = None
+    batch_size: Optional[int] = None
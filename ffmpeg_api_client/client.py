@@ -0,0 +1,392 @@
+# Synchronous client
+# Requests go over a small pool of keep-alive connections (http.client), so a
+# batch of calls reuses a few TCP (and TLS) sessions instead of opening one per
+# request. 429/5xx responses and dropped connections are retried according to
+# the RetryPolicy, honouring the server's Retry-After. Calls that start a job
+# always send a job_id, so a retry of a job that is still running gets a 409
+# instead of starting it twice, and are not retried on 500.
+
+import collections
+import concurrent.futures
+import http.client
+import json
+import os
+import queue
+import ssl
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+
+try:
+    import numpy as np
+except ImportError:  # optional; frame batches are memoryviews without it
+    np = None
+
+from .retry import APIError, RetryPolicy, check_job, parse_retry_after
+
+DEFAULT_URL = 'http://localhost:15959'
+# Encodes hold the request open until ffmpeg exits
+ENCODE_TIMEOUT = 3600
+# Idle connections older than this are not reused; gunicorn's keepalive (gunicorn.conf.py) is 2 s
+IDLE_SECONDS = 1.5
+DOWNLOAD_CHUNK = 1 << 20
+# POST /frames stream and batch headers (see frames.py on the server)
+FRAME_STREAM_HEADER = struct.Struct('<4sIII')
+FRAME_BATCH_HEADER = struct.Struct('<4sI')
+
+FrameBatch = collections.namedtuple('FrameBatch', 'frames times')
+
+
+def body_of(request):
+    """JSON body of a request builder (see builders.py) or a plain dict."""
+    return request.to_dict() if hasattr(request, 'to_dict') else dict(request)
+
+
+def new_job_id():
+    return f'client-{uuid.uuid4().hex[:12]}'
+
+
+def job_body(request):
+    """JSON body of a job-starting request, with a job_id so retries cannot start it twice."""
+    body = body_of(request)
+    body.setdefault('job_id', new_job_id())
+    return body
+
+
+def decode(headers, data):
+    if 'json' in (headers.get('content-type') or ''):
+        try:
+            return json.loads(data)
+        except ValueError:
+            pass
+    return data
+
+
+def frame_batch(buffer, count, shape, times):
+    """FrameBatch whose frames are a (count, height, width, channels) uint8 array over buffer."""
+    shape = (count, *shape)
+    if np is not None:
+        frames = np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+    else:
+        frames = memoryview(buffer).cast('B', shape)
+    return FrameBatch(frames, list(times))
+
+
+class _ConnectionPool:
+    """LIFO pool: the most recently used connection is the one most likely still open."""
+
+    def __init__(self, base_url, size, idle_seconds=IDLE_SECONDS):
+        url = urllib.parse.urlsplit(base_url)
+        self.scheme = url.scheme or 'http'
+        self.host = url.hostname or 'localhost'
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.idle_seconds = idle_seconds
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._ssl = ssl.create_default_context() if self.scheme == 'https' else None
+
+    def new(self, timeout):
+        if self._ssl is not None:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=self._ssl)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def get(self, timeout):
+        """(connection, reused)."""
+        while True:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self.new(timeout), False
+            if time.monotonic() - released_at < self.idle_seconds and conn.sock is not None:
+                conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+
+    def put(self, conn):
+        try:
+            self._idle.put_nowait((conn, time.monotonic()))
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait()[0].close()
+            except queue.Empty:
+                return
+
+
+class Client:
+    """Client for the FFmpeg API server.
+
+    Request methods take a builder from ffmpeg_api_client.builders or a plain
+    dict and return the decoded JSON response; errors raise APIError.
+    """
+
+    def __init__(self, base_url=DEFAULT_URL, pool_size=8, timeout=30, encode_timeout=ENCODE_TIMEOUT,
+                 retry=None, headers=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.encode_timeout = encode_timeout
+        self.retry = retry or RetryPolicy()
+        self.headers = {'Accept': 'application/json', **(headers or {})}
+        self._pool = _ConnectionPool(self.base_url, pool_size)
+
+    def close(self):
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- transport -------------------------------------------------------------------------
+
+    def _send(self, conn, method, path, body, headers):
+        payload = None
+        headers = {**self.headers, **(headers or {})}
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        conn.request(method, self._pool.prefix + path, body=payload, headers=headers)
+        return conn.getresponse()
+
+    def _attempt(self, method, path, body, headers, timeout):
+        conn, reused = self._pool.get(timeout)
+        try:
+            try:
+                response = self._send(conn, method, path, body, headers)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection; one more try on a fresh one
+                conn.close()
+                conn = self._pool.new(timeout)
+                response = self._send(conn, method, path, body, headers)
+            data = response.read()
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._pool.put(conn)
+        return response.status, {k.lower(): v for k, v in response.getheaders()}, data
+
+    def request(self, method, path, body=None, headers=None, timeout=None, retry=None):
+        """(status, headers, decoded body) of a successful (< 400) response."""
+        retry = retry or self.retry
+        timeout = timeout or self.timeout
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                status, response_headers, data = self._attempt(method, path, body, headers, timeout)
+            except (ConnectionError, http.client.HTTPException):
+                if attempt >= retry.attempts:
+                    raise
+                time.sleep(retry.delay(attempt))
+                continue
+            if status < 400:
+                return status, response_headers, decode(response_headers, data)
+            retry_after = parse_retry_after(response_headers.get('retry-after'))
+            if not retry.retryable(status) or attempt >= retry.attempts:
+                raise APIError(status, decode(response_headers, data), retry_after)
+            time.sleep(retry.delay(attempt, retry_after))
+
+    def _stream(self, method, path, body=None, timeout=None):
+        # Long-lived responses get their own connection rather than tying up a pooled one
+        conn = self._pool.new(timeout or self.timeout)
+        try:
+            response = self._send(conn, method, path, body, None)
+        except BaseException:
+            conn.close()
+            raise
+        if response.status >= 400:
+            headers = {k.lower(): v for k, v in response.getheaders()}
+            data = response.read()
+            conn.close()
+            raise APIError(response.status, decode(headers, data), parse_retry_after(headers.get('retry-after')))
+        return conn, response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)[2]
+
+    def post(self, path, body, **kwargs):
+        return self.request('POST', path, body, **kwargs)[2]
+
+    def _run_job(self, path, body):
+        return check_job(self.post(path, body, timeout=self.encode_timeout, retry=self.retry.for_jobs()))
+
+    # --- endpoints --------------------------------------------------------------------------
+
+    def health(self):
+        return self.get('/health')
+
+    def info(self):
+        return self.get('/info')
+
+    def stats(self):
+        return self.get('/stats')
+
+    def files(self):
+        return self.get('/files')
+
+    def encode(self, request, on_progress=None):
+        """POST /encode; on_progress(sample) is called with live progress while it runs."""
+        body = job_body(request)
+        if on_progress is None:
+            return self._run_job('/encode', body)
+        watcher = threading.Thread(target=self._watch, args=(body['job_id'], on_progress), daemon=True)
+        watcher.start()
+        try:
+            return self._run_job('/encode', body)
+        finally:
+            watcher.join(timeout=self.timeout)
+
+    def _watch(self, job_id, on_progress):
+        try:
+            for event in self.progress(job_id):
+                if event.get('event') == 'progress':
+                    on_progress(event)
+        except (OSError, http.client.HTTPException, APIError):
+            # Progress is best-effort; the encode's own response carries the outcome
+            pass
+
+    def submit(self, request):
+        """POST /jobs (queued mode); returns the job id."""
+        return self.post('/jobs', job_body(request), retry=self.retry.for_jobs())['job_id']
+
+    def job(self, job_id):
+        return self.get(f'/jobs/{urllib.parse.quote(job_id)}')
+
+    def timeline(self, job_id):
+        return self.get(f'/jobs/{urllib.parse.quote(job_id)}/timeline')
+
+    def cancel(self, job_id):
+        """POST /jobs/<id>/cancel; the job's own request then ends with a 499 'cancelled' APIError."""
+        return self.post(f'/jobs/{urllib.parse.quote(job_id)}/cancel', {})
+
+    def trim(self, request):
+        return self._run_job('/trim', job_body(request))
+
+    def analyze(self, request):
+        return self._run_job('/analyze', job_body(request))
+
+    def quality(self, request):
+        return self._run_job('/quality', job_body(request))
+
+    def encode_many(self, requests, concurrency=4, return_exceptions=False):
+        """Encode a batch over the shared pool; results are in request order.
+
+        With return_exceptions, failed requests give their exception instead of raising.
+        """
+        def run(request):
+            try:
+                return self.encode(request)
+            except Exception as e:
+                if return_exceptions:
+                    return e
+                raise
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(run, requests))
+
+    def encode_stream(self, request, out, chunk_size=64 * 1024):
+        """POST /encode/stream, writing the encoded bytes to the file object out; returns bytes written."""
+        conn, response = self._stream('POST', '/encode/stream', body_of(request), timeout=self.encode_timeout)
+        written = 0
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    return written
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            conn.close()
+
+    def frames(self, request):
+        """Yield FrameBatch(frames, times) from POST /frames; each batch is read into its own buffer."""
+        conn, response = self._stream('POST', '/frames', body_of(request), timeout=self.encode_timeout)
+
+        def read_exact(n):
+            buffer = bytearray(n)
+            view = memoryview(buffer)
+            filled = 0
+            while filled < n:
+                got = response.readinto(view[filled:])
+                if not got:
+                    raise http.client.IncompleteRead(bytes(view[:filled]), n - filled)
+                filled += got
+            return buffer
+        try:
+            _, width, height, channels = FRAME_STREAM_HEADER.unpack(read_exact(FRAME_STREAM_HEADER.size))
+            frame_bytes = width * height * channels
+            while True:
+                head = response.read(FRAME_BATCH_HEADER.size)
+                if not head:
+                    return
+                if len(head) < FRAME_BATCH_HEADER.size:
+                    head += read_exact(FRAME_BATCH_HEADER.size - len(head))
+                _, count = FRAME_BATCH_HEADER.unpack(head)
+                times = struct.unpack(f'<{count}d', read_exact(8 * count))
+                yield frame_batch(read_exact(count * frame_bytes), count, (height, width, channels), times)
+        finally:
+            conn.close()
+
+    def progress(self, job_id, wait=30):
+        """Yield the progress events of a running job, ending with its 'finished' (or 'not_found') event."""
+        path = f'/jobs/{urllib.parse.quote(job_id)}/progress?wait={wait}'
+        conn, response = self._stream('GET', path, timeout=max(self.timeout, wait + 10))
+        try:
+            while True:
+                line = response.readline()
+                if not line:
+                    return
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+    def download(self, name, dest):
+        """Download a workspace file to dest, resuming from dest + '.part' after an interruption."""
+        partial = f'{dest}.part'
+        path = f'/files/{urllib.parse.quote(name)}'
+        attempt = 0
+        while True:
+            attempt += 1
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            try:
+                conn = self._pool.new(self.encode_timeout)
+                try:
+                    headers = {**self.headers, 'Range': f'bytes={offset}-'} if offset else self.headers
+                    conn.request('GET', self._pool.prefix + path, headers=headers)
+                    response = conn.getresponse()
+                    if response.status == 416:
+                        # Everything was already received
+                        break
+                    if response.status >= 400:
+                        data = response.read()
+                        raise APIError(response.status, decode({k.lower(): v for k, v in response.getheaders()},
+                                                               data))
+                    # 200 instead of 206 means the server sent the whole file again
+                    with open(partial, 'ab' if response.status == 206 else 'wb') as f:
+                        while True:
+                            chunk = response.read(DOWNLOAD_CHUNK)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                    if response.length:
+                        raise http.client.IncompleteRead(b'', response.length)
+                finally:
+                    conn.close()
+                break
+            except (ConnectionError, http.client.HTTPException, TimeoutError):
+                if attempt >= self.retry.attempts:
+                    raise
+                time.sleep(self.retry.delay(attempt))
+        os.replace(partial, dest)
+        return dest
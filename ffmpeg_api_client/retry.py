@@ -0,0 +1,65 @@
+# Errors and the retry policy shared by the sync and asyncio clients
+
+import random
+from typing import Optional
+
+
+class APIError(Exception):
+    """Non-2xx response; payload is the decoded JSON body when there is one."""
+
+    def __init__(self, status: int, payload, retry_after: Optional[float] = None):
+        message = None
+        if isinstance(payload, dict):
+            message = payload.get('message') or (payload.get('ffmpeg_stderr') or '')[-500:].strip() or None
+        super().__init__(f'HTTP {status}: {message or payload}')
+        self.status = status
+        self.payload = payload
+        self.retry_after = retry_after
+
+
+class RetryPolicy:
+    """Which failures are retried and how long to wait before each retry.
+
+    429 and 5xx responses and connection errors are retried with jittered
+    exponential backoff; a Retry-After header from the server wins over the
+    computed delay (capped at max_delay). Calls that start a job use for_jobs().
+    """
+
+    def __init__(self, attempts: int = 5, backoff: float = 0.5, max_delay: float = 60.0,
+                 statuses=(429, 500, 502, 503, 504, 507)):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.statuses = tuple(statuses)
+
+    def retryable(self, status: int) -> bool:
+        return status in self.statuses
+
+    def for_jobs(self) -> 'RetryPolicy':
+        """This policy for calls that start a job, which are not idempotent.
+
+        A 500 can come after the job ran (or while it still runs), so it is not retried.
+        """
+        return RetryPolicy(self.attempts, self.backoff, self.max_delay, (s for s in self.statuses if s != 500))
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return min(self.backoff * 2 ** (attempt - 1), self.max_delay) * random.uniform(0.8, 1.2)
+
+
+NO_RETRY = RetryPolicy(attempts=1)
+
+
+def check_job(payload, status: int = 200):
+    """payload of a job call, raising APIError when a 2xx body reports a failed job."""
+    if isinstance(payload, dict) and payload.get('status') == 'error':
+        raise APIError(status, payload)
+    return payload
+
+
+def parse_retry_after(value) -> Optional[float]:
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -2,11 +2,40 @@ import flask
 import subprocess
 import os
 import json
+import re
 import time
+import uuid
 import logging
+import threading
+import collections
+import tempfile
 from datetime import datetime
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+import job_queue
+import filter_catalog
+import ffmpeg_runner
+import workspace_quota
+import staging
+import pools
+import analysis
+import keyframe_index
+import trim
+import media_probe
+import watch_folder
+import webhooks
+import http_cache
+import capabilities
+import two_pass
+import auto_quality
+import quality
+import admission
+import waveform
+import frames
+import cancellation
+import stall_watchdog
+import remote_input
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,8 +51,12 @@ stats = {
     'start_time': datetime.now().isoformat()
 }
 
-@app.route('/')
-def docs():
+# Shared job queue for multi-node worker mode (disabled unless FFMPEG_API_QUEUE is set)
+job_backend = job_queue.open_backend(job_queue.QUEUE_URL) if job_queue.QUEUE_URL else None
+queue_worker = None
+folder_watcher = None
+
+def render_docs():
     return '''
     <!DOCTYPE html>
     <html>
@@ -176,6 +209,11 @@ def docs():
                 <p>List all available video files in the workspace with size information</p>
             </div>
             
+            <div class="endpoint">
+                <span class="method get">GET</span><strong>/files/&lt;name&gt;</strong>
+                <p>Download a workspace file (supports Range requests for resuming)</p>
+            </div>
+            
             <div class="endpoint">
                 <span class="method get">GET</span><strong>/info</strong>
                 <p>Display FFmpeg version, capabilities, and hardware acceleration status</p>
@@ -183,12 +221,67 @@ def docs():
             
             <div class="endpoint">
                 <span class="method get">GET</span><strong>/stats</strong>
-                <p>Show encoding statistics and performance metrics</p>
+                <p>Show encoding statistics and performance metrics, including each pool's adaptive concurrency limit and its history</p>
             </div>
             
             <div class="endpoint">
                 <span class="method post">POST</span><strong>/encode</strong>
-                <p>Encode video with NVIDIA NVENC hardware acceleration</p>
+                <p>Encode video with NVIDIA NVENC hardware acceleration; <code>input</code> may also be an <code>http(s)://</code> URL (also on /trim, /analyze, /quality and /frames)</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/encode/stream</strong>
+                <p>Same body as /encode (no output needed); streams fragmented MP4 (or <code>"format": "mpegts"</code>) as it is encoded</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/jobs</strong>
+                <p>Queue an encode on the shared cluster queue (same fields as /encode); poll <code>GET /jobs/&lt;job_id&gt;</code> for the result</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method get">GET</span><strong>/jobs/&lt;job_id&gt;/timeline</strong>
+                <p>Per-job performance timeline: spawn latency, time to first frame, fps/speed/bitrate samples, CPU time and peak RSS</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method get">GET</span><strong>/jobs/&lt;job_id&gt;/progress</strong>
+                <p>Live progress of a running job (send your own <code>job_id</code> with the request) as newline-delimited JSON, ending with a <code>finished</code> line</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/jobs/&lt;job_id&gt;/cancel</strong>
+                <p>Stop a running job (send your own <code>job_id</code> with the request): ffmpeg gets <code>q</code>, then SIGTERM, then SIGKILL; partial outputs are removed and the job's request returns 499. Jobs are also cancelled when their client disconnects</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/trim</strong>
+                <p>Frame-accurate clip (<code>input</code>, <code>output</code>, <code>start</code>, <code>end</code> or <code>duration</code>): whole GOPs are stream-copied, only the partial GOPs at the cut points are re-encoded</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method get">GET</span><strong>/files/&lt;name&gt;/index</strong>
+                <p>Keyframe index of a file (times, byte offsets, GOP sizes), built once and cached; <code>?start=&amp;end=</code> limits the list, <code>?seek=t</code> returns the keyframe to seek to</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/frames</strong>
+                <p>Decoded frames as raw <code>uint8</code> batches for ML pipelines (<code>input</code>, <code>pix_fmt</code>, <code>width</code>/<code>height</code>, one of <code>fps</code>, <code>keyframes_only</code> or <code>timestamps</code>, <code>start</code>/<code>duration</code>, <code>max_frames</code>, <code>batch_size</code>); streamed as binary with per-frame times</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method get">GET</span><strong>/files/&lt;name&gt;/peaks</strong>
+                <p>Audio waveform peaks (min/max/RMS per bucket) at several zoom levels, computed once per file and cached; pick a level with <code>?samples_per_peak=</code> or <code>?width=</code>, limit with <code>?start=&amp;end=</code>, <code>?format=dat</code> for audiowaveform's binary format</p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/analyze</strong>
+                <p>One-pass loudnorm/cropdetect/silencedetect/scene analysis of an input, cached per file; encodes reuse it via <code>"auto_loudnorm": true</code> and <code>"auto_crop": true</code></p>
+            </div>
+            
+            <div class="endpoint">
+                <span class="method post">POST</span><strong>/quality</strong>
+                <p>VMAF/SSIM/PSNR of an output against its source, scored in parallel chunks; per-frame and aggregate scores, cached per (source, output) pair</p>
             </div>
             
             <h2>🎬 Basic Usage Examples</h2>
@@ -432,8 +525,12 @@ def docs():
                     <p><strong>video_codec:</strong> h264_nvenc, hevc_nvenc, libx264</p>
                     <p><strong>video_filter:</strong> Custom video filters</p>
                     <p><strong>scale:</strong> Resolution (1920x1080)</p>
+                    <p><strong>crop / auto_crop:</strong> w:h:x:y or detected black-bar crop</p>
                     <p><strong>preset:</strong> fast, medium, slow</p>
                     <p><strong>crf:</strong> Quality 18-28</p>
+                    <p><strong>target_size:</strong> "25MB" / "24MiB"; bitrate from duration, two-pass with cached first-pass stats</p>
+                    <p><strong>two_pass:</strong> true with bitrate for two-pass at a fixed bitrate</p>
+                    <p><strong>auto_quality:</strong> true or {"metric": "vmaf", "target": 93}; per-title CRF/CQ from sampled segments</p>
                 </div>
                 <div class="card">
                     <h4>Audio Parameters</h4>
@@ -441,6 +538,7 @@ def docs():
                     <p><strong>audio_filter:</strong> Custom audio filters</p>
                     <p><strong>audio_bitrate:</strong> 128k, 192k, 320k</p>
                     <p><strong>audio_only:</strong> true/false</p>
+                    <p><strong>auto_loudnorm:</strong> true or {"I": -16, "TP": -1.5, "LRA": 11}</p>
                 </div>
                 <div class="card">
                     <h4>Advanced Options</h4>
@@ -448,6 +546,7 @@ def docs():
                     <p><strong>input2:</strong> Second input file</p>
                     <p><strong>custom_filter:</strong> Special operations</p>
                     <p><strong>bitrate:</strong> Overall bitrate</p>
+                    <p><strong>callback_url:</strong> Webhook for completion/failure/progress</p>
                 </div>
             </div>
 
@@ -467,6 +566,14 @@ def docs():
     </html>
     '''
 
+# The docs page never changes while the process runs: render and compress it once
+docs_page = http_cache.StaticBody(render_docs(), 'text/html')
+docs_rendered_at = time.time()
+
+@app.route('/')
+def docs():
+    return docs_page.respond(last_modified=docs_rendered_at)
+
 @app.route('/health')
 def health():
     try:
@@ -505,6 +612,8 @@ def list_files():
             return {'error': 'Workspace not found', 'workspace': workspace}, 404
             
         for f in os.listdir(workspace):
+            if f.startswith('.'):
+                continue  # hidden partial outputs of running encodes
             if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.m4v', '.wmv', '.3gp', '.wav', '.mp3', '.aac', '.flac')):
                 filepath = os.path.join(workspace, f)
                 try:
@@ -513,67 +622,92 @@ def list_files():
                         'name': f,
                         'size_mb': round(stat.st_size / 1024 / 1024, 1),
                         'size_bytes': stat.st_size,
-                        'modified': datetime.fromtimestamp(stat.st_mtime).isoformat()
+                        'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                        'mtime': stat.st_mtime
                     })
                 except OSError:
                     continue
         
-        return {
+        # Unchanged listings revalidate with a 304 instead of resending the payload
+        last_modified = max([os.stat(workspace).st_mtime] + [f['mtime'] for f in files])
+        for f in files:
+            del f['mtime']
+        return http_cache.respond_json({
             'files': sorted(files, key=lambda x: x['name']),
             'total': len(files),
             'workspace': workspace,
             'total_size_mb': round(sum(f['size_mb'] for f in files), 1)
-        }
+        }, last_modified=last_modified)
     except Exception as e:
         logger.error(f"File listing failed: {e}")
         return {'error': str(e), 'workspace': '/workspace'}, 500
 
+@app.route('/files/<path:filename>')
+def download_file(filename):
+    # Outputs only: no hidden files (partial outputs, caches) and nothing outside the workspace
+    path = os.path.realpath(os.path.join('/workspace', filename))
+    if (not path.startswith('/workspace/') or any(part.startswith('.') for part in filename.split('/'))
+            or not os.path.isfile(path)):
+        return {'status': 'error', 'message': f'File not found: {filename}'}, 404
+    # send_file handles Range, ETag and If-Modified-Since, so interrupted downloads can resume
+    return flask.send_file(path, as_attachment=True, conditional=True, max_age=0)
+
+# ffmpeg's capabilities come from the persisted snapshot (see capabilities.py);
+# GPU memory is re-read at most every INFO_GPU_TTL seconds
+INFO_GPU_TTL = float(os.environ.get('FFMPEG_API_INFO_GPU_TTL', '10'))
+gpu_cache = {'gpu': None, 'read_at': 0.0, 'changed_at': 0.0}
+gpu_lock = threading.Lock()
+
 @app.route('/info')
 def ffmpeg_info():
     try:
-        info = {}
-        
-        # FFmpeg version
-        version_result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=10)
-        if version_result.returncode == 0:
-            info['ffmpeg_version'] = version_result.stdout.split('\n')[0]
-        
-        # Hardware accelerators
-        hwaccel_result = subprocess.run(['ffmpeg', '-hwaccels'], capture_output=True, text=True, timeout=10)
-        if hwaccel_result.returncode == 0:
-            info['hardware_accelerators'] = [line.strip() for line in hwaccel_result.stdout.split('\n')[1:] if line.strip()]
-        
-        # NVENC encoders
-        encoders_result = subprocess.run(['ffmpeg', '-encoders'], capture_output=True, text=True, timeout=10)
-        if encoders_result.returncode == 0:
-            nvenc_encoders = []
-            for line in encoders_result.stdout.split('\n'):
-                if 'nvenc' in line.lower() and line.strip():
-                    nvenc_encoders.append(line.strip())
-            info['nvenc_encoders'] = nvenc_encoders
-        
-        # GPU info
-        gpu_result = subprocess.run(['nvidia-smi', '--query-gpu=name,memory.total,memory.used', '--format=csv,noheader,nounits'], 
-                                  capture_output=True, text=True, timeout=10)
-        if gpu_result.returncode == 0:
-            gpu_data = gpu_result.stdout.strip().split(', ')
-            if len(gpu_data) >= 3:
-                info['gpu'] = {
-                    'name': gpu_data[0],
-                    'memory_total_mb': int(gpu_data[1]),
-                    'memory_used_mb': int(gpu_data[2]),
-                    'memory_free_mb': int(gpu_data[1]) - int(gpu_data[2])
-                }
+        snapshot = capabilities.snapshot()
+        with gpu_lock:
+            if time.monotonic() - gpu_cache['read_at'] > INFO_GPU_TTL:
+                gpu = capabilities.probe_gpu()
+                if gpu != gpu_cache['gpu']:
+                    gpu_cache.update(gpu=gpu, changed_at=time.time())
+                gpu_cache['read_at'] = time.monotonic()
+            gpu, gpu_changed_at = gpu_cache['gpu'], gpu_cache['changed_at']
         
-        info['cuda_available'] = 'cuda' in info.get('hardware_accelerators', [])
-        
-        return info
+        info = {key: snapshot.get(key) for key in ('ffmpeg_version', 'hardware_accelerators', 'nvenc_encoders',
+                                                    'cuda_available')}
+        if gpu:
+            info['gpu'] = gpu
+        info['capabilities_snapshot'] = {'created_at': snapshot['created_at'],
+                                         'ffmpeg_sha256': snapshot['binary'].get('sha256')}
+        return http_cache.respond_json(info, last_modified=max(snapshot['created_at'], gpu_changed_at))
     except Exception as e:
         logger.error(f"Info gathering failed: {e}")
         return {'error': str(e)}, 500
 
 @app.route('/stats')
 def get_stats():
+    response = local_stats()
+    response['pools'] = pools.pool_stats()
+    response['staging'] = staging.staging_stats()
+    try:
+        response['disk'] = {**workspace_quota.disk_status(), 'evicted_outputs': workspace_quota.eviction_count()}
+    except OSError as e:
+        response['disk'] = {'error': str(e)}
+    response['admission'] = {**admission.admission.snapshot(),
+                             'queued': {name: pool.queued for name, pool in pools.pools.items()}}
+    response['webhooks'] = webhooks.dispatcher.snapshot()
+    response['cancellation'] = cancellation.registry.snapshot()
+    response['watchdog'] = stall_watchdog.monitor.snapshot()
+    response['remote_inputs'] = remote_input.snapshot()
+    if folder_watcher is not None:
+        response['watch'] = folder_watcher.snapshot()
+    if job_backend is not None:
+        try:
+            response['cluster'] = job_queue.cluster_stats(
+                job_backend, queue_worker.snapshot() if queue_worker else None)
+        except Exception as e:
+            logger.error(f"Cluster stats failed: {e}")
+            response['cluster'] = {'error': str(e)}
+    return response
+
+def local_stats():
     uptime_seconds = (datetime.now() - datetime.fromisoformat(stats['start_time'])).total_seconds()
     return {
         **stats,
@@ -582,189 +716,1047 @@ def get_stats():
         'success_rate': round((stats['successful_encodings'] / max(stats['total_encodings'], 1)) * 100, 1)
     }
 
+@app.route('/jobs', methods=['POST'])
+@admission.limited()
+def submit_job():
+    if job_backend is None:
+        return {'status': 'error', 'message': 'Job queue not configured (set FFMPEG_API_QUEUE)'}, 503
+    
+    data = flask.request.get_json(silent=True)
+    if not data or not isinstance(data, dict):
+        return {'status': 'error', 'message': 'No JSON data provided'}, 400
+    for field in ['input', 'output']:
+        if field not in data:
+            return {'status': 'error', 'message': f'Missing required field: {field}'}, 400
+    invalid = filter_catalog.validate_encode(filter_catalog.catalog, data) or check_callback(data)
+    if invalid:
+        return {'status': 'error', **invalid}, 400
+    
+    try:
+        job_id = job_backend.enqueue(data)
+    except job_queue.DuplicateJob as e:
+        return {'status': 'error', 'field': 'job_id', 'message': str(e)}, 409
+    except Exception as e:
+        logger.error(f"Enqueue failed: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+    
+    return {'status': 'queued', 'job_id': job_id, 'timestamp': datetime.now().isoformat()}, 202
+
+@app.route('/jobs/<job_id>/timeline')
+def get_job_timeline(job_id):
+    timeline = ffmpeg_runner.load_timeline(job_id)
+    if timeline is None:
+        return {'status': 'error', 'message': f'No timeline for job: {job_id}'}, 404
+    return http_cache.respond_json(timeline)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    # Only jobs running in this process can be stopped; queued cluster jobs are still waiting for a worker
+    stopping = cancellation.registry.cancel(job_id, 'requested')
+    if stopping is None:
+        return {'status': 'error', 'message': f'Job not running here: {job_id}'}, 404
+    return {'status': 'cancelling', 'job_id': job_id, 'processes': stopping,
+            'grace_seconds': cancellation.GRACE_SECONDS, 'timestamp': datetime.now().isoformat()}, 202
+
+def cancellable(job_id):
+    # The request's ffmpeg runs stop on POST /jobs/<id>/cancel or when its client hangs up
+    return cancellation.registry.scope(job_id, cancellation.client_socket(flask.request.environ))
+
+def timeout_response(e, what, **fields):
+    # The stall watchdog stops runs that stopped making progress or passed their deadline
+    reason = getattr(e, 'reason', 'deadline')
+    if reason == 'stalled':
+        message = f'{what} stalled: no progress for {int(e.timeout)}s'
+    else:
+        message = f'{what} timeout ({int(e.timeout)}s limit)'
+    return {'status': 'error', **fields, 'reason': reason, 'message': message}, 408
+
+def cancelled_response(job_id, e):
+    return {'status': 'cancelled', 'job_id': job_id, 'reason': e.reason, 'message': str(e),
+            'timestamp': datetime.now().isoformat()}, 499
+
+# A job's runs can have short gaps between them (pass one and two, trim pieces and join)
+PROGRESS_GRACE_SECONDS = 5
+PROGRESS_POLL_SECONDS = float(ffmpeg_runner.PROGRESS_PERIOD)
+
+@app.route('/jobs/<job_id>/progress')
+def stream_job_progress(job_id):
+    # Newline-delimited JSON progress samples of a running job, ending with a "finished" line
+    wait = min(flask.request.args.get('wait', 30, type=float), 300)
+    
+    def generate():
+        deadline = time.monotonic() + wait
+        seen_at = None
+        last = None
+        while True:
+            current = ffmpeg_runner.current_progress(job_id)
+            if current is not None:
+                seen_at = time.monotonic()
+                run, sample = current
+                if sample is not last:
+                    last = sample
+                    yield json.dumps({'event': 'progress', 'job_id': job_id, 'run': run, **sample}) + '\n'
+            elif seen_at is None and time.monotonic() > deadline:
+                break
+            elif seen_at is not None and (ffmpeg_runner.load_timeline(job_id) is not None
+                                          or time.monotonic() - seen_at > PROGRESS_GRACE_SECONDS):
+                break
+            time.sleep(PROGRESS_POLL_SECONDS)
+        timeline = ffmpeg_runner.load_timeline(job_id) if seen_at is not None else None
+        yield json.dumps({'event': 'finished' if seen_at is not None else 'not_found', 'job_id': job_id,
+                          'returncode': timeline.get('returncode') if timeline else None,
+                          'summary': timeline.get('summary') if timeline else None}) + '\n'
+    
+    return flask.Response(generate(), mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    if job_backend is None:
+        return {'status': 'error', 'message': 'Job queue not configured (set FFMPEG_API_QUEUE)'}, 503
+    job = job_backend.get(job_id)
+    if job is None:
+        return {'status': 'error', 'message': f'Job not found: {job_id}'}, 404
+    return job
+
 @app.route('/encode', methods=['POST'])
+@admission.limited(pools.for_job)
 def encode():
+    return run_encode(flask.request.get_json(silent=True), cancellation.client_socket(flask.request.environ))
+
+def check_callback(data):
+    # Webhook fields of an /encode or /jobs body; returns an error dict or None
+    if not data.get('callback_url'):
+        return None
+    message = webhooks.check_url(data['callback_url'])
+    if message:
+        return {'field': 'callback_url', 'message': message}
+    unknown = [e for e in data.get('callback_events', []) if e not in webhooks.EVENTS]
+    if unknown:
+        return {'field': 'callback_events',
+                'message': f"Unknown callback_events: {', '.join(map(str, unknown))} (expected {', '.join(webhooks.EVENTS)})"}
+    return None
+
+def resolve_input(name, field='input', exists=os.path.exists):
+    # Workspace-relative names, absolute paths, or http(s) URLs that ffmpeg reads through the local range proxy
+    if remote_input.is_remote(name):
+        try:
+            return remote_input.open_url(name), None
+        except remote_input.RemoteInputError as e:
+            return None, ({'status': 'error', 'field': field, 'message': str(e)}, e.http_status)
+    path = name if name.startswith('/') else f'/workspace/{name}'
+    if not exists(path):
+        return None, ({'status': 'error', 'message': f'Input file not found: {path}'}, 404)
+    return path, None
+
+def prepare_encode(data, required_fields=('input', 'output')):
+    # Validate an /encode body and build the ffmpeg command up to (but not including) the output
+    if not data or not isinstance(data, dict):
+        return None, ({'status': 'error', 'message': 'No JSON data provided'}, 400)
+    
+    # Validate required fields
+    for field in required_fields:
+        if field not in data:
+            return None, ({'status': 'error', 'message': f'Missing required field: {field}'}, 400)
+    
+    # Reject unknown filters/codecs before spawning ffmpeg
+    invalid = filter_catalog.validate_encode(filter_catalog.catalog, data)
+    if invalid:
+        return None, ({'status': 'error', **invalid}, 400)
+    invalid = check_callback(data)
+    if invalid:
+        return None, ({'status': 'error', **invalid}, 400)
+    
+    input_file = data['input']
+    output_file = data.get('output')
+    input2_file = data.get('input2')
+    temp_files = []
+    
+    # Handle special concatenation syntax
+    if input_file.startswith('concat:'):
+        files = input_file.replace('concat:', '').split('|')
+        input_files = [f'/workspace/{f}' if not f.startswith('/') else f for f in files]
+        # Create concat file list (unique per request, jobs run concurrently)
+        fd, concat_list = tempfile.mkstemp(prefix='concat_list_', suffix='.txt')
+        with os.fdopen(fd, 'w') as f:
+            for file in input_files:
+                f.write(f"file '{file}'\n")
+        input_file = concat_list
+        temp_files.append(concat_list)
+        use_concat = True
+    else:
+        use_concat = False
+        if remote_input.is_remote(input_file):
+            input_file, error = resolve_input(input_file)
+            if error:
+                return None, error
+        # Add workspace prefix if not absolute path
+        elif not input_file.startswith('/'):
+            input_file = f'/workspace/{input_file}'
+    
+    if input2_file and remote_input.is_remote(input2_file):
+        input2_file, error = resolve_input(input2_file, 'input2')
+        if error:
+            return None, error
+    elif input2_file and not input2_file.startswith('/'):
+        input2_file = f'/workspace/{input2_file}'
+    
+    if output_file and not output_file.startswith('/'):
+        output_file = f'/workspace/{output_file}'
+    
+    # Check if input file exists (skip for concat and remote inputs, checked at the origin)
+    if not use_concat and not remote_input.is_proxy_url(input_file) and not os.path.exists(input_file):
+        available_files = []
+        try:
+            available_files = [f for f in os.listdir('/workspace') 
+                             if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.wav', '.mp3'))]
+        except:
+            pass
+    
+        return None, ({
+            'status': 'error', 
+            'message': f'Input file not found: {input_file}',
+            'available_files': available_files
+        }, 404)
+    
+    # Apply cached (or freshly measured) loudnorm/crop analysis when requested
+    applied_analysis = {}
+    if not use_concat:
+        try:
+            # A cache miss decodes the whole input, so it waits for a light slot like /analyze does
+            data, applied_analysis = analysis.apply_cached(data, input_file, slot=pools.pools['light'].slot)
+        except analysis.AnalysisError as e:
+            return None, ({'status': 'error', 'message': f'Analysis failed: {e}'}, 422)
+    
+    # Target size / two-pass: the bitrate comes from the probed duration
+    target = quality_choice = None
+    if data.get('target_size') is not None or data.get('two_pass'):
+        if use_concat:
+            return None, ({'status': 'error', 'field': 'target_size',
+                           'message': 'target_size and two_pass are not supported for concat inputs'}, 400)
+        try:
+            target = two_pass.plan(data, input_file)
+        except two_pass.TargetSizeError as e:
+            return None, ({'status': 'error', 'field': e.field, 'message': str(e)}, 400)
+    
+    crop = data.get('crop')
+    if crop and not re.fullmatch(r'\d+:\d+:\d+:\d+', str(crop)):
+        return None, ({'status': 'error', 'field': 'crop', 'message': 'crop must be "w:h:x:y"'}, 400)
+    if data.get('auto_quality') and (use_concat or input2_file or data.get('complex_filter') or data.get('audio_only')
+                                     or target or data.get('bitrate')):
+        return None, ({'status': 'error', 'field': 'auto_quality',
+                       'message': 'auto_quality needs a single video input and no bitrate or target_size'}, 400)
+    if data.get('auto_quality'):
+        try:
+            auto_quality.settings(data.get('video_codec', 'h264_nvenc'), data['auto_quality'])
+        except auto_quality.AutoQualityError as e:
+            return None, ({'status': 'error', 'field': 'auto_quality', 'message': str(e)}, 400)
+    
+    # Build FFmpeg command
+    cmd = ['ffmpeg', '-y']
+    
+    # Hardware acceleration (skip for audio-only)
+    if not data.get('audio_only', False):
+        cmd.extend(['-hwaccel', 'cuda'])
+    
+    # Input handling
+    if use_concat:
+        cmd.extend(['-f', 'concat', '-safe', '0', '-i', input_file])
+    else:
+        cmd.extend(['-i', input_file])
+    
+    # Second input for mixing
+    if input2_file:
+        cmd.extend(['-i', input2_file])
+    
+    # Complex filter for advanced operations
+    if 'complex_filter' in data:
+        cmd.extend(['-filter_complex', data['complex_filter']])
+    
+    # Video codec and settings
+    if not data.get('audio_only', False):
+        video_codec = data.get('video_codec', 'h264_nvenc')
+        cmd.extend(['-c:v', video_codec])
+    
+        preset = data.get('preset', 'fast')
+        if 'nvenc' in video_codec:
+            cmd.extend(['-preset', preset])
+    
+        # Video filters (crop first, so scaling sees the cropped frame)
+        video_filters = []
+        if crop:
+            video_filters.append(f'crop={crop}')
+        if data.get('scale'):
+            video_filters.append(f"scale_cuda={data['scale']}")
+        if data.get('video_filter'):
+            video_filters.append(data['video_filter'])
+        filter_args = ['-vf', ','.join(video_filters)] if video_filters else []
+    
+        # Quality settings
+        bitrate = data.get('bitrate')
+        crf = str(data.get('crf', '23'))
+    
+        if target:
+            cmd.extend(two_pass.rate_args(target))
+        elif data.get('auto_quality'):
+            # Sampled segments go through the same decoder, encoder and filters as the full encode
+            sample_cmd = cmd[:cmd.index('-i')] + ['-i', input_file, '-map', '0:v:0', '-an'] + cmd[cmd.index('-c:v'):]
+            reference_filter = ','.join(f for f in (f'crop={crop}' if crop else None, data.get('video_filter'))
+                                        if f and 'cuda' not in f and 'npp' not in f) or None
+            try:
+                with pools.for_job(data).slot():
+                    quality_choice = auto_quality.choose(input_file, video_codec, sample_cmd + filter_args,
+                                                         data['auto_quality'], crop=crop,
+                                                         reference_filter=reference_filter,
+                                                         job_id=str(data.get('job_id') or uuid.uuid4().hex))
+            except (auto_quality.AutoQualityError, quality.QualityError) as e:
+                return None, ({'status': 'error', 'field': 'auto_quality', 'message': str(e)}, 422)
+            cmd.extend(quality_choice.pop('args'))
+        elif bitrate:
+            cmd.extend(['-b:v', bitrate])
+        elif 'nvenc' in video_codec:
+            cmd.extend(['-crf', crf])
+    
+        cmd.extend(filter_args)
+    else:
+        cmd.extend(['-vn'])  # No video for audio-only
+    
+    # Audio codec and settings
+    if not data.get('video_only', False):
+        audio_codec = data.get('audio_codec', 'aac')
+        cmd.extend(['-c:a', audio_codec])
+    
+        audio_bitrate = data.get('audio_bitrate', '128k')
+        if audio_codec != 'pcm_s16le':
+            cmd.extend(['-b:a', audio_bitrate])
+    
+        # Audio filters
+        audio_filter = data.get('audio_filter')
+        if audio_filter:
+            cmd.extend(['-af', audio_filter])
+    else:
+        cmd.extend(['-an'])  # No audio for video-only
+    
+    if target and target['rate_control'] == 'two_pass':
+        # First-pass stats are shared by every encode of this input through the same video pipeline
+        target['passlog'] = two_pass.passlog_prefix(two_pass.stats_key(cmd, (input_file, input2_file)))
+    
+    return {'cmd': cmd, 'input_file': input_file, 'input2_file': input2_file, 'output_file': output_file,
+            'temp_files': temp_files, 'analysis': applied_analysis, 'target': target,
+            'auto_quality': quality_choice}, None
+
+def cleanup_prepared(prepared):
+    for path in prepared['temp_files']:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def run_encode(data, sock=None):
+    if not isinstance(data, dict):
+        data = {}  # rejected with a 400 by prepare_encode
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        with cancellation.registry.scope(job_id, sock):
+            result = execute_encode(data, job_id)
+    except cancellation.DuplicateJob as e:
+        return {'status': 'error', 'job_id': job_id, 'field': 'job_id', 'message': str(e)}, 409
+    response, status = result if isinstance(result, tuple) else (result, 200)
+    # Outputs still moving back from scratch are reported by finish_staged_output once the move is done;
+    # a run that lost its queue lease is reported by the node that took the job over
+    if (wants_notification(data) and not response.get('output_pending_move')
+            and response.get('reason') != 'lease_lost'):
+        notify_job(data, job_id, response, status)
+    return result
+
+def wants_notification(data):
+    return bool(data and data.get('callback_url') and not webhooks.check_url(data['callback_url']))
+
+def notify_job(data, job_id, response, status):
+    # Completion/failure webhook for jobs that asked for one
+    event = 'completed' if status == 200 and response.get('status') == 'success' else 'failed'
+    if event not in data.get('callback_events', webhooks.EVENTS):
+        return
+    fields = {key: response[key] for key in ('output_file', 'output_size_mb', 'processing_time_seconds', 'returncode')
+              if key in response}
+    if event == 'failed':
+        fields['message'] = response.get('message') or (response.get('ffmpeg_stderr') or '')[-1000:]
+        fields['http_status'] = status
+    webhooks.dispatcher.notify(data['callback_url'], event, job_id, **fields)
+
+def progress_notifier(data, job_id, input_file):
+    # Progress milestone webhooks, only when the job asks for them
+    if not data.get('callback_url') or 'progress' not in data.get('callback_events', webhooks.EVENTS):
+        return None
+    milestones = data.get('progress_milestones', (25, 50, 75))
+    return webhooks.ProgressNotifier(data['callback_url'], job_id, media_probe.duration(input_file), milestones)
+
+def execute_encode(data, job_id):
     start_time = time.time()
     stats['total_encodings'] += 1
     
     try:
-        data = flask.request.json
-        if not data:
-            return {'status': 'error', 'message': 'No JSON data provided'}, 400
+        prepared, error = prepare_encode(data)
+        if error:
+            return error
+        cmd, input_file, output_file = prepared['cmd'], prepared['input_file'], prepared['output_file']
         
-        # Validate required fields
-        required_fields = ['input', 'output']
-        for field in required_fields:
-            if field not in data:
-                return {'status': 'error', 'message': f'Missing required field: {field}'}, 400
+        target = prepared['target']
         
-        input_file = data['input']
-        output_file = data['output']
-        input2_file = data.get('input2')
-        
-        # Handle special concatenation syntax
-        if input_file.startswith('concat:'):
-            files = input_file.replace('concat:', '').split('|')
-            input_files = [f'/workspace/{f}' if not f.startswith('/') else f for f in files]
-            # Create concat file list
-            concat_list = '/tmp/concat_list.txt'
-            with open(concat_list, 'w') as f:
-                for file in input_files:
-                    f.write(f"file '{file}'\n")
-            input_file = concat_list
-            use_concat = True
+        # Reserve disk space for the estimated output before starting
+        if target and target.get('target_bytes'):
+            estimate, estimate_source = int(target['target_bytes'] * workspace_quota.SAFETY_FACTOR), 'target_size'
         else:
-            use_concat = False
-            # Add workspace prefix if not absolute path
-            if not input_file.startswith('/'):
-                input_file = f'/workspace/{input_file}'
-        
-        if input2_file and not input2_file.startswith('/'):
-            input2_file = f'/workspace/{input2_file}'
-            
-        if not output_file.startswith('/'):
-            output_file = f'/workspace/{output_file}'
-        
-        # Check if input file exists (skip for concat)
-        if not use_concat and not os.path.exists(input_file):
-            available_files = []
-            try:
-                available_files = [f for f in os.listdir('/workspace') 
-                                 if f.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.wav', '.mp3'))]
-            except:
-                pass
-            
+            estimate, estimate_source = workspace_quota.estimate_output_bytes(data, input_file)
+        try:
+            workspace_quota.reserve(job_id, estimate)
+        except workspace_quota.InsufficientSpace as e:
+            stats['failed_encodings'] += 1
+            cleanup_prepared(prepared)
             return {
-                'status': 'error', 
-                'message': f'Input file not found: {input_file}',
-                'available_files': available_files
-            }, 404
-        
-        # Build FFmpeg command
-        cmd = ['ffmpeg', '-y']
-        
-        # Hardware acceleration (skip for audio-only)
-        if not data.get('audio_only', False):
-            cmd.extend(['-hwaccel', 'cuda'])
-        
-        # Input handling
-        if use_concat:
-            cmd.extend(['-f', 'concat', '-safe', '0', '-i', input_file])
-        else:
-            cmd.extend(['-i', input_file])
-            
-        # Second input for mixing
-        if input2_file:
-            cmd.extend(['-i', input2_file])
+                'status': 'error',
+                'message': str(e),
+                'estimated_output_bytes': e.needed,
+                'available_bytes': e.available,
+                'estimate_source': estimate_source
+            }, 507
+        workspace_quota.touch(input_file)
         
-        # Complex filter for advanced operations
-        if 'complex_filter' in data:
-            cmd.extend(['-filter_complex', data['complex_filter']])
+        # Output file (written to a hidden temp file, renamed into place on success).
+        # With staging, ffmpeg writes to scratch and the file is moved back in the background.
+        tmp_output = workspace_quota.temp_path(output_file, job_id)
+        scratch_output = staging.scratch_output_path(job_id, output_file, estimate) if tmp_output else None
         
-        # Video codec and settings
-        if not data.get('audio_only', False):
-            video_codec = data.get('video_codec', 'h264_nvenc')
-            cmd.extend(['-c:v', video_codec])
-            
-            preset = data.get('preset', 'fast')
-            if 'nvenc' in video_codec:
-                cmd.extend(['-preset', preset])
-            
-            # Quality settings
-            bitrate = data.get('bitrate')
-            crf = str(data.get('crf', '23'))
-            
-            if bitrate:
-                cmd.extend(['-b:v', bitrate])
-            elif 'nvenc' in video_codec:
-                cmd.extend(['-crf', crf])
+        moving = False
+        output_size = 0
+        staged_inputs = []
+        try:
+            # Read inputs from fast local scratch when staging is enabled; the copies stay
+            # pinned until this job is done, however long it waits for its slot
+            for path in (input_file, prepared['input2_file']):
+                if path:
+                    staged = staging.stage_input(path)
+                    staged_inputs.append(staged)
+                    cmd = [staged if arg == path else arg for arg in cmd]
             
-            # Video filters
-            video_filter = data.get('video_filter')
-            scale = data.get('scale')
+            # Pass one sees exactly the inputs and filters pass two will
+            first_pass_cmd = None
+            if target and target.get('passlog'):
+                first_pass_cmd = list(cmd)
+                cmd += two_pass.second_pass_args(target['passlog'])
+            cmd.append(scratch_output or tmp_output or output_file)
             
-            if video_filter and scale:
-                cmd.extend(['-vf', f'scale_cuda={scale},{video_filter}'])
-            elif video_filter:
-                cmd.extend(['-vf', video_filter])
-            elif scale:
-                cmd.extend(['-vf', f'scale_cuda={scale}'])
-        else:
-            cmd.extend(['-vn'])  # No video for audio-only
-        
-        # Audio codec and settings
-        if not data.get('video_only', False):
-            audio_codec = data.get('audio_codec', 'aac')
-            cmd.extend(['-c:a', audio_codec])
+            logger.info(f"Starting encoding: {' '.join(cmd)}")
             
-            audio_bitrate = data.get('audio_bitrate', '128k')
-            if audio_codec != 'pcm_s16le':
-                cmd.extend(['-b:a', audio_bitrate])
+            # Audio-only and stream-copy jobs run in their own pool, never behind GPU encodes
+            pool = pools.for_job(data)
+            with pool.slot() as queue_wait:
+                first_pass = (two_pass.ensure_stats(first_pass_cmd, target['passlog'], job_id, pool.timeout)
+                              if first_pass_cmd else None)
+                # Execute FFmpeg under the stall watchdog, recording a progress timeline
+                result = ffmpeg_runner.run_ffmpeg(cmd, job_id, timeout=pool.timeout,
+                                                  on_progress=progress_notifier(data, job_id, input_file))
             
-            # Audio filters
-            audio_filter = data.get('audio_filter')
-            if audio_filter:
-                cmd.extend(['-af', audio_filter])
-        else:
-            cmd.extend(['-an'])  # No audio for video-only
-        
-        # Output file
-        cmd.append(output_file)
-        
-        logger.info(f"Starting encoding: {' '.join(cmd)}")
-        
-        # Execute FFmpeg with timeout
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=3600)  # 1 hour timeout
+            # Only complete outputs are moved into place
+            if result.returncode == 0 and scratch_output and os.path.exists(scratch_output):
+                output_size = os.path.getsize(scratch_output)
+                staging.mover.submit(scratch_output, tmp_output, lambda moved: finish_staged_output(
+                    moved, job_id, tmp_output, output_file, data, input_file, start_time))
+                moving = True
+            elif result.returncode == 0 and tmp_output and os.path.exists(tmp_output):
+                output_size = workspace_quota.commit_output(tmp_output, output_file)
+                workspace_quota.learn(data, output_size, input_file)
+        except cancellation.Cancelled:
+            # Temp and scratch outputs go below; direct outputs (image sequences, paths outside
+            # /workspace) are removed here so a cancelled job leaves no truncated files behind
+            if not tmp_output:
+                workspace_quota.discard_direct_output(output_file, start_time)
+            raise
+        finally:
+            cleanup_prepared(prepared)
+            for staged in staged_inputs:
+                staging.release_input(staged)
+            if not moving:
+                if scratch_output:
+                    workspace_quota.discard_output(scratch_output)
+                if tmp_output:
+                    workspace_quota.discard_output(tmp_output)
+                workspace_quota.release(job_id)
         
         processing_time = time.time() - start_time
         
-        # Check if output file was created
-        output_exists = os.path.exists(output_file)
-        output_size = 0
+        # Check if output file was created (a staged output is only in place once the mover is done)
+        output_exists = not moving and os.path.exists(output_file) and (result.returncode == 0 or not tmp_output)
         if output_exists:
             output_size = os.path.getsize(output_file)
             stats['successful_encodings'] += 1
-        else:
+        elif not moving:
             stats['failed_encodings'] += 1
         
         response = {
-            'status': 'success' if result.returncode == 0 and output_exists else 'error',
+            'status': 'success' if result.returncode == 0 and (output_exists or moving) else 'error',
+            'job_id': job_id,
             'returncode': result.returncode,
             'processing_time_seconds': round(processing_time, 2),
+            'pool': pool.name,
+            'queue_wait_ms': round(queue_wait * 1000, 1),
+            'timeline': result.timeline['summary'],
             'output_file_created': output_exists,
-            'output_size_mb': round(output_size / 1024 / 1024, 1) if output_exists else 0,
+            'output_size_mb': round(output_size / 1024 / 1024, 1) if output_exists or moving else 0,
+            'estimated_output_mb': round(estimate / 1024 / 1024, 1),
+            'output_pending_move': moving,
+            'analysis_applied': prepared['analysis'] or None,
+            'auto_quality': prepared['auto_quality'],
             'command': ' '.join(cmd),
-            'input_file': input_file,
+            'input_file': remote_input.origin_url(input_file),
             'output_file': output_file,
             'timestamp': datetime.now().isoformat()
         }
         
+        if target:
+            response['rate_control'] = {
+                'mode': target['rate_control'],
+                'video_bitrate_kbps': target['video_kbps'],
+                **(first_pass or {}),
+            }
+            if target.get('target_bytes'):
+                response['rate_control']['target_size_bytes'] = target['target_bytes']
+                if output_exists or moving:
+                    response['rate_control'].update({
+                        'size_error_percent': round((output_size / target['target_bytes'] - 1) * 100, 2),
+                        'within_target': output_size <= target['target_bytes'],
+                    })
+        
         # Include FFmpeg output for debugging if there was an error
-        if result.returncode != 0 or not output_exists:
+        if result.returncode != 0 or not (output_exists or moving):
             response['ffmpeg_stdout'] = result.stdout
             response['ffmpeg_stderr'] = result.stderr
         
         logger.info(f"Encoding completed: {response['status']} in {processing_time:.2f}s")
         
-        return response
+        return response, 200
         
-    except subprocess.TimeoutExpired:
+    except subprocess.TimeoutExpired as e:
+        stats['failed_encodings'] += 1
+        logger.error(f"Encoding {job_id} stopped: {getattr(e, 'reason', 'deadline')}")
+        return timeout_response(e, 'Encoding', job_id=job_id)
+    except two_pass.FirstPassError as e:
         stats['failed_encodings'] += 1
-        logger.error("Encoding timeout")
-        return {'status': 'error', 'message': 'Encoding timeout (1 hour limit)'}, 408
+        logger.error(f"Encoding {job_id} failed in its first pass")
+        return {'status': 'error', 'job_id': job_id, 'message': str(e), 'ffmpeg_stderr': e.stderr,
+                'timestamp': datetime.now().isoformat()}, 422
+    except cancellation.Cancelled as e:
+        stats['failed_encodings'] += 1
+        logger.warning(f"Encoding {job_id} cancelled ({e.reason})")
+        return cancelled_response(job_id, e)
     except Exception as e:
         stats['failed_encodings'] += 1
         logger.error(f"Encoding failed: {e}")
         return {'status': 'error', 'message': str(e), 'timestamp': datetime.now().isoformat()}, 500
 
+# Fragmented MP4 can be played while it is still being written; MPEG-TS is always streamable
+STREAM_FORMATS = {
+    'mp4': ('video/mp4', ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+                          '-frag_duration', '1000000']),
+    'mpegts': ('video/mp2t', ['-f', 'mpegts']),
+}
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def finish_staged_output(moved, job_id, tmp_output, output_file, data, input_file, start_time):
+    # Runs on the staging mover thread once a scratch output has been copied next to its destination
+    error = None if moved else 'Moving the output back from scratch failed'
+    try:
+        if moved:
+            output_size = workspace_quota.commit_output(tmp_output, output_file)
+            workspace_quota.learn(data, output_size, input_file)
+    except OSError as e:
+        error = f'Moving the output into place failed: {e}'
+    finally:
+        workspace_quota.discard_output(tmp_output)
+        workspace_quota.release(job_id)
+    stats['failed_encodings' if error else 'successful_encodings'] += 1
+    if wants_notification(data):
+        response = {'output_file': output_file, 'returncode': 0,
+                    'processing_time_seconds': round(time.time() - start_time, 2)}
+        if error:
+            notify_job(data, job_id, {**response, 'status': 'error', 'message': error}, 500)
+        else:
+            notify_job(data, job_id, {**response, 'status': 'success',
+                                      'output_size_mb': round(output_size / 1024 / 1024, 1)}, 200)
+
+@app.route('/encode/stream', methods=['POST'])
+@admission.limited(pools.for_job)
+def stream_encode():
+    data = flask.request.get_json(silent=True)
+    prepared, error = prepare_encode(data, required_fields=('input',))
+    if error:
+        return error
+    
+    container = data.get('format', 'mp4')
+    if container not in STREAM_FORMATS:
+        return {'status': 'error', 'message': f'Unsupported stream format: {container}',
+                'supported_formats': list(STREAM_FORMATS)}, 400
+    mimetype, muxer_args = STREAM_FORMATS[container]
+    cmd = prepared['cmd'] + muxer_args + ['pipe:1']
+    
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        token = cancellation.registry.open(job_id)
+    except cancellation.DuplicateJob as e:
+        cleanup_prepared(prepared)
+        return {'status': 'error', 'job_id': job_id, 'field': 'job_id', 'message': str(e)}, 409
+    stats['total_encodings'] += 1
+    pool = pools.for_job(data)
+    try:
+        # Queued as this job, so a cancel or the client hanging up gives up its place
+        with cancellation.registry.running(token, cancellation.client_socket(flask.request.environ)):
+            pool.acquire()
+    except cancellation.Cancelled as e:
+        stats['failed_encodings'] += 1
+        cancellation.registry.close(token)
+        cleanup_prepared(prepared)
+        return cancelled_response(job_id, e)
+    logger.info(f"Starting streaming encode: {' '.join(cmd)}")
+    # ffmpeg blocks on a full stdout pipe, so a slow client throttles the encode.
+    # stdout carries the stream, so its progress blocks go to stderr.
+    try:
+        process = subprocess.Popen(ffmpeg_runner.with_progress(cmd, 'pipe:2'), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, **cancellation.popen_kwargs())
+    except Exception:
+        pool.release()
+        cancellation.registry.close(token)
+        cleanup_prepared(prepared)
+        raise
+    token.attach(process)
+    
+    def stop():
+        threading.Thread(target=cancellation.terminate, args=(process, ffmpeg_runner.STOP_GRACE_SECONDS, False),
+                         name=f'stop-{job_id}', daemon=True).start()
+    
+    # A client that stops reading stalls the encode too, and frees its slot the same way
+    watch = stall_watchdog.monitor.watch(job_id, stop, pool.timeout)
+    stderr_tail = collections.deque(maxlen=50)
+    
+    def read_stderr():
+        t0, block = time.monotonic(), {}
+        for raw in process.stderr:
+            line = raw.decode(errors='replace')
+            key, sep, value = line.strip().partition('=')
+            if sep and key.isidentifier():
+                block[key] = value
+                if key == 'progress':
+                    watch.progress(ffmpeg_runner.progress_sample(block, time.monotonic() - t0))
+                    block = {}
+                continue
+            watch.saw_duration(stall_watchdog.parse_duration(line))
+            stderr_tail.append(line)
+    
+    threading.Thread(target=read_stderr, daemon=True).start()
+    
+    def finish():
+        # The stream is done or its client went away: q, then SIGTERM and SIGKILL to ffmpeg's group
+        stall_watchdog.monitor.unwatch(watch)
+        if process.poll() is None:
+            cancellation.terminate(process)
+        process.wait()
+    
+    def generate():
+        start_time = time.time()
+        sent = 0
+        try:
+            while True:
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if sent == 0:
+                    logger.info(f"Stream first byte after {time.time() - start_time:.2f}s")
+                sent += len(chunk)
+                yield chunk
+            process.wait()
+        finally:
+            finish()
+            if token.cancelled or watch.reason:
+                # Stopped with "q" first, so ffmpeg gets to finish the fragment it is writing
+                stats['failed_encodings'] += 1
+                logger.warning(f"Streaming encode {job_id} stopped ({token.reason or watch.reason})")
+            elif process.returncode == 0:
+                stats['successful_encodings'] += 1
+            else:
+                stats['failed_encodings'] += 1
+                logger.error(f"Streaming encode ended with code {process.returncode}: "
+                             f"{''.join(stderr_tail)[-2000:]}")
+            logger.info(f"Streaming encode sent {sent} bytes in {time.time() - start_time:.2f}s")
+    
+    def close():
+        # Runs even if the client disconnects before the first chunk
+        finish()
+        process.stdin.close()
+        cancellation.registry.close(token)
+        pool.release()
+        cleanup_prepared(prepared)
+    
+    # Not direct_passthrough: werkzeug then skips the close callbacks that release the slot
+    response = flask.Response(generate(), mimetype=mimetype, headers={'X-Job-Id': job_id})
+    response.call_on_close(close)
+    return response
+
+# Whether a trim needs the GPU is only known after planning; the GPU queue is the one that can back up
+@app.route('/trim', methods=['POST'])
+@admission.limited(lambda data: pools.pools['gpu'])
+def trim_media():
+    data = flask.request.get_json(silent=True)
+    if not data or not isinstance(data, dict):
+        return {'status': 'error', 'message': 'No JSON data provided'}, 400
+    for field in ['input', 'output', 'start']:
+        if field not in data:
+            return {'status': 'error', 'message': f'Missing required field: {field}'}, 400
+    if 'end' not in data and 'duration' not in data:
+        return {'status': 'error', 'message': 'Missing required field: end (or duration)'}, 400
+    try:
+        start = float(data['start'])
+        end = float(data['end']) if 'end' in data else start + float(data['duration'])
+    except (TypeError, ValueError):
+        return {'status': 'error', 'message': 'start, end and duration must be numbers (seconds)'}, 400
+    
+    input_file, error = resolve_input(data['input'])
+    if error:
+        return error
+    output_file = data['output'] if data['output'].startswith('/') else f"/workspace/{data['output']}"
+    
+    start_time = time.time()
+    stats['total_encodings'] += 1
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        index = keyframe_index.lookup(input_file)
+        if index is None:
+            with pools.pools['light'].slot():
+                index = keyframe_index.get_index(input_file)
+        # Pure copies (keyframe-aligned cuts) never wait behind GPU encodes
+        needs_encode = any(s['mode'] == 'encode' for s in trim.plan(index, start, end))
+        pool = pools.pools['gpu'] if needs_encode else pools.pools['light']
+        
+        duration = media_probe.duration(input_file) or (end - start)
+        estimate = int(media_probe.input_size(input_file) * min((end - start) / duration, 1.0)
+                       * workspace_quota.SAFETY_FACTOR)
+        try:
+            workspace_quota.reserve(job_id, estimate)
+        except workspace_quota.InsufficientSpace as e:
+            stats['failed_encodings'] += 1
+            return {'status': 'error', 'message': str(e), 'estimated_output_bytes': e.needed,
+                    'available_bytes': e.available}, 507
+        workspace_quota.touch(input_file)
+        tmp_output = workspace_quota.temp_path(output_file, job_id)
+        try:
+            with cancellable(job_id), pool.slot() as queue_wait:
+                result = trim.smart_trim(input_file, tmp_output or output_file, start, end, job_id,
+                                         timeout=pool.timeout)
+            output_size = (workspace_quota.commit_output(tmp_output, output_file) if tmp_output
+                           else os.path.getsize(output_file))
+        except cancellation.Cancelled:
+            if not tmp_output:
+                workspace_quota.discard_direct_output(output_file, start_time)
+            raise
+        finally:
+            if tmp_output:
+                workspace_quota.discard_output(tmp_output)
+            workspace_quota.release(job_id)
+    except (trim.TrimError, keyframe_index.IndexBuildError) as e:
+        stats['failed_encodings'] += 1
+        return {'status': 'error', 'job_id': job_id, 'message': str(e)}, 422
+    except subprocess.TimeoutExpired as e:
+        stats['failed_encodings'] += 1
+        return timeout_response(e, 'Trim', job_id=job_id)
+    except cancellation.Cancelled as e:
+        stats['failed_encodings'] += 1
+        return cancelled_response(job_id, e)
+    except cancellation.DuplicateJob as e:
+        stats['failed_encodings'] += 1
+        return {'status': 'error', 'job_id': job_id, 'field': 'job_id', 'message': str(e)}, 409
+    
+    stats['successful_encodings'] += 1
+    processing_time = time.time() - start_time
+    logger.info(f"Trim completed in {processing_time:.2f}s "
+                f"({result['copied_seconds']}s copied, {result['encoded_seconds']}s re-encoded)")
+    return {
+        'status': 'success',
+        'job_id': job_id,
+        'processing_time_seconds': round(processing_time, 2),
+        'pool': pool.name,
+        'queue_wait_ms': round(queue_wait * 1000, 1),
+        **result,
+        'output_size_mb': round(output_size / 1024 / 1024, 1),
+        'input_file': remote_input.origin_url(input_file),
+        'output_file': output_file,
+        'timestamp': datetime.now().isoformat()
+    }
+
+@app.route('/files/<path:filename>/index')
+def get_file_index(filename):
+    input_file = filename if filename.startswith('/') else f'/workspace/{filename}'
+    if not os.path.isfile(input_file):
+        return {'status': 'error', 'message': f'Input file not found: {input_file}'}, 404
+    try:
+        start = flask.request.args.get('start', type=float)
+        end = flask.request.args.get('end', type=float)
+        seek = flask.request.args.get('seek', type=float)
+        built = False
+        index = keyframe_index.lookup(input_file)
+        if index is None:
+            # The packet scan only demuxes, so it runs in the light pool
+            with pools.pools['light'].slot():
+                index = keyframe_index.get_index(input_file)
+            built = True
+    except keyframe_index.IndexBuildError as e:
+        return {'status': 'error', 'message': str(e)}, 422
+    
+    response = {'status': 'success', 'input_file': input_file, 'cached': not built, **index.to_dict(start, end)}
+    if seek is not None:
+        response['seek'] = index.seek_point(seek)
+    # The index only changes with the file, so its identity is the ETag
+    return http_cache.respond_json(response, etag_source=[media_probe.identity_key(input_file), start, end, seek],
+                                   last_modified=os.path.getmtime(input_file))
+
+@app.route('/files/<path:filename>/peaks')
+def get_file_peaks(filename):
+    if waveform.np is None:
+        return {'status': 'error', 'message': 'Waveform peaks need NumPy (pip install numpy)'}, 503
+    input_file = filename if filename.startswith('/') else f'/workspace/{filename}'
+    if not os.path.isfile(input_file):
+        return {'status': 'error', 'message': f'Input file not found: {input_file}'}, 404
+    args = flask.request.args
+    output_format = args.get('format', 'json')
+    if output_format not in ('json', 'dat'):
+        return {'status': 'error', 'message': 'format must be json or dat', 'field': 'format'}, 400
+    start = args.get('start', 0.0, type=float)
+    end = args.get('end', type=float)
+    try:
+        peaks = waveform.lookup(input_file)
+        built = peaks is None
+        if built:
+            # Decoding is CPU-only work, so it runs in the light pool
+            with pools.pools['light'].slot():
+                peaks = waveform.get_peaks(input_file)
+    except waveform.PeaksError as e:
+        return {'status': 'error', 'message': str(e)}, 422
+    except subprocess.TimeoutExpired as e:
+        return timeout_response(e, 'Waveform decode')
+    try:
+        samples_per_peak = peaks.choose_level(args.get('samples_per_peak', type=int),
+                                              args.get('width', 2000, type=int), start, end)
+    except waveform.PeaksError as e:
+        return {'status': 'error', 'message': str(e), 'field': 'samples_per_peak'}, 400
+
+    etag_source = [media_probe.identity_key(input_file), output_format, samples_per_peak, start, end]
+    last_modified = os.path.getmtime(input_file)
+    if output_format == 'dat':
+        return http_cache.respond_bytes(lambda: peaks.to_dat(samples_per_peak, start, end),
+                                        'application/octet-stream', etag_source, last_modified)
+    return http_cache.respond_json(lambda: {'status': 'success', 'input_file': input_file, 'cached': not built,
+                                            **peaks.to_dict(samples_per_peak, start, end)},
+                                   etag_source, last_modified)
+
+@app.route('/analyze', methods=['POST'])
+@admission.limited(lambda data: pools.pools['light'])
+def analyze_media():
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict) or 'input' not in data:
+        return {'status': 'error', 'message': 'Missing required field: input'}, 400
+    input_file, error = resolve_input(data['input'])
+    if error:
+        return error
+    
+    detectors = data.get('detectors') or list(analysis.DETECTORS)
+    if isinstance(detectors, str):
+        detectors = [d.strip() for d in detectors.split(',') if d.strip()]
+    start_time = time.time()
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        # Audio-only analysis never touches the GPU, so it shares the light pool
+        audio_only = all(d in analysis.AUDIO_DETECTORS for d in detectors)
+        pool = pools.for_job({'audio_only': audio_only})
+        with cancellable(job_id), pool.slot():
+            results, reused = analysis.analyze(input_file, detectors, data.get('params'), job_id=job_id,
+                                               timeout=pool.timeout)
+    except analysis.AnalysisError as e:
+        return {'status': 'error', 'message': str(e)}, 422
+    except subprocess.TimeoutExpired as e:
+        return timeout_response(e, 'Analysis', job_id=job_id)
+    except cancellation.Cancelled as e:
+        return cancelled_response(job_id, e)
+    except cancellation.DuplicateJob as e:
+        return {'status': 'error', 'job_id': job_id, 'field': 'job_id', 'message': str(e)}, 409
+    
+    return {
+        'status': 'success',
+        'input_file': remote_input.origin_url(input_file),
+        'results': results,
+        'cached': reused,
+        'processing_time_seconds': round(time.time() - start_time, 2),
+        'timestamp': datetime.now().isoformat()
+    }
+
+@app.route('/quality', methods=['POST'])
+@admission.limited(lambda data: pools.pools['light'])
+def quality_metrics():
+    data = flask.request.get_json(silent=True)
+    for field in ('source', 'output'):
+        if not isinstance(data, dict) or field not in data:
+            return {'status': 'error', 'message': f'Missing required field: {field}'}, 400
+    source, error = resolve_input(data['source'], 'source', exists=os.path.isfile)
+    if error:
+        return error
+    output, error = resolve_input(data['output'], 'output', exists=os.path.isfile)
+    if error:
+        return error
+    metrics = data.get('metrics') or [quality.default_metric()]
+    if isinstance(metrics, str):
+        metrics = [m.strip() for m in metrics.split(',') if m.strip()]
+    crop = data.get('crop')
+    if crop and not re.fullmatch(r'\d+:\d+:\d+:\d+', str(crop)):
+        return {'status': 'error', 'field': 'crop', 'message': 'crop must be "w:h:x:y"'}, 400
+    chunks = data.get('chunks')
+    if chunks is not None and (not isinstance(chunks, int) or chunks < 1):
+        return {'status': 'error', 'field': 'chunks', 'message': 'chunks must be a positive integer'}, 400
+    
+    start_time = time.time()
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        # Scoring is CPU work split over its own chunk processes; it holds one light slot
+        pool = pools.pools['light']
+        with cancellable(job_id), pool.slot():
+            results, reused = quality.score(source, output, metrics, crop=crop, chunks=chunks,
+                                            job_id=job_id, timeout=pool.timeout)
+    except quality.QualityError as e:
+        return {'status': 'error', 'message': str(e)}, 422
+    except subprocess.TimeoutExpired as e:
+        return timeout_response(e, 'Quality scoring', job_id=job_id)
+    except cancellation.Cancelled as e:
+        return cancelled_response(job_id, e)
+    except cancellation.DuplicateJob as e:
+        return {'status': 'error', 'job_id': job_id, 'field': 'job_id', 'message': str(e)}, 409
+    
+    if not data.get('per_frame', True):
+        results = {m: {k: v for k, v in r.items() if k != 'per_frame'} for m, r in results.items()}
+    return http_cache.respond_json({
+        'status': 'success',
+        'source': remote_input.origin_url(source),
+        'output': remote_input.origin_url(output),
+        'metrics': results,
+        'cached': reused,
+        'processing_time_seconds': round(time.time() - start_time, 2),
+    })
+
+# NVDEC decodes count against the GPU; CPU decodes are light work
+def frames_pool(data=None):
+    return pools.pools['gpu' if frames.use_hwaccel() else 'light']
+
+@app.route('/frames', methods=['POST'])
+@admission.limited(frames_pool)
+def extract_frames():
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict) or 'input' not in data:
+        return {'status': 'error', 'message': 'Missing required field: input'}, 400
+    input_file, error = resolve_input(data['input'], exists=os.path.isfile)
+    if error:
+        return error
+    try:
+        opts = frames.options(data)
+    except frames.FrameRequestError as e:
+        return {'status': 'error', 'field': e.field, 'message': str(e)}, 400
+    if media_probe.video_stream(input_file) is None:
+        return {'status': 'error', 'message': 'Input has no video stream'}, 422
+    
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    try:
+        token = cancellation.registry.open(job_id)
+    except cancellation.DuplicateJob as e:
+        return {'status': 'error', 'job_id': job_id, 'field': 'job_id', 'message': str(e)}, 409
+    pool = frames_pool()
+    pool.acquire()
+    try:
+        reader = frames.FrameReader(input_file, opts, job_id=job_id)
+        # Half-read frames are of no use, so a cancel kills the decode outright
+        token.attach(reader.process, grace=0)
+        height, width, channels = reader.start()
+    except frames.FrameError as e:
+        pool.release()
+        cancellation.registry.close(token)
+        return {'status': 'error', 'message': str(e)}, 422
+    except Exception:
+        pool.release()
+        cancellation.registry.close(token)
+        raise
+    
+    def generate():
+        start_time = time.time()
+        yield frames.stream_header(reader)
+        try:
+            for count, times, buffer in reader.raw_batches():
+                yield frames.batch_header(count, times)
+                # WSGI servers only take bytes, so this is the one copy on the HTTP path
+                yield bytes(memoryview(buffer)[:count * reader.frame_bytes])
+        except frames.FrameError as e:
+            # Headers are already sent; a short stream is how the client learns of the failure
+            logger.error(f"Frame extraction failed after {reader.frames_read} frames: {e}")
+            return
+        elapsed = time.time() - start_time
+        logger.info(f"Extracted {reader.frames_read} {width}x{height} frames in {elapsed:.2f}s "
+                    f"({reader.frames_read / max(elapsed, 1e-6):.1f} fps)")
+    
+    def close():
+        # Runs even if the client disconnects mid-stream
+        reader.close()
+        cancellation.registry.close(token)
+        pool.release()
+    
+    # Not direct_passthrough: werkzeug then skips the close callbacks that release the slot
+    response = flask.Response(generate(), mimetype='application/octet-stream',
+                              headers={'X-Job-Id': job_id, 'X-Frame-Width': str(width), 'X-Frame-Height': str(height),
+                                       'X-Frame-Channels': str(channels), 'X-Pixel-Format': opts['pix_fmt']})
+    response.call_on_close(close)
+    return response
+
 @app.errorhandler(404)
 def not_found(error):
-    return {'error': 'Endpoint not found', 'available_endpoints': ['/', '/health', '/files', '/info', '/stats', '/encode']}, 404
+    return {'error': 'Endpoint not found', 'available_endpoints': ['/', '/health', '/files', '/info', '/stats', '/encode', '/encode/stream', '/jobs', '/trim', '/analyze', '/quality', '/frames', '/files/<name>', '/files/<name>/index', '/files/<name>/peaks', '/jobs/<id>/progress', '/jobs/<id>/cancel']}, 404
 
 @app.errorhandler(500)
 def internal_error(error):
     return {'error': 'Internal server error', 'message': str(error)}, 500
 
+def run_watch_job(data):
+    # Watch-folder files go to the cluster queue when there is one, otherwise straight into the local pools
+    if job_backend is not None:
+        job_backend.enqueue(data)
+        return True
+    response = run_encode(data)
+    if isinstance(response, tuple):
+        response = response[0]
+    if response.get('status') != 'success':
+        logger.error(f"Watch folder encode of {data['input']} failed: {response.get('message') or response.get('ffmpeg_stderr', '')[-500:]}")
+    return response.get('status') == 'success'
+
+def start_background_services():
+    # Called once per process after forking (see gunicorn.conf.py post_fork)
+    global queue_worker, folder_watcher
+    # Loads (or, if the ffmpeg binary changed, rebuilds) the capability snapshot off the request path
+    threading.Thread(target=capabilities.snapshot, name='capabilities-load', daemon=True).start()
+    threading.Thread(target=filter_catalog.catalog.warm, name='filter-catalog-warm', daemon=True).start()
+    if pools.ADAPTIVE:
+        threading.Thread(target=pools.adapt_loop, name='pool-adapt', daemon=True).start()
+    if workspace_quota.QUOTA_BYTES or workspace_quota.OUTPUT_MAX_AGE:
+        threading.Thread(target=workspace_quota.eviction_loop, name='workspace-eviction', daemon=True).start()
+    if job_queue.WORKER_MODE and job_backend is not None and queue_worker is None:
+        queue_worker = job_queue.QueueWorker(job_backend, run_encode, local_stats)
+        queue_worker.start()
+    if watch_folder.WATCH_CONFIG and folder_watcher is None:
+        try:
+            folder_watcher = watch_folder.FolderWatcher(watch_folder.load_config(), run_watch_job)
+            folder_watcher.start()
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Watch folders not started: {e}")
+            folder_watcher = None
+
 if __name__ == '__main__':
+    start_background_services()
     app.run(host='0.0.0.0', port=5000, debug=False)
 
@@ -0,0 +1,259 @@
+# Run ffmpeg while parsing its -progress output into a per-job timeline
+# The timeline records spawn latency, time to first frame, periodic
+# fps/speed/bitrate samples and the child's final CPU time and peak RSS.
+
+import collections
+import itertools
+import json
+import os
+import subprocess
+import threading
+import time
+import logging
+
+import cancellation
+import stall_watchdog
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_DIR = os.environ.get('FFMPEG_API_TIMELINE_DIR', '/tmp/ffmpeg_api_timelines')
+TIMELINE_KEEP = int(os.environ.get('FFMPEG_API_TIMELINE_KEEP', '1000'))
+PROGRESS_PERIOD = os.environ.get('FFMPEG_API_PROGRESS_PERIOD', '0.5')
+MAX_SAMPLES = 2000
+# A stalled ffmpeg is stuck where it does not read "q"; SIGKILL follows SIGTERM after this
+STOP_GRACE_SECONDS = 2
+
+_saves = 0
+_run_ids = itertools.count()
+
+# Callables observer(run_id, sample) told about every progress sample, and once
+# with sample=None when the run ends; called from the thread running ffmpeg
+progress_observers = []
+
+# Latest progress sample of every running ffmpeg process, by job id, for live progress streams
+live_progress = {}
+
+
+class RunResult:
+    def __init__(self, returncode, stdout, stderr, timeline):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timeline = timeline
+
+
+def _parse_number(value):
+    value = value.strip().rstrip('x')
+    if value.endswith('kbits/s'):
+        value = value[:-len('kbits/s')]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def with_progress(cmd, target='pipe:1'):
+    # ffmpeg writes key=value progress blocks to target (stdout) instead of the stats line on stderr
+    return [cmd[0], '-progress', target, '-stats_period', PROGRESS_PERIOD, '-nostats', *cmd[1:]]
+
+
+def progress_sample(block, elapsed):
+    """Sample from one key=value block of -progress output, elapsed seconds into the run."""
+    return {
+        't': round(elapsed, 3),
+        'frame': int(_parse_number(block.get('frame', '0')) or 0),
+        'fps': _parse_number(block.get('fps', '')),
+        'speed': _parse_number(block.get('speed', '')),
+        'bitrate_kbps': _parse_number(block.get('bitrate', '')),
+        'out_time_s': round(int(block['out_time_us']) / 1e6, 3) if block.get('out_time_us', 'N/A').isdigit() else None,
+        'total_size': int(block['total_size']) if block.get('total_size', 'N/A').isdigit() else None,
+    }
+
+
+def run_ffmpeg(cmd, job_id, timeout=3600, on_progress=None, on_stderr=None, duration=None):
+    """Run an ffmpeg command to completion under the stall watchdog.
+
+    The run is stopped, raising stall_watchdog.Stopped (a subprocess.TimeoutExpired),
+    when its progress stalls or it passes a deadline scaled to the input duration
+    (taken from duration, else from ffmpeg's own report of its inputs); timeout is
+    the deadline when no duration is known.
+    on_progress(sample) is called for every progress block and on_stderr(line)
+    for every stderr line; only the last 500 stderr lines are kept in the result.
+    Raises cancellation.Cancelled if the job running in this context is cancelled.
+    """
+    token = cancellation.current()
+    if token:
+        token.check()
+    timeline = {
+        'job_id': job_id,
+        'command': ' '.join(cmd),
+        'started_at': time.time(),
+        'spawn_ms': None,
+        'first_frame_ms': None,
+        'samples': [],
+    }
+    run_id = next(_run_ids)
+    t0 = time.monotonic()
+    process = subprocess.Popen(with_progress(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               **cancellation.popen_kwargs())
+    timeline['spawn_ms'] = round((time.monotonic() - t0) * 1000, 2)
+    if token:
+        token.attach(process)
+
+    def _stop():
+        threading.Thread(target=cancellation.terminate, args=(process, STOP_GRACE_SECONDS, False),
+                         name=f'stop-{job_id}', daemon=True).start()
+
+    watch = stall_watchdog.monitor.watch(job_id, _stop, timeout, duration)
+    stderr_lines = collections.deque(maxlen=500)
+
+    def _drain_stderr():
+        for line in process.stderr:
+            stderr_lines.append(line)
+            if duration is None:
+                watch.saw_duration(stall_watchdog.parse_duration(line))
+            if on_stderr:
+                on_stderr(line)
+
+    stderr_thread = threading.Thread(target=_drain_stderr, daemon=True)
+    stderr_thread.start()
+
+    block = {}
+    try:
+        for line in process.stdout:
+            key, sep, value = line.strip().partition('=')
+            if not sep:
+                continue
+            block[key] = value
+            if key != 'progress':
+                continue
+            elapsed = time.monotonic() - t0
+            sample = progress_sample(block, elapsed)
+            if timeline['first_frame_ms'] is None and (sample['frame'] > 0 or (sample['out_time_s'] or 0) > 0):
+                timeline['first_frame_ms'] = round(elapsed * 1000, 2)
+            watch.progress(sample)
+            if len(timeline['samples']) < MAX_SAMPLES:
+                timeline['samples'].append(sample)
+            if on_progress:
+                on_progress(sample)
+            for observer in progress_observers:
+                observer(run_id, sample)
+            live_progress[job_id] = sample
+            block = {}
+        # wait4 gives us the child's own resource usage
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        stall_watchdog.monitor.unwatch(watch)
+        for observer in progress_observers:
+            observer(run_id, None)
+        live_progress.pop(job_id, None)
+        if token:
+            token.detach(process)
+        if process.returncode is None:
+            process.kill()
+            process.wait()
+        process.stdin.close()
+    stderr_thread.join(timeout=5)
+
+    wall = time.monotonic() - t0
+    cpu = rusage.ru_utime + rusage.ru_stime
+    timeline.update({
+        'wall_seconds': round(wall, 3),
+        'cpu_user_seconds': round(rusage.ru_utime, 3),
+        'cpu_system_seconds': round(rusage.ru_stime, 3),
+        'cpu_utilization': round(cpu / wall, 2) if wall > 0 else None,
+        'max_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'returncode': process.returncode,
+        'deadline_seconds': round(watch.deadline, 1),
+    })
+    if token and token.cancelled:
+        timeline['cancelled'] = token.reason
+    if watch.reason:
+        timeline['stopped'] = watch.reason
+    timeline['summary'] = summarize(timeline)
+    save_timeline(timeline)
+
+    if token:
+        # "q" ends ffmpeg with status 0 and a truncated output, so the exit code alone cannot tell
+        token.check()
+
+    if watch.reason:
+        raise stall_watchdog.Stopped(cmd, watch, ''.join(stderr_lines))
+    return RunResult(process.returncode, '', ''.join(stderr_lines), timeline)
+
+
+def current_progress(job_id):
+    """(run id, latest sample) of a job's running ffmpeg, including its sub-runs ("<job>-pass1"), or None."""
+    if job_id in live_progress:
+        return job_id, live_progress.get(job_id)
+    for run, sample in list(live_progress.items()):
+        if run.startswith(f'{job_id}-'):
+            return run, sample
+    return None
+
+
+def summarize(timeline):
+    samples = [s for s in timeline['samples'] if s['frame'] or s['out_time_s']]
+    fps = [s['fps'] for s in samples if s['fps']]
+    speed = [s['speed'] for s in samples if s['speed']]
+    wall = timeline.get('wall_seconds') or 0
+    first_frame_s = (timeline['first_frame_ms'] or 0) / 1000
+    summary = {
+        'spawn_ms': timeline['spawn_ms'],
+        'first_frame_ms': timeline['first_frame_ms'],
+        'avg_fps': round(sum(fps) / len(fps), 1) if fps else None,
+        'avg_speed': round(sum(speed) / len(speed), 2) if speed else None,
+        'final_bitrate_kbps': samples[-1]['bitrate_kbps'] if samples else None,
+        'cpu_seconds': round(timeline.get('cpu_user_seconds', 0) + timeline.get('cpu_system_seconds', 0), 2),
+        'cpu_utilization': timeline.get('cpu_utilization'),
+        'max_rss_mb': timeline.get('max_rss_mb'),
+        'samples': len(timeline['samples']),
+    }
+    # Rough hint of where the time went; a starting point for tuning, not a verdict
+    if wall and first_frame_s / wall > 0.5:
+        summary['hint'] = 'startup'
+    elif timeline.get('cpu_utilization') is not None and timeline['cpu_utilization'] >= 0.9 * (os.cpu_count() or 1):
+        summary['hint'] = 'cpu_bound'
+    elif timeline.get('cpu_utilization') is not None and timeline['cpu_utilization'] < 0.5:
+        summary['hint'] = 'io_or_gpu_bound'
+    else:
+        summary['hint'] = 'mixed'
+    return summary
+
+
+def save_timeline(timeline):
+    # Stored on disk so any gunicorn worker can serve it
+    global _saves
+    try:
+        os.makedirs(TIMELINE_DIR, exist_ok=True)
+        path = os.path.join(TIMELINE_DIR, f"{timeline['job_id']}.json")
+        with open(path + '.tmp', 'w') as f:
+            json.dump(timeline, f)
+        os.replace(path + '.tmp', path)
+        _saves += 1
+        if _saves % 100 == 0:
+            prune_timelines()
+    except OSError as e:
+        logger.warning(f"Could not save timeline for {timeline['job_id']}: {e}")
+
+
+def prune_timelines():
+    entries = sorted(
+        (e for e in os.scandir(TIMELINE_DIR) if e.name.endswith('.json')),
+        key=lambda e: e.stat().st_mtime)
+    for entry in entries[:-TIMELINE_KEEP]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def load_timeline(job_id):
+    if os.path.basename(job_id) != job_id:
+        return None
+    try:
+        with open(os.path.join(TIMELINE_DIR, f'{job_id}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,287 @@
+# Pre-flight validation of encode parameters
+# Filter, encoder and pixel-format names are read once from the ffmpeg binary
+# and cached on disk, so a typo is rejected before any process is spawned.
+
+import difflib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CACHE = os.environ.get('FFMPEG_API_CATALOG_CACHE', '/tmp/ffmpeg_catalog.json')
+CATALOG_VERSION = 2
+
+# Options every filter accepts in addition to its own AVOptions
+GENERIC_FILTER_OPTIONS = {'enable'}
+
+# Filters whose option values are pixel format names
+PIX_FMT_OPTIONS = {
+    'format': 'pix_fmts',
+    'noformat': 'pix_fmts',
+    'scale_cuda': 'format',
+    'scale_npp': 'format',
+    'hwupload_cuda': 'format',
+}
+
+_FILTER_LINE = re.compile(r'^ [T.][S.][C.] (\S+)\s+(\S+->\S+)')
+_CODER_LINE = re.compile(r'^ ([VAS])[F.][S.][X.][B.][D.] (\S+).*?(?:\(codec (\S+)\))?$')
+_PIX_FMT_LINE = re.compile(r'^[I.][O.][H.][P.][B.] (\S+)')
+_OPTION_LINE = re.compile(r'^   (\S+)\s+<')
+
+
+class FilterGraphError(ValueError):
+    pass
+
+
+class Catalog:
+    def __init__(self, ffmpeg='ffmpeg'):
+        self.ffmpeg = ffmpeg
+        self.filters = {}
+        self.encoders = {}
+        self.codecs = {}
+        self.pix_fmts = set()
+        self.filter_options = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def _binary_key(self):
+        path = shutil.which(self.ffmpeg)
+        if not path:
+            return None
+        st = os.stat(os.path.realpath(path))
+        return f'{os.path.realpath(path)}:{st.st_size}:{int(st.st_mtime)}'
+
+    def _run(self, *args):
+        result = subprocess.run([self.ffmpeg, '-hide_banner', *args], capture_output=True, text=True, timeout=30)
+        return result.stdout
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return True
+            key = self._binary_key()
+            if key is None:
+                logger.warning("ffmpeg not found; pre-flight validation disabled")
+                return False
+            if self._load_cache(key):
+                self.loaded = True
+                return True
+            for line in self._run('-filters').splitlines():
+                m = _FILTER_LINE.match(line)
+                if m:
+                    self.filters[m.group(1)] = m.group(2)
+            for line in self._run('-encoders').splitlines():
+                m = _CODER_LINE.match(line)
+                if m:
+                    self.encoders[m.group(2)] = m.group(1)
+                    # "-c:a mp3" picks the default encoder for the mp3 codec
+                    self.codecs[m.group(3) or m.group(2)] = m.group(1)
+            for line in self._run('-pix_fmts').splitlines():
+                m = _PIX_FMT_LINE.match(line)
+                if m:
+                    self.pix_fmts.add(m.group(1))
+            self.key = key
+            self.loaded = True
+            self._dirty = True
+        self.save()
+        return True
+
+    def _load_cache(self, key):
+        try:
+            with open(CATALOG_CACHE) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cached.get('version') != CATALOG_VERSION or cached.get('binary') != key:
+            return False
+        self.key = key
+        self.filters = cached['filters']
+        self.encoders = cached['encoders']
+        self.codecs = cached['codecs']
+        self.pix_fmts = set(cached['pix_fmts'])
+        self.filter_options = {k: set(v) for k, v in cached.get('filter_options', {}).items()}
+        return True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                'version': CATALOG_VERSION,
+                'binary': self.key,
+                'filters': self.filters,
+                'encoders': self.encoders,
+                'codecs': self.codecs,
+                'pix_fmts': sorted(self.pix_fmts),
+                'filter_options': {k: sorted(v) for k, v in self.filter_options.items()},
+            }
+            self._dirty = False
+        try:
+            tmp = f'{CATALOG_CACHE}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, CATALOG_CACHE)
+        except OSError as e:
+            logger.warning(f"Could not write catalog cache {CATALOG_CACHE}: {e}")
+
+    def options_for(self, filter_name):
+        options = self.filter_options.get(filter_name)
+        if options is None:
+            options = set(GENERIC_FILTER_OPTIONS)
+            for line in self._run('-h', f'filter={filter_name}').splitlines():
+                m = _OPTION_LINE.match(line)
+                if m:
+                    options.add(m.group(1))
+            with self._lock:
+                self.filter_options[filter_name] = options
+                self._dirty = True
+        return options
+
+    def warm(self):
+        # Fetch option lists for every filter so later lookups never spawn ffmpeg
+        if not self.load():
+            return
+        for name in list(self.filters):
+            if name not in self.filter_options:
+                try:
+                    self.options_for(name)
+                except Exception as e:
+                    logger.warning(f"Could not read options for filter {name}: {e}")
+        self.save()
+        logger.info(f"Filter catalog warmed: {len(self.filters)} filters, {len(self.encoders)} encoders")
+
+
+def _split(text, separators):
+    # Split on any separator outside quotes and brackets, honouring backslash escapes
+    parts, current, quote, depth = [], [], False, 0
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch == '\\' and i + 1 < len(text):
+            current.append(text[i:i + 2])
+            i += 2
+            continue
+        if ch == "'":
+            quote = not quote
+        elif not quote and ch == '[':
+            depth += 1
+        elif not quote and ch == ']':
+            depth -= 1
+        elif not quote and depth == 0 and ch in separators:
+            parts.append(''.join(current))
+            current = []
+            i += 1
+            continue
+        current.append(ch)
+        i += 1
+    if quote:
+        raise FilterGraphError(f'Unterminated quote in "{text}"')
+    parts.append(''.join(current))
+    return parts
+
+
+_LABELS = re.compile(r'^\s*((?:\[[^\]]*\]\s*)*)(.*?)((?:\s*\[[^\]]*\])*)\s*$', re.S)
+
+
+def parse_filtergraph(graph):
+    """Return [(filter_name, [(key or None, value), ...]), ...] for a filtergraph string."""
+    filters = []
+    for chain in _split(graph, ';'):
+        for spec in _split(chain, ','):
+            if not spec.strip():
+                raise FilterGraphError('Empty filter in filtergraph')
+            body = _LABELS.match(spec).group(2)
+            name, _, args = body.partition('=')
+            name = name.strip().split('@', 1)[0]
+            if not name:
+                raise FilterGraphError(f'Missing filter name in "{spec.strip()}"')
+            options = []
+            if args:
+                for arg in _split(args, ':'):
+                    key, sep, value = arg.partition('=')
+                    if sep and re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', key):
+                        options.append((key, value))
+                    else:
+                        options.append((None, arg))
+            filters.append((name, options))
+    return filters
+
+
+def _suggest(name, choices):
+    return difflib.get_close_matches(name, choices, n=3, cutoff=0.6)
+
+
+def _error(field, message, suggestions=None):
+    error = {'field': field, 'message': message}
+    if suggestions:
+        error['suggestions'] = suggestions
+    return error
+
+
+def check_filtergraph(catalog, field, graph):
+    try:
+        parsed = parse_filtergraph(graph)
+    except FilterGraphError as e:
+        return _error(field, str(e))
+    for name, options in parsed:
+        if name not in catalog.filters:
+            return _error(field, f"Unknown filter '{name}' in {field}", _suggest(name, catalog.filters))
+        known = catalog.options_for(name)
+        for key, value in options:
+            if key is not None and known and key not in known:
+                return _error(field, f"Unknown option '{key}' for filter '{name}' in {field}",
+                              _suggest(key, known))
+        pix_option = PIX_FMT_OPTIONS.get(name)
+        if pix_option:
+            for key, value in options:
+                if key == pix_option or (key is None and name in ('format', 'noformat')):
+                    for fmt in value.strip("'").split('|'):
+                        if fmt and fmt not in catalog.pix_fmts:
+                            return _error(field, f"Unknown pixel format '{fmt}' for filter '{name}' in {field}",
+                                          _suggest(fmt, catalog.pix_fmts))
+    return None
+
+
+def check_encoder(catalog, field, name, kind):
+    if name == 'copy':
+        return None
+    found = catalog.encoders.get(name) or catalog.codecs.get(name)
+    if found is None:
+        choices = [n for n, k in catalog.encoders.items() if k == kind]
+        return _error(field, f"Unknown encoder '{name}' in {field}", _suggest(name, choices))
+    if found != kind:
+        wanted = {'V': 'video', 'A': 'audio', 'S': 'subtitle'}[kind]
+        return _error(field, f"Encoder '{name}' in {field} is not a {wanted} encoder")
+    return None
+
+
+def validate_encode(catalog, data):
+    """Check the filter and codec fields of an /encode body; returns an error dict or None."""
+    if not catalog.load():
+        return None
+    for field in ('video_filter', 'audio_filter', 'complex_filter'):
+        value = data.get(field)
+        if value:
+            if not isinstance(value, str):
+                return _error(field, f'{field} must be a string')
+            error = check_filtergraph(catalog, field, value)
+            if error:
+                return error
+    if not data.get('audio_only', False):
+        error = check_encoder(catalog, 'video_codec', data.get('video_codec', 'h264_nvenc'), 'V')
+        if error:
+            return error
+    if not data.get('video_only', False):
+        error = check_encoder(catalog, 'audio_codec', data.get('audio_codec', 'aac'), 'A')
+        if error:
+            return error
+    return None
+
+
+catalog = Catalog()
@@ -0,0 +1,295 @@
+# Decoded frames for ML pipelines
+# ffmpeg decodes (with NVDEC when the build has it), samples and resizes in the
+# filtergraph and writes -f rawvideo to a pipe. The pipe is read with readinto
+# straight into one buffer per batch of frames, and batches are handed out as
+# NumPy arrays (or memoryviews) over that buffer, so frames are never copied
+# per frame and no image codec is involved. Presentation times come from a
+# showinfo filter on ffmpeg's stderr.
+#
+# Wire format of POST /frames (all little-endian):
+#   stream header  '<4sIII'  b'RAWF', width, height, channels (uint8 samples)
+#   per batch      '<4sI'    b'BTCH', frame count n
+#                  n float64 presentation times in seconds (NaN if unknown)
+#                  n * height * width * channels frame bytes
+
+import collections
+import os
+import re
+import struct
+import subprocess
+import threading
+import time
+import logging
+
+try:
+    import numpy as np
+except ImportError:  # optional; batches are memoryviews without it
+    np = None
+
+import capabilities
+import media_probe
+import stall_watchdog
+
+logger = logging.getLogger(__name__)
+
+# Pixel format -> channels per pixel (all 8-bit, packed)
+PIXEL_FORMATS = {'rgb24': 3, 'bgr24': 3, 'rgba': 4, 'bgra': 4, 'gray': 1}
+BATCH_SIZE = int(os.environ.get('FFMPEG_API_FRAMES_BATCH', '32'))
+MAX_BATCH_BYTES = int(os.environ.get('FFMPEG_API_FRAMES_MAX_BATCH_MB', '256')) * 1024 * 1024
+MAX_DIMENSION = 8192
+MAX_TIMESTAMPS = 1000
+SCALE_FLAGS = os.environ.get('FFMPEG_API_FRAMES_SCALE_FLAGS', 'bilinear')
+# Decode on the GPU when ffmpeg lists the cuda hwaccel (set to 0 to always decode on the CPU)
+HWACCEL = os.environ.get('FFMPEG_API_FRAMES_HWACCEL', '1') == '1'
+# Deadline when the input duration is unknown (the stall watchdog scales it otherwise)
+DECODE_TIMEOUT = int(os.environ.get('FFMPEG_API_FRAMES_TIMEOUT', '3600'))
+START_TIMEOUT = 30
+
+STREAM_HEADER = struct.Struct('<4sIII')
+BATCH_HEADER = struct.Struct('<4sI')
+
+Batch = collections.namedtuple('Batch', 'frames times')
+
+_OUTPUT_SIZE = re.compile(r'Video: rawvideo.*?, (\d+)x(\d+)')
+_PTS_TIME = re.compile(r'Parsed_showinfo.* n: *\d+ .*pts_time:(\S+)')
+
+
+class FrameRequestError(ValueError):
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+
+
+class FrameError(Exception):
+    pass
+
+
+def use_hwaccel():
+    return HWACCEL and 'cuda' in capabilities.snapshot().get('hardware_accelerators', [])
+
+
+def _number(data, field, cast=float, minimum=0.0, maximum=None):
+    value = data.get(field)
+    if value is None:
+        return None
+    try:
+        value = cast(value)
+    except (TypeError, ValueError):
+        raise FrameRequestError(field, f'{field} must be a number')
+    if value < minimum or (maximum is not None and value > maximum):
+        raise FrameRequestError(field, f'{field} must be between {minimum} and {maximum}' if maximum is not None
+                                else f'{field} must be at least {minimum}')
+    return value
+
+
+def options(data):
+    """Validated extraction options from a request body."""
+    pix_fmt = data.get('pix_fmt', 'rgb24')
+    if pix_fmt not in PIXEL_FORMATS:
+        raise FrameRequestError('pix_fmt', f"pix_fmt must be one of {', '.join(PIXEL_FORMATS)}")
+    opts = {
+        'pix_fmt': pix_fmt,
+        'width': _number(data, 'width', int, 1, MAX_DIMENSION),
+        'height': _number(data, 'height', int, 1, MAX_DIMENSION),
+        'fps': _number(data, 'fps', float, 0.001, 1000),
+        'keyframes_only': bool(data.get('keyframes_only', False)),
+        'timestamps': None,
+        'start': _number(data, 'start'),
+        'duration': _number(data, 'duration', float, 0.001),
+        'max_frames': _number(data, 'max_frames', int, 1),
+        'batch_size': _number(data, 'batch_size', int, 1, 4096) or BATCH_SIZE,
+    }
+    timestamps = data.get('timestamps')
+    if timestamps is not None:
+        if not isinstance(timestamps, list) or not timestamps or len(timestamps) > MAX_TIMESTAMPS:
+            raise FrameRequestError('timestamps', f'timestamps must be a list of 1 to {MAX_TIMESTAMPS} times (s)')
+        try:
+            opts['timestamps'] = sorted({float(t) for t in timestamps})
+        except (TypeError, ValueError):
+            raise FrameRequestError('timestamps', 'timestamps must be numbers (seconds)')
+        if opts['timestamps'][0] < 0:
+            raise FrameRequestError('timestamps', 'timestamps must not be negative')
+    if sum(bool(x) for x in (opts['fps'], opts['keyframes_only'], opts['timestamps'])) > 1:
+        raise FrameRequestError('fps', 'Use only one of fps, keyframes_only and timestamps')
+    if opts['timestamps'] and (opts['start'] is not None or opts['duration'] is not None):
+        raise FrameRequestError('timestamps', 'timestamps cannot be combined with start or duration')
+    return opts
+
+
+def command(input_file, opts, hwaccel=False):
+    """(ffmpeg command, seconds to add to output times to get input times)."""
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-v', 'info']
+    if hwaccel:
+        # Without -hwaccel_output_format frames come back to system memory for the CPU filters
+        cmd += ['-hwaccel', 'cuda']
+    if opts['keyframes_only']:
+        cmd += ['-skip_frame', 'nokey']
+    timestamps = opts['timestamps']
+    offset = timestamps[0] if timestamps else (opts['start'] or 0.0)
+    if offset:
+        cmd += ['-ss', f'{offset:.6f}']
+    if opts['duration']:
+        cmd += ['-t', f"{opts['duration']:.6f}"]
+    cmd += ['-i', input_file, '-map', '0:v:0', '-an', '-sn', '-dn']
+
+    filters = []
+    if opts['fps']:
+        filters.append(f"fps={opts['fps']}")
+    if timestamps:
+        # The first frame at or after each time; times closer than one frame apart yield one frame
+        terms = '+'.join(f'gte(t,{t - offset:.6f})*(isnan(prev_selected_t)+lt(prev_selected_t,{t - offset:.6f}))'
+                         for t in timestamps)
+        filters.append(f"select='{terms}'")
+    if opts['width'] or opts['height']:
+        filters.append(f"scale={opts['width'] or -1}:{opts['height'] or -1}:flags={SCALE_FLAGS}")
+    filters += [f"format={opts['pix_fmt']}", 'showinfo=checksum=0']
+    cmd += ['-vf', ','.join(filters), '-fps_mode', 'passthrough']
+    if opts['max_frames']:
+        cmd += ['-frames:v', str(opts['max_frames'])]
+    return cmd + ['-f', 'rawvideo', '-pix_fmt', opts['pix_fmt'], 'pipe:1'], offset
+
+
+def _read_full(stream, view):
+    # Pipe reads return whatever is buffered; keep reading until the batch is full or the stream ends
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+class FrameReader:
+    """One ffmpeg decode of input_file, read as fixed-shape batches of raw frames."""
+
+    def __init__(self, input_file, opts, hwaccel=None, job_id='frames'):
+        self.opts = opts
+        self.channels = PIXEL_FORMATS[opts['pix_fmt']]
+        self.width = self.height = None
+        self.frames_read = 0
+        self._times = []
+        self._stderr_tail = collections.deque(maxlen=30)
+        self._cond = threading.Condition()
+        self._stderr_done = False
+        self.cmd, self._offset = command(input_file, opts, use_hwaccel() if hwaccel is None else hwaccel)
+        logger.info(f"Starting frame extraction: {' '.join(self.cmd)}")
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, start_new_session=True)
+        duration = media_probe.duration(input_file)
+        if duration and opts['duration']:
+            duration = min(duration, opts['duration'])
+        # A client that stops reading blocks the pipe and so stalls the decode too, which frees its slot
+        self._watch = stall_watchdog.monitor.watch(job_id, self.process.kill, DECODE_TIMEOUT, duration)
+        self._decoded = 0
+        threading.Thread(target=self._read_stderr, name='frames-stderr', daemon=True).start()
+
+    def _read_stderr(self):
+        for raw in self.process.stderr:
+            line = raw.decode(errors='replace')
+            m = _PTS_TIME.search(line)
+            with self._cond:
+                if m:
+                    self._decoded += 1
+                    self._watch.progress({'out_time_s': None, 'frame': self._decoded})
+                    try:
+                        self._times.append(float(m.group(1)) + self._offset)
+                    except ValueError:
+                        self._times.append(float('nan'))
+                elif self.width is None and (size := _OUTPUT_SIZE.search(line)):
+                    self.width, self.height = int(size.group(1)), int(size.group(2))
+                else:
+                    self._stderr_tail.append(line.rstrip())
+                self._cond.notify_all()
+        with self._cond:
+            self._stderr_done = True
+            self._cond.notify_all()
+
+    def stderr_tail(self):
+        with self._cond:
+            return '\n'.join(self._stderr_tail)[-2000:]
+
+    def start(self):
+        """Wait for the output frame size; raises FrameError if ffmpeg fails before producing frames."""
+        deadline = time.monotonic() + START_TIMEOUT
+        with self._cond:
+            while self.width is None and not self._stderr_done and time.monotonic() < deadline:
+                self._cond.wait(0.5)
+        if self.width is None:
+            self.close()
+            raise FrameError(f'Frame extraction did not start: {self.stderr_tail()}')
+        return self.height, self.width, self.channels
+
+    @property
+    def frame_bytes(self):
+        return self.width * self.height * self.channels
+
+    def _batch_times(self, count):
+        # showinfo reports each frame before it reaches the pipe, but stderr is read on another thread
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._times) >= count or self._stderr_done, timeout=5)
+            times = self._times[:count]
+            del self._times[:count]
+        return times + [float('nan')] * (count - len(times))
+
+    def raw_batches(self):
+        """Yield (frame count, times, buffer) with count * frame_bytes bytes of frames at the start of buffer."""
+        self.start()
+        batch = max(min(self.opts['batch_size'], MAX_BATCH_BYTES // self.frame_bytes), 1)
+        try:
+            while True:
+                # A fresh buffer per batch: arrays handed out earlier stay valid
+                buffer = bytearray(batch * self.frame_bytes)
+                filled = _read_full(self.process.stdout, memoryview(buffer))
+                count = filled // self.frame_bytes
+                if count:
+                    times = self._batch_times(count)
+                    self.frames_read += count
+                    yield count, times, buffer
+                if filled < len(buffer):
+                    break
+            self.process.wait()
+            if self._watch.reason:
+                raise FrameError(f'Frame extraction stopped by the watchdog ({self._watch.reason}) '
+                                 f'after {self._watch.limit:.0f}s')
+            if self.process.returncode != 0:
+                raise FrameError(f'ffmpeg exited with {self.process.returncode}: {self.stderr_tail()}')
+        finally:
+            self.close()
+
+    def batches(self):
+        """Yield Batch(frames, times); frames is an (n, height, width, channels) uint8 array over the buffer."""
+        for count, times, buffer in self.raw_batches():
+            shape = (count, self.height, self.width, self.channels)
+            if np is not None:
+                frames = np.frombuffer(buffer, dtype=np.uint8, count=count * self.frame_bytes).reshape(shape)
+            else:
+                frames = memoryview(buffer)[:count * self.frame_bytes].cast('B', shape)
+            yield Batch(frames, times)
+
+    def close(self):
+        stall_watchdog.monitor.unwatch(self._watch)
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_frames(input_file, **kwargs):
+    """Yield Batch(frames, times) for input_file; keyword arguments as in the POST /frames body."""
+    with FrameReader(input_file, options(kwargs)) as reader:
+        yield from reader.batches()
+
+
+def stream_header(reader):
+    return STREAM_HEADER.pack(b'RAWF', reader.width, reader.height, reader.channels)
+
+
+def batch_header(count, times):
+    return BATCH_HEADER.pack(b'BTCH', count) + struct.pack(f'<{count}d', *times)
@@ -9,15 +9,18 @@ bind = "0.0.0.0:5000"
 backlog = 2048
 
 # Worker processes
-workers = 2
-worker_class = "sync"
+# One process with many threads: encode concurrency is limited by the
+# GPU and light job pools in pools.py, not by the number of workers
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
 worker_connections = 1000
 timeout = 3600  # 1 hour for long video processing
 keepalive = 2
-max_requests = 1000
-max_requests_jitter = 100
+# No max_requests: recycling the only worker would cancel its running encodes
+# and drop the in-memory pool, admission and cancellation state
+max_requests = 0
 
-# Restart workers after this many requests, to help prevent memory leaks
 preload_app = True
 
 # Logging
@@ -53,13 +56,27 @@ def when_ready(server):
 
 def worker_int(worker):
     worker.log.info("🔄 Worker received INT or QUIT signal")
+    _cancel_jobs(worker)
 
 def pre_fork(server, worker):
     server.log.info("👷 Worker spawned (pid: %s)", worker.pid)
 
 def post_fork(server, worker):
     server.log.info("✅ Worker spawned (pid: %s)", worker.pid)
+    # Background threads do not survive fork, so start them in each worker
+    from ffmpeg_api import start_background_services
+    start_background_services()
 
 def worker_abort(worker):
     worker.log.info("💥 Worker received SIGABRT signal")
 
+def worker_exit(server, worker):
+    _cancel_jobs(worker)
+
+def _cancel_jobs(worker):
+    # ffmpeg runs in its own session, so it would outlive a worker that is restarted or shut down
+    import cancellation
+    stopping = cancellation.registry.cancel_all('shutdown', wait=True)
+    if stopping:
+        worker.log.info("🛑 Cancelled %s running job(s) on worker exit", stopping)
+
@@ -0,0 +1,123 @@
+# Conditional requests and compression for read-mostly endpoints
+# Responses carry an ETag (and Last-Modified where there is a natural one);
+# a matching If-None-Match/If-Modified-Since gets an empty 304. Bodies are
+# gzip- or brotli-compressed according to Accept-Encoding. Static bodies are
+# rendered and compressed once and reused for every request.
+
+import gzip
+import hashlib
+import json
+from email.utils import formatdate, parsedate_to_datetime
+
+import flask
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+MIN_COMPRESS_BYTES = 1024
+
+
+def _etag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def _compress(body, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if static else 5)
+    return gzip.compress(body, compresslevel=9 if static else 6, mtime=0)
+
+
+def _choose_encoding(available):
+    # Honour q=0 exclusions; otherwise prefer brotli
+    accepted = {}
+    for part in flask.request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.lower()] = q
+    for encoding in ('br', 'gzip'):
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def _not_modified(etag, last_modified):
+    if_none_match = flask.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = flask.request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class StaticBody:
+    """A body rendered once, with its ETag and compressed variants precomputed."""
+
+    def __init__(self, body, mimetype):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.etag = _etag(self.body)
+        self.variants = {None: self.body, 'gzip': _compress(self.body, 'gzip', static=True)}
+        if brotli is not None:
+            self.variants['br'] = _compress(self.body, 'br', static=True)
+
+    def respond(self, last_modified=None):
+        return _respond(self.body, self.mimetype, self.etag, last_modified, self.variants)
+
+
+def _headers(etag, last_modified):
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def _respond(body, mimetype, etag, last_modified, variants=None):
+    headers = _headers(etag, last_modified)
+    if _not_modified(etag, last_modified):
+        return flask.Response(status=304, headers=headers)
+
+    available = set(variants) if variants else ({'gzip', 'br'} if brotli is not None else {'gzip'})
+    encoding = _choose_encoding(available) if len(body) >= MIN_COMPRESS_BYTES else None
+    if encoding:
+        body = variants[encoding] if variants else _compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return flask.Response(body, mimetype=mimetype, headers=headers)
+
+
+def respond_json(payload, etag_source=None, last_modified=None):
+    """JSON response with conditional-request and compression handling.
+
+    payload may be a callable, which is only called when a full response is needed.
+    etag_source (any JSON-able value) lets callers derive the ETag from something
+    cheaper than the payload itself, e.g. a file's identity.
+    """
+    if etag_source is not None:
+        etag = _etag(json.dumps(etag_source, sort_keys=True, default=str).encode())
+        if _not_modified(etag, last_modified):
+            return flask.Response(status=304, headers=_headers(etag, last_modified))
+    body = flask.current_app.json.dumps(payload() if callable(payload) else payload).encode()
+    return _respond(body, 'application/json', etag if etag_source is not None else _etag(body), last_modified)
+
+
+def respond_bytes(body, mimetype, etag_source=None, last_modified=None):
+    """Binary counterpart of respond_json; body may likewise be a callable."""
+    if etag_source is not None:
+        etag = _etag(json.dumps(etag_source, sort_keys=True, default=str).encode())
+        if _not_modified(etag, last_modified):
+            return flask.Response(status=304, headers=_headers(etag, last_modified))
+    body = body() if callable(body) else body
+    return _respond(body, mimetype, etag if etag_source is not None else _etag(body), last_modified)
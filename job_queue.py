@@ -0,0 +1,339 @@
+# Shared job queue for multi-node worker mode
+# Several API nodes point at the same backend (e.g. a SQLite file on a shared
+# volume) and pull encode jobs from it whenever they have a free slot.
+
+import abc
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime
+
+import cancellation
+
+logger = logging.getLogger(__name__)
+
+QUEUE_URL = os.environ.get('FFMPEG_API_QUEUE', '')
+WORKER_MODE = os.environ.get('FFMPEG_API_WORKER_MODE', '0') == '1'
+NODE_NAME = os.environ.get('FFMPEG_API_NODE_ID') or socket.gethostname()
+WORKER_CONCURRENCY = int(os.environ.get('FFMPEG_API_QUEUE_CONCURRENCY', '1'))
+VISIBILITY_TIMEOUT = float(os.environ.get('FFMPEG_API_VISIBILITY_TIMEOUT', '60'))
+HEARTBEAT_INTERVAL = float(os.environ.get('FFMPEG_API_HEARTBEAT_INTERVAL', '15'))
+POLL_INTERVAL = float(os.environ.get('FFMPEG_API_QUEUE_POLL_INTERVAL', '1'))
+MAX_ATTEMPTS = int(os.environ.get('FFMPEG_API_QUEUE_MAX_ATTEMPTS', '3'))
+NODE_TTL = float(os.environ.get('FFMPEG_API_NODE_TTL', '60'))
+
+
+class DuplicateJob(ValueError):
+    pass
+
+
+class QueueBackend(abc.ABC):
+    """Interface every shared queue backend implements."""
+
+    @abc.abstractmethod
+    def enqueue(self, payload):
+        pass
+
+    @abc.abstractmethod
+    def lease(self, node_id, visibility_timeout):
+        """Claim the oldest available job, or return None."""
+
+    @abc.abstractmethod
+    def heartbeat(self, job_id, lease_token, visibility_timeout):
+        """Extend a lease; returns False if the lease was lost."""
+
+    @abc.abstractmethod
+    def complete(self, job_id, lease_token, result, failed=False):
+        pass
+
+    @abc.abstractmethod
+    def get(self, job_id):
+        pass
+
+    @abc.abstractmethod
+    def counts(self):
+        pass
+
+    @abc.abstractmethod
+    def publish_node(self, node_id, node_stats):
+        pass
+
+    @abc.abstractmethod
+    def nodes(self, ttl):
+        pass
+
+
+class SQLiteQueueBackend(QueueBackend):
+    """Queue stored in a single SQLite file, safe for several processes/hosts."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._conn() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                node_id TEXT,
+                lease_token TEXT,
+                lease_expires REAL,
+                result TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)')
+            conn.execute('''CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY,
+                last_seen REAL NOT NULL,
+                stats TEXT NOT NULL)''')
+
+    def _conn(self):
+        # One connection per thread, and never reuse one inherited across fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # isolation_level=None lets us issue BEGIN IMMEDIATE ourselves
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, payload):
+        job_id = payload.get('job_id') or uuid.uuid4().hex
+        # The worker runs the payload under the same id, so timelines line up
+        payload = {**payload, 'job_id': job_id}
+        now = time.time()
+        try:
+            self._conn().execute(
+                'INSERT INTO jobs (id, payload, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, json.dumps(payload), 'queued', now, now))
+        except sqlite3.IntegrityError:
+            raise DuplicateJob(f'A job with id {job_id} already exists') from None
+        return job_id
+
+    def lease(self, node_id, visibility_timeout):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Expired leases belong to nodes that died or stopped heartbeating
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', result = ?, updated_at = ? "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (json.dumps({'status': 'error', 'message': 'Lease expired too many times'}),
+                 now, now, MAX_ATTEMPTS))
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM jobs "
+                "WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY created_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            token = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE jobs SET state = 'leased', attempts = attempts + 1, node_id = ?, "
+                "lease_token = ?, lease_expires = ?, updated_at = ? WHERE id = ?",
+                (node_id, token, now + visibility_timeout, now, row['id']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return {
+            'job_id': row['id'],
+            'payload': json.loads(row['payload']),
+            'attempt': row['attempts'] + 1,
+            'lease_token': token,
+        }
+
+    def heartbeat(self, job_id, lease_token, visibility_timeout):
+        now = time.time()
+        cur = self._conn().execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+            "WHERE id = ? AND lease_token = ? AND state = 'leased'",
+            (now + visibility_timeout, now, job_id, lease_token))
+        return cur.rowcount == 1
+
+    def complete(self, job_id, lease_token, result, failed=False):
+        cur = self._conn().execute(
+            "UPDATE jobs SET state = ?, result = ?, lease_expires = NULL, updated_at = ? "
+            "WHERE id = ? AND lease_token = ? AND state = 'leased'",
+            ('failed' if failed else 'done', json.dumps(result), time.time(), job_id, lease_token))
+        return cur.rowcount == 1
+
+    def get(self, job_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row['id'],
+            'state': row['state'],
+            'attempts': row['attempts'],
+            'node_id': row['node_id'],
+            'payload': json.loads(row['payload']),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'created_at': datetime.fromtimestamp(row['created_at']).isoformat(),
+            'updated_at': datetime.fromtimestamp(row['updated_at']).isoformat(),
+        }
+
+    def counts(self):
+        now = time.time()
+        counts = {'queued': 0, 'leased': 0, 'done': 0, 'failed': 0, 'expired_leases': 0}
+        for row in self._conn().execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state'):
+            counts[row['state']] = row['n']
+        counts['expired_leases'] = self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'leased' AND lease_expires < ?", (now,)).fetchone()[0]
+        return counts
+
+    def publish_node(self, node_id, node_stats):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO nodes (node_id, last_seen, stats) VALUES (?, ?, ?)',
+            (node_id, time.time(), json.dumps(node_stats)))
+
+    def nodes(self, ttl):
+        cutoff = time.time() - ttl
+        return [
+            {'node_id': row['node_id'], 'last_seen': row['last_seen'], 'stats': json.loads(row['stats'])}
+            for row in self._conn().execute('SELECT * FROM nodes WHERE last_seen >= ? ORDER BY node_id', (cutoff,))
+        ]
+
+
+BACKENDS = {
+    'sqlite': SQLiteQueueBackend,
+}
+
+
+def open_backend(url):
+    """Open a backend from a URL such as sqlite:////shared/queue.db."""
+    scheme, sep, rest = url.partition('://')
+    if not sep or scheme not in BACKENDS:
+        raise ValueError(f'Unsupported queue backend: {url}')
+    return BACKENDS[scheme](rest)
+
+
+class QueueWorker:
+    """Pulls jobs from a shared backend and runs them with a local handler."""
+
+    def __init__(self, backend, handler, node_stats, node_id=None, concurrency=WORKER_CONCURRENCY):
+        self.backend = backend
+        self.handler = handler
+        self.node_stats = node_stats
+        # Each gunicorn worker process is its own node
+        self.node_id = node_id or f'{NODE_NAME}:{os.getpid()}'
+        self.concurrency = max(concurrency, 1)
+        self.active = {}
+        self.processed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._run, name=f'queue-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._publish_loop, name='queue-node-publisher', daemon=True)
+        t.start()
+        self._threads.append(t)
+        logger.info(f"Queue worker {self.node_id} started with {self.concurrency} slot(s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _publish_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.backend.publish_node(self.node_id, self.snapshot())
+            except Exception as e:
+                logger.warning(f"Publishing node stats failed: {e}")
+            self._stop.wait(HEARTBEAT_INTERVAL)
+
+    def snapshot(self):
+        with self._lock:
+            active = list(self.active)
+        return {
+            **self.node_stats(),
+            'active_jobs': active,
+            'free_slots': self.concurrency - len(active),
+            'processed_jobs': self.processed,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.backend.lease(self.node_id, VISIBILITY_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Leasing job failed: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(POLL_INTERVAL)
+                continue
+            self._process(job)
+
+    def _process(self, job):
+        job_id, token = job['job_id'], job['lease_token']
+        with self._lock:
+            self.active[job_id] = time.time()
+        done = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(job_id, token, done), daemon=True)
+        beat.start()
+        logger.info(f"Node {self.node_id} running job {job_id} (attempt {job['attempt']})")
+        try:
+            result, status_code = self.handler(job['payload'])
+            failed = status_code >= 400 or result.get('status') == 'error'
+        except Exception as e:
+            logger.error(f"Queued job {job_id} crashed: {e}")
+            result, failed = {'status': 'error', 'message': str(e)}, True
+        finally:
+            done.set()
+            with self._lock:
+                self.active.pop(job_id, None)
+                self.processed += 1
+        result['node_id'] = self.node_id
+        if not self.backend.complete(job_id, token, result, failed=failed):
+            logger.warning(f"Lease for job {job_id} was lost before completion")
+
+    def _heartbeat(self, job_id, token, done):
+        # The lease runs out VISIBILITY_TIMEOUT after the last heartbeat that got through
+        expires = time.monotonic() + VISIBILITY_TIMEOUT
+        while not done.wait(max(min(HEARTBEAT_INTERVAL, expires - time.monotonic()), 0)):
+            sent = time.monotonic()
+            try:
+                if self.backend.heartbeat(job_id, token, VISIBILITY_TIMEOUT):
+                    expires = sent + VISIBILITY_TIMEOUT
+                    continue
+                logger.warning(f"Lease for job {job_id} lost")
+            except Exception as e:
+                if sent < expires:
+                    logger.warning(f"Heartbeat for job {job_id} failed: {e}")
+                    continue
+                logger.warning(f"Heartbeats for job {job_id} failed for longer than its lease: {e}")
+            # Another node may be running the job now: stop ours, its partial output is removed
+            cancellation.registry.cancel(job_id, 'lease_lost')
+            return
+
+
+def cluster_stats(backend, local_stats):
+    """Combine the stats every live node published into one cluster view."""
+    nodes = backend.nodes(NODE_TTL)
+    totals = {'total_encodings': 0, 'successful_encodings': 0, 'failed_encodings': 0,
+              'active_jobs': 0, 'free_slots': 0}
+    for node in nodes:
+        s = node['stats']
+        for key in ('total_encodings', 'successful_encodings', 'failed_encodings', 'free_slots'):
+            totals[key] += s.get(key, 0)
+        totals['active_jobs'] += len(s.get('active_jobs', []))
+    return {
+        'nodes': len(nodes),
+        'node_ids': [n['node_id'] for n in nodes],
+        'queue': backend.counts(),
+        **totals,
+        'local_node': local_stats,
+    }
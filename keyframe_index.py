@@ -0,0 +1,223 @@
+# Persistent keyframe/packet index per media file
+# One packet-level ffprobe pass records every keyframe's timestamp and byte
+# offset plus the packet count and size of each GOP. The index is stored as
+# packed arrays keyed by the file identity, so a replaced file gets a new index
+# and seeks/cuts never have to scan the container again.
+
+import array
+import bisect
+import os
+import struct
+import subprocess
+import sys
+import threading
+import logging
+from collections import OrderedDict
+
+import media_probe
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'KFI1'
+# magic, keyframe count, packet count, duration, stream time base num/den
+HEADER = struct.Struct('<4sIIdII')
+PROBE_TIMEOUT = int(os.environ.get('FFMPEG_API_INDEX_TIMEOUT', '600'))
+MEMORY_CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_build_locks = {}
+
+
+class IndexBuildError(Exception):
+    pass
+
+
+class KeyframeIndex:
+    """Keyframe times (s), byte offsets and per-GOP packet/byte counts of a file's first video stream."""
+
+    def __init__(self, times, positions, gop_packets, gop_bytes, packet_count, duration, time_base):
+        self.times = times
+        self.positions = positions
+        self.gop_packets = gop_packets
+        self.gop_bytes = gop_bytes
+        self.packet_count = packet_count
+        self.duration = duration
+        self.time_base = time_base
+
+    def __len__(self):
+        return len(self.times)
+
+    def keyframe_at_or_before(self, t):
+        """Index of the last keyframe at or before t (0 if t precedes the first keyframe)."""
+        return max(bisect.bisect_right(self.times, t + 1e-6) - 1, 0)
+
+    def keyframe_at_or_after(self, t):
+        """Index of the first keyframe at or after t, or None if there is none."""
+        i = bisect.bisect_left(self.times, t - 1e-6)
+        return i if i < len(self.times) else None
+
+    def gop_end(self, i):
+        return self.times[i + 1] if i + 1 < len(self.times) else self.duration
+
+    def seek_point(self, t):
+        # -ss before -i lands on this keyframe; decoding then runs forward to t
+        i = self.keyframe_at_or_before(t)
+        return {'requested': t, 'keyframe': self.times[i], 'byte_offset': self.positions[i],
+                'decode_ahead_seconds': round(max(t - self.times[i], 0.0), 6)}
+
+    def to_dict(self, start=None, end=None):
+        lo = self.keyframe_at_or_before(start) if start is not None else 0
+        hi = bisect.bisect_right(self.times, end) if end is not None else len(self.times)
+        gops = self.gop_packets
+        return {
+            'keyframe_count': len(self.times),
+            'packet_count': self.packet_count,
+            'duration': self.duration,
+            'time_base': f'{self.time_base[0]}/{self.time_base[1]}',
+            'avg_gop_packets': round(sum(gops) / len(gops), 2) if gops else None,
+            'max_gop_seconds': round(max((self.gop_end(i) - self.times[i] for i in range(len(self.times))),
+                                         default=0.0), 3),
+            'keyframes': [{'time': self.times[i], 'byte_offset': self.positions[i],
+                           'gop_packets': self.gop_packets[i], 'gop_bytes': self.gop_bytes[i]}
+                          for i in range(lo, hi)],
+        }
+
+
+def _swap(arrays):
+    # The file format is little-endian
+    if sys.byteorder == 'big':
+        for a in arrays:
+            a.byteswap()
+
+
+def _write(path, index):
+    arrays = [array.array('d', index.times), array.array('q', index.positions),
+              array.array('I', index.gop_packets), array.array('q', index.gop_bytes)]
+    _swap(arrays)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(index.times), index.packet_count, index.duration or 0.0, *index.time_base))
+        for a in arrays:
+            a.tofile(f)
+    os.replace(tmp, path)
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            magic, count, packet_count, duration, tb_num, tb_den = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                return None
+            arrays = []
+            for typecode in ('d', 'q', 'I', 'q'):
+                a = array.array(typecode)
+                a.fromfile(f, count)
+                arrays.append(a)
+    except (OSError, EOFError, struct.error):
+        return None
+    _swap(arrays)
+    return KeyframeIndex(*arrays, packet_count, duration or None, (tb_num, tb_den))
+
+
+def _probe_packets(path, stream):
+    """Stream ffprobe's packet list into arrays; memory stays proportional to the keyframe count."""
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', f"{stream['index']}",
+           '-show_entries', 'packet=pts_time,dts_time,pos,size,flags', '-of', 'csv=p=0', path]
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True)
+    timer = threading.Timer(PROBE_TIMEOUT, process.kill)
+    timer.daemon = True
+    timer.start()
+
+    keyframes = []  # (time, pos, packets, bytes) in decode order
+    packet_count = 0
+    try:
+        for line in process.stdout:
+            # csv field order follows ffprobe's packet section: pts_time, dts_time, size, pos, flags
+            fields = line.strip().split(',')
+            if len(fields) < 5:
+                continue
+            pts_time, dts_time, size, pos, flags = fields[:5]
+            packet_count += 1
+            if 'K' in flags:
+                time_s = pts_time if pts_time not in ('', 'N/A') else dts_time
+                try:
+                    keyframes.append([float(time_s), int(pos) if pos.isdigit() else -1, 0, 0])
+                except ValueError:
+                    continue
+            if keyframes:
+                keyframes[-1][2] += 1
+                keyframes[-1][3] += int(size) if size.isdigit() else 0
+        stderr = process.stderr.read()
+        process.wait()
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if process.returncode != 0:
+        raise IndexBuildError(f'ffprobe packet scan failed: {stderr.strip()[-500:]}')
+    if not keyframes:
+        raise IndexBuildError('No keyframes found in video stream')
+
+    keyframes.sort(key=lambda k: k[0])
+    return keyframes, packet_count
+
+
+def build(path):
+    """Scan path with ffprobe and write its index to the cache."""
+    stream = media_probe.video_stream(path)
+    if stream is None:
+        raise IndexBuildError('No video stream to index')
+    key = media_probe.identity_key(path)
+    keyframes, packet_count = _probe_packets(path, stream)
+    num, _, den = stream.get('time_base', '1/1').partition('/')
+    index = KeyframeIndex(
+        array.array('d', (k[0] for k in keyframes)),
+        array.array('q', (k[1] for k in keyframes)),
+        array.array('I', (k[2] for k in keyframes)),
+        array.array('q', (k[3] for k in keyframes)),
+        packet_count, media_probe.duration(path), (int(num or 1), int(den or 1)))
+    _write(media_probe.cache_path('keyframes', key, '.idx'), index)
+    logger.info(f"Indexed {path}: {len(index)} keyframes, {packet_count} packets")
+    _remember(key, index)
+    return index
+
+
+def _remember(key, index):
+    with _lock:
+        _cache[key] = index
+        _cache.move_to_end(key)
+        while len(_cache) > MEMORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def lookup(path):
+    """Return the cached index for path's current contents, or None if it has not been built."""
+    key = media_probe.identity_key(path)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    index = _read(media_probe.cache_path('keyframes', key, '.idx'))
+    if index is not None:
+        _remember(key, index)
+    return index
+
+
+def get_index(path):
+    """Cached index for path, building it once if needed (concurrent callers share one scan)."""
+    index = lookup(path)
+    if index is not None:
+        return index
+    key = media_probe.identity_key(path)
+    with _lock:
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+    with build_lock:
+        index = lookup(path)
+        if index is None:
+            index = build(path)
+    with _lock:
+        _build_locks.pop(key, None)
+    return index
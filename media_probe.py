@@ -0,0 +1,110 @@
+# Cached ffprobe lookups shared by the scheduling and analysis features
+# Results are keyed by path, size and mtime so a replaced file is re-probed.
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import logging
+from collections import OrderedDict
+
+import remote_input
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 1024
+
+# Persistent per-input caches (analysis results, indexes, ...) live under here
+CACHE_DIR = os.environ.get('FFMPEG_API_CACHE_DIR', '/workspace/.ffmpeg_api_cache')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def file_identity(path):
+    if remote_input.is_proxy_url(path):
+        # Remote inputs are identified by URL, size and ETag, not by the proxy port of this worker
+        return remote_input.identity(path)
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+def identity_key(path):
+    """Stable hex key for a file's current contents (path + size + mtime, or URL + size + ETag)."""
+    return hashlib.sha1(':'.join(map(str, file_identity(path))).encode()).hexdigest()
+
+
+def is_input(path):
+    """True for a regular file or a remote input served by the local proxy."""
+    return os.path.isfile(path) or remote_input.is_proxy_url(path)
+
+
+def input_size(path):
+    """Size in bytes of a file or remote input, or 0 if it cannot be read."""
+    try:
+        return file_identity(path)[1]
+    except OSError:
+        return 0
+
+
+def cache_path(kind, key, suffix='.json'):
+    directory = os.path.join(CACHE_DIR, kind)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, key + suffix)
+
+
+def probe(path):
+    """Return ffprobe's format/streams JSON for a file, or None if it cannot be probed."""
+    try:
+        key = file_identity(path)
+    except OSError:
+        return None
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+            capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"ffprobe failed for {path}: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+    try:
+        info = json.loads(result.stdout)
+    except ValueError:
+        return None
+    with _lock:
+        _cache[key] = info
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return info
+
+
+def duration(path):
+    info = probe(path)
+    if not info:
+        return None
+    try:
+        return float(info['format']['duration'])
+    except (KeyError, ValueError):
+        return None
+
+
+def video_stream(path):
+    info = probe(path) or {}
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            return stream
+    return None
+
+
+def audio_stream(path):
+    info = probe(path) or {}
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == 'audio':
+            return stream
+    return None
@@ -0,0 +1,310 @@
+# Execution pools for encodes
+# GPU video encodes and CPU-light jobs (audio-only, stream copy) get separate
+# concurrency limits and queues, so a backlog of 4K encodes never delays a
+# short MP3 conversion. Each pool's limit is tuned at runtime by an AIMD
+# controller that watches the aggregate ffmpeg speed of the jobs it runs.
+
+import collections
+import contextlib
+import contextvars
+import os
+import threading
+import time
+import logging
+
+import cancellation
+import ffmpeg_runner
+
+logger = logging.getLogger(__name__)
+
+GPU_POOL_SIZE = int(os.environ.get('FFMPEG_API_GPU_POOL_SIZE', '2'))
+LIGHT_POOL_SIZE = int(os.environ.get('FFMPEG_API_LIGHT_POOL_SIZE', '8'))
+GPU_TIMEOUT = int(os.environ.get('FFMPEG_API_GPU_TIMEOUT', '3600'))
+LIGHT_TIMEOUT = int(os.environ.get('FFMPEG_API_LIGHT_TIMEOUT', '600'))
+LATENCY_WINDOW = 200
+# Completions counted towards the drain rate (used for Retry-After)
+DRAIN_WINDOW = 600
+
+# Adaptive limits: the pool sizes above are the starting points, the controller
+# moves each limit between 1 and its maximum
+ADAPTIVE = os.environ.get('FFMPEG_API_ADAPTIVE_CONCURRENCY', '1') == '1'
+GPU_POOL_MAX = int(os.environ.get('FFMPEG_API_GPU_POOL_MAX', '6'))
+LIGHT_POOL_MAX = int(os.environ.get('FFMPEG_API_LIGHT_POOL_MAX', str(max(LIGHT_POOL_SIZE, (os.cpu_count() or 1) * 2))))
+# Length of one measurement window; the limit changes at most once per window
+ADAPT_INTERVAL = float(os.environ.get('FFMPEG_API_ADAPT_INTERVAL', '20'))
+ADAPT_TICK = 1.0
+# A window only counts if the pool was full for most of it (otherwise demand, not the limit, set the speed)
+SATURATED_SHARE = 0.7
+GAIN_THRESHOLD = 0.05     # one more slot must add at least 5% aggregate speed to be kept
+DROP_THRESHOLD = 0.15     # aggregate speed this far below the best seen means overload
+DECREASE_FACTOR = 0.75
+REPROBE_SECONDS = 300     # how long a limit that did not help stays off-limits
+HISTORY = 50
+# How often a queued job checks whether it was cancelled
+CANCEL_POLL_SECONDS = 0.5
+
+# The pool whose slot the current thread (or a context copied from it) is running in
+_current = contextvars.ContextVar('pool', default=None)
+
+
+class Pool:
+    """Bounded pool of job slots with a FIFO wait queue; the limit can change at runtime."""
+
+    def __init__(self, name, limit, timeout, max_limit=None):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+        self._cond = threading.Condition()
+        self._waits = collections.deque(maxlen=LATENCY_WINDOW)
+        self._runs = collections.deque(maxlen=LATENCY_WINDOW)
+        self._done = collections.deque(maxlen=LATENCY_WINDOW)
+        self._live = {}  # ffmpeg run id -> latest instantaneous speed/fps
+        self.adaptive = AdaptiveLimit(self, max(max_limit, limit)) if ADAPTIVE and max_limit else None
+
+    def set_limit(self, limit):
+        with self._cond:
+            self.limit = max(int(limit), 1)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """Block until a slot is free; returns the time spent queued in seconds.
+
+        Raises cancellation.Cancelled, giving up its place in the queue, if the job
+        running in this context is cancelled while it waits.
+        """
+        start = time.monotonic()
+        token = cancellation.current()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self.queued += 1
+            # Tickets keep the queue first-come first-served
+            while ticket != self._serving or self.running >= self.limit:
+                if token is not None and token.cancelled:
+                    self._abandoned.add(ticket)
+                    self.queued -= 1
+                    self._pass_on()
+                    token.check()
+                self._cond.wait(CANCEL_POLL_SECONDS if token is not None else None)
+            self._serving += 1
+            self.queued -= 1
+            self.running += 1
+            self._pass_on()
+        waited = time.monotonic() - start
+        self._waits.append(waited)
+        return waited
+
+    def _pass_on(self):
+        # Skip the tickets of jobs cancelled while queued, and wake whoever is next
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+        self._cond.notify_all()
+
+    def release(self, run_seconds=None):
+        with self._cond:
+            self.running -= 1
+            self.completed += 1
+            self._done.append(time.monotonic())
+            self._cond.notify_all()
+        if run_seconds is not None:
+            self._runs.append(run_seconds)
+
+    @contextlib.contextmanager
+    def slot(self):
+        waited = self.acquire()
+        start = time.monotonic()
+        token = _current.set(self)
+        try:
+            yield waited
+        finally:
+            _current.reset(token)
+            self.release(time.monotonic() - start)
+
+    def observe(self, run_id, sample):
+        # ffmpeg's own speed/fps are averages since start; the controller needs current rates
+        with self._cond:
+            if sample is None:
+                self._live.pop(run_id, None)
+                return
+            last = self._live.get(run_id)
+            current = {'t': sample['t'], 'out_time_s': sample['out_time_s'] or 0, 'frame': sample['frame'],
+                       'speed': 0.0, 'fps': 0.0}
+            if last is not None and sample['t'] > last['t']:
+                dt = sample['t'] - last['t']
+                speed = max(current['out_time_s'] - last['out_time_s'], 0) / dt
+                fps = max(current['frame'] - last['frame'], 0) / dt
+                # Smoothed over a couple of progress periods
+                current['speed'] = (last['speed'] + speed) / 2 if last['speed'] else speed
+                current['fps'] = (last['fps'] + fps) / 2 if last['fps'] else fps
+            self._live[run_id] = current
+
+    def drain_rate(self):
+        """Jobs finished per second recently; estimated from run times before enough have finished."""
+        now = time.monotonic()
+        done = [t for t in list(self._done) if now - t <= DRAIN_WINDOW]
+        if len(done) >= 2:
+            return len(done) / max(now - done[0], 1.0)
+        runs = list(self._runs)
+        average_run = sum(runs) / len(runs) if runs else 60.0
+        return max(self.limit, 1) / max(average_run, 1.0)
+
+    def throughput(self):
+        """Aggregate (speed, fps) of the ffmpeg processes currently running in this pool."""
+        with self._cond:
+            return (sum(r['speed'] for r in self._live.values()),
+                    sum(r['fps'] for r in self._live.values()))
+
+    def stats(self):
+        waits = sorted(self._waits)
+        runs = list(self._runs)
+        result = {
+            'limit': self.limit,
+            'running': self.running,
+            'queued': self.queued,
+            'completed': self.completed,
+            'timeout_seconds': self.timeout,
+            'avg_wait_ms': round(sum(waits) / len(waits) * 1000, 1) if waits else 0,
+            'p95_wait_ms': round(waits[min(int(len(waits) * 0.95), len(waits) - 1)] * 1000, 1) if waits else 0,
+            'avg_run_seconds': round(sum(runs) / len(runs), 2) if runs else 0,
+            'drain_per_minute': round(self.drain_rate() * 60, 2),
+        }
+        if self.adaptive is not None:
+            result['adaptive'] = self.adaptive.snapshot()
+        return result
+
+
+class AdaptiveLimit:
+    """AIMD controller for one pool's limit.
+
+    While the pool is full, the aggregate speed (sum of realtime multiples of
+    its running ffmpeg processes) is averaged over a window. The limit grows by
+    one while each extra slot still adds throughput, steps back by one when it
+    stops helping (and leaves that limit alone for REPROBE_SECONDS), and is cut
+    multiplicatively when throughput falls well below the best seen.
+    """
+
+    def __init__(self, pool, max_limit, min_limit=1):
+        self.pool = pool
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.by_limit = {}      # limit -> measured aggregate speed
+        self.ceiling = None     # smallest limit known not to help
+        self.probe_after = 0.0
+        self.history = collections.deque(maxlen=HISTORY)
+        self.last_window = None
+        self._window = []
+        self._ticks = 0
+        self._lock = threading.Lock()
+
+    def tick(self):
+        speed, fps = self.pool.throughput()
+        self._ticks += 1
+        if self.pool.running and self.pool.running >= self.pool.limit:
+            self._window.append((speed, fps))
+        if self._ticks * ADAPT_TICK < ADAPT_INTERVAL:
+            return
+        window, ticks = self._window, self._ticks
+        self._window, self._ticks = [], 0
+        if not window or len(window) < ticks * SATURATED_SHARE:
+            return  # the pool was not the bottleneck, nothing to learn about its limit
+        speed = sum(s for s, _ in window) / len(window)
+        fps = sum(f for _, f in window) / len(window)
+        if speed <= 0:
+            return  # nothing running here reports progress (e.g. streamed encodes)
+        with self._lock:
+            self.last_window = {'limit': self.pool.limit, 'speed': round(speed, 2), 'fps': round(fps, 1),
+                                'at': time.time()}
+            self._decide(speed, fps)
+
+    def _decide(self, speed, fps):
+        limit = self.pool.limit
+        now = time.monotonic()
+        if self.ceiling is not None and now >= self.probe_after:
+            # Load and content change, so old measurements expire and higher limits get probed again
+            self.ceiling = None
+            self.by_limit = {}
+        best = max(self.by_limit.values(), default=None)
+        below = self.by_limit.get(limit - 1)
+        previous = self.by_limit.get(limit)
+        self.by_limit[limit] = speed if previous is None else (previous + speed) / 2
+
+        if best and speed < best * (1 - DROP_THRESHOLD):
+            new = max(self.min_limit, min(limit - 1, int(limit * DECREASE_FACTOR)))
+            reason = f'aggregate speed {speed:.2f}x is {1 - speed / best:.0%} below the best seen ({best:.2f}x)'
+        elif below is not None and speed < below * (1 + GAIN_THRESHOLD):
+            new = max(self.min_limit, limit - 1)
+            self.ceiling, self.probe_after = limit, now + REPROBE_SECONDS
+            reason = f'no gain over limit {limit - 1} ({speed:.2f}x vs {below:.2f}x)'
+        elif limit < self.max_limit and (self.ceiling is None or limit + 1 < self.ceiling):
+            new = limit + 1
+            reason = (f'gain over limit {limit - 1} ({speed:.2f}x vs {below:.2f}x)' if below is not None
+                      else f'probing above {limit} ({speed:.2f}x)')
+        else:
+            return
+        if new == limit:
+            return
+        self.pool.set_limit(new)
+        self.history.append({'at': time.time(), 'from': limit, 'to': new, 'speed': round(speed, 2),
+                             'fps': round(fps, 1), 'reason': reason})
+        logger.info(f"Pool {self.pool.name}: limit {limit} -> {new} ({reason})")
+
+    def snapshot(self):
+        speed, fps = self.pool.throughput()
+        with self._lock:
+            return {
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'current_speed': round(speed, 2),
+                'current_fps': round(fps, 1),
+                'last_window': self.last_window,
+                'speed_by_limit': {str(k): round(v, 2) for k, v in sorted(self.by_limit.items())},
+                'ceiling': self.ceiling,
+                'history': list(self.history),
+            }
+
+
+def _observe(run_id, sample):
+    pool = _current.get()
+    if pool is not None:
+        pool.observe(run_id, sample)
+
+
+ffmpeg_runner.progress_observers.append(_observe)
+
+pools = {
+    'gpu': Pool('gpu', GPU_POOL_SIZE, GPU_TIMEOUT, GPU_POOL_MAX),
+    'light': Pool('light', LIGHT_POOL_SIZE, LIGHT_TIMEOUT, LIGHT_POOL_MAX),
+}
+
+
+def adapt_loop():
+    while True:
+        time.sleep(ADAPT_TICK)
+        for pool in pools.values():
+            try:
+                pool.adaptive.tick()
+            except Exception as e:
+                logger.warning(f"Adaptive limit update for pool {pool.name} failed: {e}")
+
+
+def is_light(data):
+    # Audio-only jobs and pure stream copies need neither the GPU nor much CPU
+    if data.get('audio_only', False):
+        return True
+    return (data.get('video_codec') == 'copy' and not data.get('video_filter')
+            and not data.get('complex_filter') and not data.get('scale'))
+
+
+def for_job(data):
+    return pools['light'] if is_light(data) else pools['gpu']
+
+
+def pool_stats():
+    return {name: pool.stats() for name, pool in pools.items()}
@@ -0,0 +1,212 @@
+# Objective video quality (VMAF, SSIM, PSNR)
+# ffmpeg compares an encode against its source: the encode is scaled to the
+# reference size and pixel format, both timelines are reset to zero, and the
+# metric filters' summaries or per-frame logs are parsed. Whole-file scoring
+# splits the timeline into chunks scored concurrently, and per-frame results
+# are cached per (source, output) pair.
+
+import concurrent.futures
+import contextvars
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import logging
+
+import ffmpeg_runner
+import filter_catalog
+import media_probe
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('vmaf', 'ssim', 'psnr')
+VMAF_THREADS = int(os.environ.get('FFMPEG_API_VMAF_THREADS', '4'))
+# Chunks scored at once, and the shortest chunk worth a separate process
+PARALLEL = int(os.environ.get('FFMPEG_API_QUALITY_PARALLEL', str(os.cpu_count() or 1)))
+MIN_CHUNK_SECONDS = 5.0
+
+_SCORE = {
+    'vmaf': re.compile(r'VMAF score: ([\d.]+)'),
+    'ssim': re.compile(r'SSIM .*All:([\d.]+)'),
+    'psnr': re.compile(r'PSNR .*average:([\d.]+|inf)'),
+}
+_FRAME = {
+    'ssim': re.compile(r'All:([\d.]+)'),
+    'psnr': re.compile(r'psnr_avg:([\d.]+|inf)'),
+}
+
+
+class QualityError(Exception):
+    pass
+
+
+def available(metric):
+    catalog = filter_catalog.catalog
+    name = 'libvmaf' if metric == 'vmaf' else metric
+    return not catalog.load() or name in catalog.filters
+
+
+def default_metric():
+    return 'vmaf' if available('vmaf') else 'ssim'
+
+
+def reference_size(input_file, crop=None):
+    """(width, height, pix_fmt) of the picture the metrics are computed at."""
+    stream = media_probe.video_stream(input_file)
+    if stream is None:
+        raise QualityError('Input has no video stream')
+    width, height = stream.get('width'), stream.get('height')
+    if crop:
+        width, height = (int(v) for v in str(crop).split(':')[:2])
+    return width, height, stream.get('pix_fmt') or 'yuv420p'
+
+
+def _metric_filter(metric, log_path=None, threads=VMAF_THREADS):
+    if metric == 'vmaf':
+        options = f'n_threads={threads}'
+        return f'libvmaf={options}:log_fmt=json:log_path={log_path}' if log_path else f'libvmaf={options}'
+    return f'{metric}=stats_file={log_path}' if log_path else metric
+
+
+def compare_command(distorted, reference, metrics, size, start=None, duration=None, distorted_start=None,
+                    reference_filter=None, logs=None, threads=VMAF_THREADS):
+    """ffmpeg command scoring distorted against reference (optionally a time range of each).
+
+    metrics is one metric or a list; logs maps metric -> per-frame log path.
+    """
+    metrics = [metrics] if isinstance(metrics, str) else list(metrics)
+    logs = logs or {}
+    width, height, pix_fmt = size
+    cmd = ['ffmpeg', '-y']
+    for path, offset in ((distorted, distorted_start if distorted_start is not None else start), (reference, start)):
+        if offset:
+            cmd += ['-ss', f'{offset:.6f}']
+        if duration:
+            cmd += ['-t', f'{duration:.6f}']
+        cmd += ['-i', path]
+    reference_chain = f'{reference_filter},' if reference_filter else ''
+    graph = (f'[0:v]scale={width}:{height}:flags=bicubic,format={pix_fmt},setpts=PTS-STARTPTS[d];'
+             f'[1:v]{reference_chain}scale={width}:{height},format={pix_fmt},setpts=PTS-STARTPTS[r];')
+    if len(metrics) == 1:
+        graph += f'[d][r]{_metric_filter(metrics[0], logs.get(metrics[0]), threads)}'
+    else:
+        # One decode of each input feeds every metric
+        n = len(metrics)
+        graph += (f"[d]split={n}{''.join(f'[d{i}]' for i in range(n))};"
+                  f"[r]split={n}{''.join(f'[r{i}]' for i in range(n))};")
+        graph += ';'.join(f'[d{i}][r{i}]{_metric_filter(m, logs.get(m), threads)}' for i, m in enumerate(metrics))
+    return cmd + ['-lavfi', graph, '-f', 'null', '-']
+
+
+def measure(distorted, reference, metric, job_id, timeout=600, **kwargs):
+    """Mean score of distorted against reference; kwargs as for compare_command."""
+    if metric not in METRICS:
+        raise QualityError(f"Unknown metric '{metric}' (expected {', '.join(METRICS)})")
+    lines = []
+    pattern = _SCORE[metric]
+    result = ffmpeg_runner.run_ffmpeg(compare_command(distorted, reference, metric, **kwargs), job_id, timeout,
+                                      on_stderr=lambda line: pattern.search(line) and lines.append(line))
+    if result.returncode != 0 or not lines:
+        raise QualityError(f'{metric} measurement failed: {result.stderr[-1000:]}')
+    value = pattern.search(lines[-1]).group(1)
+    return float('inf') if value == 'inf' else float(value)
+
+
+def _read_frames(metric, path):
+    if metric == 'vmaf':
+        with open(path) as f:
+            return [frame['metrics']['vmaf'] for frame in json.load(f)['frames']]
+    values = []
+    with open(path) as f:
+        for line in f:
+            m = _FRAME[metric].search(line)
+            if m:
+                values.append(float('inf') if m.group(1) == 'inf' else float(m.group(1)))
+    return values
+
+
+def _score_chunk(source, output, metrics, size, start, duration, reference_filter, work_dir, index, job_id,
+                 timeout, threads):
+    logs = {m: os.path.join(work_dir, f'{index}.{m}.log') for m in metrics}
+    cmd = compare_command(output, source, metrics, size, start=start, duration=duration,
+                          reference_filter=reference_filter, logs=logs, threads=threads)
+    result = ffmpeg_runner.run_ffmpeg(cmd, f'{job_id}-chunk{index}', timeout)
+    if result.returncode != 0:
+        raise QualityError(f'Scoring chunk {index} ({start:.1f}s) failed: {result.stderr[-1000:]}')
+    return {m: _read_frames(m, logs[m]) for m in metrics}
+
+
+def chunk_plan(duration, chunks=None):
+    """[(start, length)] covering the timeline; the last chunk runs to the end (length None)."""
+    count = chunks or max(min(PARALLEL, int(duration // MIN_CHUNK_SECONDS)), 1)
+    length = duration / count
+    return [(i * length, length if i < count - 1 else None) for i in range(count)]
+
+
+def _summary(frames):
+    finite = sorted(v for v in frames if v != float('inf'))
+    if not finite:
+        return {'frames': len(frames), 'mean': None}
+    return {
+        'frames': len(frames),
+        'mean': round(sum(finite) / len(finite), 4),
+        'min': round(finite[0], 4),
+        'p5': round(finite[int(len(finite) * 0.05)], 4),
+        'max': round(finite[-1], 4),
+        # Harmonic mean weights the worst frames more, closer to what viewers notice
+        'harmonic_mean': round(len(finite) / sum(1 / max(v, 1e-6) for v in finite), 4),
+        'infinite_frames': len(frames) - len(finite),
+    }
+
+
+def score(source, output, metrics, crop=None, chunks=None, job_id='quality', timeout=3600):
+    """Per-frame and aggregate scores of output against source; returns (results, reused metrics)."""
+    unknown = [m for m in metrics if m not in METRICS or not available(m)]
+    if unknown:
+        raise QualityError(f"Unknown or unavailable metric(s): {', '.join(unknown)} "
+                           f"(available: {', '.join(m for m in METRICS if available(m))})")
+    size = reference_size(source, crop)
+    reference_filter = f'crop={crop}' if crop else None
+    key = hashlib.sha1(json.dumps([media_probe.identity_key(source), media_probe.identity_key(output),
+                                   crop]).encode()).hexdigest()
+    cache_file = media_probe.cache_path('quality', key)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    missing = [m for m in metrics if m not in cached]
+
+    if missing:
+        duration = media_probe.duration(output) or media_probe.duration(source)
+        if not duration:
+            raise QualityError('Cannot score an output without a known duration')
+        plan = chunk_plan(duration, chunks)
+        # VMAF's own threads are shared out between the concurrent chunks
+        threads = max(VMAF_THREADS // len(plan), 1)
+        work_dir = tempfile.mkdtemp(prefix=f'quality_{job_id}_')
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(plan), PARALLEL)) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, _score_chunk, source, output, missing, size,
+                                       start, length, reference_filter, work_dir, i, job_id, timeout, threads)
+                           for i, (start, length) in enumerate(plan)]
+                parts = [f.result() for f in futures]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        for m in missing:
+            cached[m] = {'per_frame': [round(v, 4) if v != float('inf') else None
+                                       for part in parts for v in part[m]],
+                         'chunks': len(plan)}
+        tmp = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmp, cache_file)
+
+    results = {}
+    for m in metrics:
+        frames = [float('inf') if v is None else v for v in cached[m]['per_frame']]
+        results[m] = {**_summary(frames), 'chunks': cached[m]['chunks'], 'per_frame': cached[m]['per_frame']}
+    return results, [m for m in metrics if m not in missing]
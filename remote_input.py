@@ -0,0 +1,529 @@
+# Remote (http/https) inputs read through a local range proxy
+# ffmpeg is handed a loopback URL served by this process instead of the origin.
+# The proxy answers range requests from an on-disk chunk cache; missing chunks
+# are fetched from the origin as parallel ranged GETs over kept-alive
+# connections, reading further ahead the longer a read runs sequentially. A
+# probe, an analysis, a first pass and the encode of the same asset (or two
+# jobs on it) download each byte once. Chunks are evicted least recently used
+# first to keep the cache under its budget. Hosts that resolve to loopback,
+# private or link-local addresses are refused unless listed, checked both
+# before the first request and on every connection (so also after redirects).
+
+import concurrent.futures
+import hashlib
+import http.client
+import http.server
+import ipaddress
+import os
+import re
+import socket
+import threading
+import time
+import urllib.parse
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = int(float(os.environ.get('FFMPEG_API_REMOTE_CHUNK_MB', '4')) * 1024 * 1024)
+# Concurrent ranged fetches per worker, and how many chunks a sequential read may run ahead
+PARALLEL = int(os.environ.get('FFMPEG_API_REMOTE_PARALLEL', '4'))
+READAHEAD = int(os.environ.get('FFMPEG_API_REMOTE_READAHEAD', str(2 * PARALLEL)))
+CACHE_DIR = os.environ.get('FFMPEG_API_REMOTE_CACHE_DIR', os.path.join(
+    os.environ.get('FFMPEG_API_CACHE_DIR', '/workspace/.ffmpeg_api_cache'), 'remote'))
+CACHE_MAX_BYTES = int(float(os.environ.get('FFMPEG_API_REMOTE_CACHE_GB', '20')) * 1024 ** 3)
+# An asset is re-checked at the origin (size, ETag) when it is used again after this long
+REVALIDATE_SECONDS = float(os.environ.get('FFMPEG_API_REMOTE_REVALIDATE', '60'))
+TIMEOUT = float(os.environ.get('FFMPEG_API_REMOTE_TIMEOUT', '30'))
+# Comma-separated host names remote inputs may come from; empty allows any public host
+ALLOWED_HOSTS = {h.strip().lower() for h in os.environ.get('FFMPEG_API_REMOTE_HOSTS', '').split(',') if h.strip()}
+# Comma-separated host names or addresses that may resolve to loopback, private or link-local addresses
+PRIVATE_HOSTS = {h.strip().lower() for h in os.environ.get('FFMPEG_API_REMOTE_PRIVATE_HOSTS', '').split(',')
+                 if h.strip()}
+IDLE_CONNECTIONS = 8
+MAX_REDIRECTS = 5
+FETCH_ATTEMPTS = 3
+
+_PROXY_URL = re.compile(r'^http://127\.0\.0\.1:\d+/([0-9a-f]{40})/')
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_assets = {}
+_by_url = {}
+_inflight = {}
+_lock = threading.Lock()
+_prune_lock = threading.Lock()
+_cache_bytes = None
+_server = None
+_server_pid = None
+_executor = None
+_executor_pid = None
+_stats = {'assets': 0, 'chunk_hits': 0, 'chunk_fetches': 0, 'bytes_fetched': 0, 'bytes_served': 0,
+          'fetch_errors': 0, 'connections_opened': 0, 'connections_reused': 0, 'evicted_bytes': 0}
+
+
+class RemoteInputError(OSError):
+    def __init__(self, message, http_status=502):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+def _count(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+
+def is_remote(name):
+    return isinstance(name, str) and name.lower().startswith(('http://', 'https://'))
+
+
+class Asset:
+    def __init__(self, url, fetch_url, size, validator, ranges):
+        self.url = url
+        self.fetch_url = fetch_url
+        self.size = size
+        self.validator = validator
+        self.ranges = ranges
+        self.checked = time.monotonic()
+        self.key = hashlib.sha1(f'{url}\n{size}\n{validator}'.encode()).hexdigest()
+
+    def chunk_path(self, index):
+        return os.path.join(CACHE_DIR, f'{self.key}-{index}')
+
+    def chunk_span(self, index):
+        start = index * CHUNK_BYTES
+        return start, min(start + CHUNK_BYTES, self.size)
+
+
+class _Origins:
+    """Kept-alive connections to origin servers, most recently used first."""
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        origin = (parts.scheme.lower(), parts.netloc)
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        while True:
+            with self._lock:
+                idle = self._idle.get(origin)
+                conn = idle.pop() if idle else None
+            reused = conn is not None
+            if conn is None:
+                cls = http.client.HTTPSConnection if origin[0] == 'https' else http.client.HTTPConnection
+                conn = cls(parts.netloc, timeout=TIMEOUT)
+                _count('connections_opened')
+            else:
+                _count('connections_reused')
+            try:
+                if not reused:
+                    conn.connect()
+                    # The address actually connected to, so a DNS answer that changed after _check_url is caught
+                    _check_address(parts.hostname.lower(), conn.sock.getpeername()[0])
+                conn.request('GET', target, headers=headers)
+                return origin, conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                # The origin had closed this idle connection already; take another one
+
+    def release(self, origin, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(origin, [])
+            if len(idle) < IDLE_CONNECTIONS:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+_origins = _Origins()
+
+
+def _is_public(address):
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # is_global is false for loopback, private, link-local (cloud metadata), shared and reserved ranges
+    return ip.is_global and not ip.is_multicast
+
+
+def _check_address(host, address):
+    if host not in PRIVATE_HOSTS and address not in PRIVATE_HOSTS and not _is_public(address):
+        raise RemoteInputError(f'Remote inputs from {host} are not allowed: it resolves to {address}, '
+                               f'which is not a public address', 400)
+
+
+def _check_url(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+        raise RemoteInputError(f'Not an http(s) URL: {url}', 400)
+    host = parts.hostname.lower()
+    if ALLOWED_HOSTS and host not in ALLOWED_HOSTS:
+        raise RemoteInputError(f'Remote inputs from {parts.hostname} are not allowed', 400)
+    if host in PRIVATE_HOSTS:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)}
+    except (socket.gaierror, UnicodeError) as e:
+        raise RemoteInputError(f'Cannot resolve {parts.hostname}: {e}')
+    # Every address is checked: the connection may go to any of them
+    for address in sorted(addresses):
+        _check_address(host, address)
+
+
+def _probe(url):
+    """(fetch URL after redirects, size, validator, whether ranges work) for url.
+
+    A one-byte ranged GET rather than HEAD: presigned object-store URLs are only valid for GET.
+    """
+    fetch_url = url
+    for _ in range(MAX_REDIRECTS + 1):
+        try:
+            origin, conn, response = _origins.request(fetch_url, {'Range': 'bytes=0-0'})
+        except RemoteInputError:
+            raise
+        except (http.client.HTTPException, OSError) as e:
+            raise RemoteInputError(f'Cannot reach {url}: {e}')
+        status = response.status
+        validator = response.getheader('ETag') or response.getheader('Last-Modified') or ''
+        if status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+            response.read()
+            _origins.release(origin, conn, response)
+            fetch_url = urllib.parse.urljoin(fetch_url, response.getheader('Location'))
+            _check_url(fetch_url)
+            continue
+        if status == 206:
+            m = _CONTENT_RANGE.match(response.getheader('Content-Range', ''))
+            response.read()
+            _origins.release(origin, conn, response)
+            if not m:
+                raise RemoteInputError(f'{url} did not report its size')
+            return fetch_url, int(m.group(3)), validator, True
+        if status == 200:
+            # No range support: the body is the whole asset, not worth reading just to probe
+            conn.close()
+            length = response.getheader('Content-Length')
+            if not (length or '').isdigit():
+                raise RemoteInputError(f'{url} did not report its size')
+            return fetch_url, int(length), validator, False
+        response.read()
+        _origins.release(origin, conn, response)
+        if status == 416:
+            return fetch_url, 0, validator, True
+        if status in (404, 410):
+            raise RemoteInputError(f'Input file not found: {url}', 404)
+        raise RemoteInputError(f'{url} answered HTTP {status}')
+    raise RemoteInputError(f'Too many redirects for {url}')
+
+
+def open_url(url):
+    """Local proxy URL ffmpeg can read url through; the origin is checked at most every REVALIDATE_SECONDS."""
+    _check_url(url)
+    with _lock:
+        asset = _by_url.get(url)
+    if asset is None or time.monotonic() - asset.checked > REVALIDATE_SECONDS:
+        fetch_url, size, validator, ranges = _probe(url)
+        if size == 0:
+            raise RemoteInputError(f'Input file is empty: {url}', 422)
+        asset = Asset(url, fetch_url, size, validator, ranges)
+        with _lock:
+            if asset.key not in _assets:
+                _stats['assets'] += 1
+            # A changed asset gets a new key, so chunks of the old contents are never served for it
+            _assets[asset.key] = _by_url[url] = asset
+    name = urllib.parse.quote(os.path.basename(urllib.parse.urlsplit(url).path) or 'input')
+    return f'http://127.0.0.1:{_ensure_server()}/{asset.key}/{name}'
+
+
+def _asset(path):
+    m = _PROXY_URL.match(path) if isinstance(path, str) else None
+    return _assets.get(m.group(1)) if m else None
+
+
+def is_proxy_url(path):
+    return _asset(path) is not None
+
+
+def origin_url(path):
+    """The remote URL behind a proxy URL; anything else is returned unchanged."""
+    asset = _asset(path)
+    return asset.url if asset else path
+
+
+def identity(path):
+    """(url, size, validator) of the asset behind a proxy URL, stable across workers and restarts."""
+    asset = _asset(path)
+    if asset is None:
+        raise RemoteInputError(f'Not a remote input: {path}', 404)
+    return (asset.url, asset.size, asset.validator)
+
+
+def _pool():
+    global _executor, _executor_pid
+    # Called with _lock held; a pool inherited across fork has no threads left
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL, thread_name_prefix='remote-fetch')
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def _chunk(asset, index):
+    """Future for a chunk being in the cache; one fetch per chunk however many readers want it."""
+    path = asset.chunk_path(index)
+    # Origins without range support are downloaded whole, once
+    flight = path if asset.ranges else asset.key
+    with _lock:
+        future = _inflight.get(flight)
+        if future is None:
+            if os.path.exists(path):
+                future = concurrent.futures.Future()
+                future.set_result(path)
+                return future
+            future = _inflight[flight] = _pool().submit(_fetch if asset.ranges else _fetch_whole, asset, index)
+            future.add_done_callback(lambda _: _forget(flight))
+    return future
+
+
+def _forget(flight):
+    with _lock:
+        _inflight.pop(flight, None)
+
+
+def _fetch(asset, index):
+    start, end = asset.chunk_span(index)
+    error = None
+    for attempt in range(FETCH_ATTEMPTS):
+        if attempt:
+            time.sleep(0.5 * 2 ** attempt)
+        try:
+            origin, conn, response = _origins.request(asset.fetch_url, {'Range': f'bytes={start}-{end - 1}'})
+            if response.status != 206:
+                # An origin that now ignores Range would send the whole asset; do not read it into memory
+                conn.close()
+                raise RemoteInputError(f'HTTP {response.status}')
+            data = response.read(end - start)
+            _origins.release(origin, conn, response)
+            validator = response.getheader('ETag') or response.getheader('Last-Modified') or ''
+            if asset.validator and validator and validator != asset.validator:
+                raise RemoteInputError(f'{asset.url} changed while it was being read', 409)
+            if len(data) != end - start:
+                raise RemoteInputError(f'short read ({len(data)} of {end - start} bytes)')
+            _store(asset.chunk_path(index), data)
+            _count('chunk_fetches')
+            return asset.chunk_path(index)
+        except RemoteInputError as e:
+            if e.http_status in (400, 409):
+                _count('fetch_errors')
+                raise
+            error = e
+        except (http.client.HTTPException, OSError) as e:
+            error = e
+    _count('fetch_errors')
+    raise RemoteInputError(f'Fetching bytes {start}-{end - 1} of {asset.url} failed: {error}')
+
+
+def _fetch_whole(asset, index):
+    try:
+        origin, conn, response = _origins.request(asset.fetch_url, {})
+        try:
+            if response.status != 200:
+                raise RemoteInputError(f'HTTP {response.status}')
+            for i in range((asset.size + CHUNK_BYTES - 1) // CHUNK_BYTES):
+                start, end = asset.chunk_span(i)
+                data = response.read(end - start)
+                if len(data) != end - start:
+                    raise RemoteInputError(f'short read at byte {start + len(data)}')
+                _store(asset.chunk_path(i), data)
+                _count('chunk_fetches')
+            response.read()
+        finally:
+            _origins.release(origin, conn, response)
+    except (http.client.HTTPException, OSError) as e:
+        _count('fetch_errors')
+        raise RemoteInputError(f'Downloading {asset.url} failed: {e}')
+    return asset.chunk_path(index)
+
+
+def _store(path, data):
+    global _cache_bytes
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    with _lock:
+        _stats['bytes_fetched'] += len(data)
+        if _cache_bytes is not None:
+            _cache_bytes += len(data)
+        over = _cache_bytes is None or _cache_bytes > CACHE_MAX_BYTES
+    if over:
+        _prune()
+
+
+def _prune():
+    # Evict down to 90% of the budget so a full cache does not rescan on every new chunk
+    global _cache_bytes
+    if not _prune_lock.acquire(blocking=False):
+        return
+    try:
+        entries = []
+        for entry in os.scandir(CACHE_DIR):
+            try:
+                if not entry.name.endswith('.tmp'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            except OSError:
+                pass
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if total > CACHE_MAX_BYTES:
+            for _, size, path in sorted(entries):
+                if total <= 0.9 * CACHE_MAX_BYTES:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += size
+        with _lock:
+            _cache_bytes = total
+            _stats['evicted_bytes'] += evicted
+    finally:
+        _prune_lock.release()
+
+
+def _read_chunk(asset, index, offset):
+    """Open file object positioned at offset within a chunk, fetching the chunk if needed."""
+    path = asset.chunk_path(index)
+    for _ in range(2):
+        if os.path.exists(path):
+            _count('chunk_hits')
+        else:
+            _chunk(asset, index).result()
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            # Evicted between the fetch and the read
+            continue
+        # Touching marks the chunk as recently used for eviction
+        os.utime(f.fileno())
+        f.seek(offset)
+        return f
+    raise RemoteInputError(f'Chunk {index} of {asset.url} was evicted while being read')
+
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        parts = self.path.split('/')
+        asset = _assets.get(parts[1]) if len(parts) > 1 else None
+        if asset is None:
+            self.send_error(404)
+            return
+        start, end = 0, asset.size
+        requested = self.headers.get('Range')
+        m = _RANGE.match(requested or '')
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                if m.group(2):
+                    end = min(int(m.group(2)) + 1, asset.size)
+            else:
+                start = max(asset.size - int(m.group(2)), 0)
+            if start >= asset.size or start >= end:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{asset.size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        else:
+            m = None
+
+        first, last = start // CHUNK_BYTES, (end - 1) // CHUNK_BYTES
+        f = None
+        if body:
+            # The first chunk is fetched before answering, so an origin failure is still a clean 502
+            try:
+                f = self._open(asset, first, last, first, start)
+            except (RemoteInputError, concurrent.futures.CancelledError) as e:
+                logger.error(f"Remote input {asset.url}: {e}")
+                self.send_error(502)
+                return
+        self.send_response(206 if m else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if m:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{asset.size}')
+        self.end_headers()
+        if not body:
+            return
+
+        position = start
+        try:
+            for index in range(first, last + 1):
+                if f is None:
+                    f = self._open(asset, first, last, index, position)
+                chunk_start, chunk_end = asset.chunk_span(index)
+                count = min(end, chunk_end) - position
+                with f:
+                    self.connection.sendfile(f, position - chunk_start, count)
+                f = None
+                position += count
+                _count('bytes_served', count)
+        except (RemoteInputError, concurrent.futures.CancelledError) as e:
+            # Headers are out; a short body is how the reader learns of the failure
+            logger.error(f"Remote input {asset.url}: {e}")
+            self.close_connection = True
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg seeks by dropping the connection and asking for another range
+            self.close_connection = True
+        finally:
+            if f is not None:
+                f.close()
+
+    def _open(self, asset, first, last, index, position):
+        # Read-ahead grows with how far this read has gone sequentially, so a
+        # short header read does not pull in the whole readahead window
+        ahead = min(READAHEAD, index - first + 1)
+        for i in range(index + 1, min(index + ahead, last) + 1):
+            _chunk(asset, i)
+        chunk_start, _ = asset.chunk_span(index)
+        return _read_chunk(asset, index, position - chunk_start)
+
+
+def _ensure_server():
+    """Port of this process's proxy, started on first use (threads do not survive fork)."""
+    global _server, _server_pid
+    with _lock:
+        if _server is None or _server_pid != os.getpid():
+            _server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _ProxyHandler)
+            _server.daemon_threads = True
+            _server_pid = os.getpid()
+            threading.Thread(target=_server.serve_forever, name='remote-input-proxy', daemon=True).start()
+            logger.info(f"Remote input proxy listening on 127.0.0.1:{_server.server_address[1]}")
+        return _server.server_address[1]
+
+
+def snapshot():
+    with _lock:
+        return {**_stats, 'fetching': len(_inflight), 'cache_bytes': _cache_bytes,
+                'cache_max_bytes': CACHE_MAX_BYTES, 'chunk_bytes': CHUNK_BYTES, 'parallel': PARALLEL,
+                'readahead_chunks': READAHEAD, 'allowed_hosts': sorted(ALLOWED_HOSTS),
+                'private_hosts': sorted(PRIVATE_HOSTS)}
@@ -0,0 +1,225 @@
+# Scratch-tier staging for inputs and outputs on slow mounts
+# Inputs are copied to fast local scratch (NVMe or /dev/shm) with large
+# sequential reads and kept in a size-bounded LRU cache keyed by path+mtime.
+# ffmpeg writes outputs to scratch too; they are moved back in the background.
+# A staged copy is pinned from staging until its job is done with it, so another
+# job making room cannot evict it while its job is queued for a slot.
+
+import collections
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_DIR = os.environ.get('FFMPEG_API_SCRATCH_DIR', '')
+SCRATCH_MAX_BYTES = int(float(os.environ.get('FFMPEG_API_SCRATCH_MAX_GB', '8')) * 1024 ** 3)
+STAGE_OUTPUTS = os.environ.get('FFMPEG_API_SCRATCH_OUTPUTS', '1') == '1'
+COPY_BUFFER = 8 * 1024 * 1024
+ENABLED = bool(SCRATCH_DIR)
+WORKSPACE = '/workspace/'
+
+stats = {
+    'input_hits': 0,
+    'input_misses': 0,
+    'bytes_staged': 0,
+    'bytes_saved': 0,
+    'outputs_moved': 0,
+    'output_move_failures': 0,
+}
+_stats_lock = threading.Lock()
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+_pins = collections.Counter()
+_pins_lock = threading.Lock()
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            stats[key] += value
+
+
+def _inputs_dir():
+    path = os.path.join(SCRATCH_DIR, 'inputs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _outputs_dir():
+    path = os.path.join(SCRATCH_DIR, 'outputs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def copy_sequential(src, dst):
+    # One large sequential read stream is far cheaper than ffmpeg's seeks on a 9p/SMB mount
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, COPY_BUFFER)
+
+
+def cache_bytes():
+    try:
+        return sum(e.stat().st_size for e in os.scandir(_inputs_dir()) if e.is_file())
+    except OSError:
+        return 0
+
+
+def _evict_inputs(needed):
+    # Least recently used first; hits bump the file's mtime. Copies still being
+    # written (.tmp) and copies pinned by a job are never evicted.
+    entries = sorted((e for e in os.scandir(_inputs_dir()) if e.is_file()), key=lambda e: e.stat().st_mtime)
+    total = sum(e.stat().st_size for e in entries)
+    for entry in entries:
+        if total + needed <= SCRATCH_MAX_BYTES:
+            break
+        if entry.name.endswith('.tmp'):
+            continue
+        try:
+            size = entry.stat().st_size
+            # Checked and removed under the pin lock, so a hit cannot pin it in between
+            with _pins_lock:
+                if _pins[entry.path]:
+                    continue
+                os.remove(entry.path)
+            total -= size
+        except OSError:
+            continue
+
+
+def _pin(staged):
+    with _pins_lock:
+        _pins[staged] += 1
+
+
+def release_input(staged):
+    """Unpin a copy returned by stage_input once its job is done with it; other paths are ignored."""
+    with _pins_lock:
+        if _pins[staged] > 1:
+            _pins[staged] -= 1
+        else:
+            _pins.pop(staged, None)
+
+
+def stage_input(path):
+    """Return a scratch copy of path (copying it on a miss), or path itself if it should not be staged.
+
+    The copy stays pinned against eviction until release_input is called for it.
+    """
+    if not ENABLED or not path.startswith(WORKSPACE):
+        return path
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    if st.st_size > SCRATCH_MAX_BYTES // 2:
+        return path
+    key = hashlib.sha1(f'{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}'.encode()).hexdigest()
+    staged = os.path.join(_inputs_dir(), key + os.path.splitext(path)[1])
+
+    with _key_locks_lock:
+        lock = _key_locks.setdefault(key, threading.Lock())
+    with lock:
+        with _pins_lock:
+            hit = os.path.exists(staged)
+            if hit:
+                _pins[staged] += 1
+        if hit:
+            os.utime(staged)
+            _count(input_hits=1, bytes_saved=st.st_size)
+            return staged
+        if shutil.disk_usage(SCRATCH_DIR).free < st.st_size:
+            _evict_inputs(st.st_size)
+            if shutil.disk_usage(SCRATCH_DIR).free < st.st_size:
+                return path
+        _evict_inputs(st.st_size)
+        tmp = f'{staged}.{os.getpid()}.{threading.get_ident()}.tmp'
+        _pin(staged)
+        try:
+            start = time.time()
+            copy_sequential(path, tmp)
+            os.replace(tmp, staged)
+        except OSError as e:
+            release_input(staged)
+            logger.warning(f"Staging {path} failed, reading it in place: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return path
+        _count(input_misses=1, bytes_staged=st.st_size)
+        logger.info(f"Staged {path} to scratch ({st.st_size / 1024 / 1024:.1f} MB in {time.time() - start:.2f}s)")
+        return staged
+
+
+def scratch_output_path(job_id, output_file, estimate):
+    """Scratch location for an output, or None if outputs are not staged or scratch is too full."""
+    if not (ENABLED and STAGE_OUTPUTS):
+        return None
+    directory = _outputs_dir()
+    if shutil.disk_usage(directory).free < estimate:
+        return None
+    return os.path.join(directory, f'{job_id}{os.path.splitext(output_file)[1]}')
+
+
+class OutputMover:
+    """Background thread that moves finished outputs from scratch back to /workspace."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def submit(self, scratch_file, workspace_tmp, on_done):
+        # on_done(moved: bool) runs on the mover thread once the file has been copied to workspace_tmp
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='scratch-output-mover', daemon=True)
+                self._thread.start()
+        self._queue.put((scratch_file, workspace_tmp, on_done))
+
+    def _run(self):
+        while True:
+            scratch_file, workspace_tmp, on_done = self._queue.get()
+            moved = False
+            try:
+                copy_sequential(scratch_file, workspace_tmp)
+                moved = True
+                _count(outputs_moved=1)
+            except OSError as e:
+                _count(output_move_failures=1)
+                logger.error(f"Moving {scratch_file} back to workspace failed: {e}")
+            finally:
+                try:
+                    os.remove(scratch_file)
+                except OSError:
+                    pass
+            try:
+                on_done(moved)
+            except Exception as e:
+                logger.error(f"Output move callback failed: {e}")
+
+
+mover = OutputMover()
+
+
+def staging_stats():
+    with _stats_lock:
+        snapshot = dict(stats)
+    lookups = snapshot['input_hits'] + snapshot['input_misses']
+    snapshot.update({
+        'enabled': ENABLED,
+        'scratch_dir': SCRATCH_DIR or None,
+        'hit_rate': round(snapshot['input_hits'] / lookups, 3) if lookups else None,
+        'cache_bytes': cache_bytes() if ENABLED else 0,
+        'cache_max_bytes': SCRATCH_MAX_BYTES,
+        'pending_output_moves': mover.pending(),
+    })
+    return snapshot
@@ -0,0 +1,159 @@
+# Stall detection for running ffmpeg processes
+# A healthy ffmpeg keeps moving its progress counters (output time, frames).
+# One monitor thread checks every watched run once a second and stops those
+# that have made no forward progress for a while (a broken input, a wedged
+# NVENC session), so their pool slots come back in seconds. Instead of one
+# fixed timeout for every job, the hard deadline scales with the input
+# duration and a conservative expected speed, so long inputs may run long.
+
+import os
+import re
+import subprocess
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# No forward progress for this long stops a run
+STALL_SECONDS = float(os.environ.get('FFMPEG_API_STALL_SECONDS', '30'))
+# Allowance before the first output frame (probing, opening devices, output-side seeks)
+STARTUP_SECONDS = float(os.environ.get('FFMPEG_API_STARTUP_SECONDS', '120'))
+# Deadline = startup allowance + factor * input duration / expected speed (x realtime)
+EXPECTED_SPEED = float(os.environ.get('FFMPEG_API_EXPECTED_SPEED', '0.5'))
+DEADLINE_FACTOR = float(os.environ.get('FFMPEG_API_DEADLINE_FACTOR', '3'))
+CHECK_SECONDS = 1.0
+
+_DURATION = re.compile(r'^\s*Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+_stats = {'stalled': 0, 'deadline': 0}
+_stats_lock = threading.Lock()
+
+
+class Stopped(subprocess.TimeoutExpired):
+    """A run the watchdog stopped; reason is 'stalled' or 'deadline', timeout the limit that was passed."""
+
+    def __init__(self, cmd, watch, stderr=''):
+        super().__init__(cmd, watch.limit, output='', stderr=stderr)
+        self.reason = watch.reason
+
+
+def deadline_seconds(duration, fallback, expected_speed=None):
+    """Hard limit for a run over duration seconds of input; fallback when the duration is unknown."""
+    if not duration:
+        return fallback
+    return STARTUP_SECONDS + DEADLINE_FACTOR * duration / (expected_speed or EXPECTED_SPEED)
+
+
+def parse_duration(line):
+    """Seconds from an input's "Duration: HH:MM:SS.ss" stderr line, or None."""
+    m = _DURATION.match(line)
+    if not m:
+        return None
+    return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+
+
+class Watch:
+    """One watched run; stop() is called (on the monitor thread) when it stalls or overruns."""
+
+    def __init__(self, job_id, stop, fallback_deadline, duration=None, expected_speed=None):
+        self.job_id = job_id
+        self.reason = None
+        self.started = time.monotonic()
+        self.last_progress = None
+        self._position = None
+        self._stop = stop
+        self._fallback = fallback_deadline
+        self._expected_speed = expected_speed
+        self.duration = None
+        self.deadline = fallback_deadline
+        if duration:
+            self.set_duration(duration)
+
+    def set_duration(self, duration):
+        self.duration = duration
+        self.deadline = deadline_seconds(duration, self._fallback, self._expected_speed)
+
+    def saw_duration(self, duration):
+        # Inputs are listed one by one on stderr; the longest one bounds the run
+        if duration and duration > (self.duration or 0):
+            self.set_duration(duration)
+
+    def progress(self, sample):
+        position = (sample['out_time_s'] or 0, sample['frame'])
+        if self._position is None or any(now > before for now, before in zip(position, self._position)):
+            if any(position):
+                self.last_progress = time.monotonic()
+            self._position = position
+
+    def check(self, now):
+        elapsed = now - self.started
+        if elapsed > self.deadline:
+            return 'deadline'
+        if self.last_progress is None:
+            return 'stalled' if elapsed > STARTUP_SECONDS else None
+        return 'stalled' if now - self.last_progress > STALL_SECONDS else None
+
+    @property
+    def limit(self):
+        """Seconds that were allowed for what tripped the watch."""
+        if self.reason == 'deadline':
+            return self.deadline
+        return STALL_SECONDS if self.last_progress is not None else STARTUP_SECONDS
+
+    def trip(self, reason):
+        self.reason = reason
+        with _stats_lock:
+            _stats[reason] += 1
+        if reason == 'stalled':
+            logger.error(f"ffmpeg for {self.job_id} made no progress for {self.limit:.0f}s, stopping it")
+        else:
+            logger.error(f"ffmpeg for {self.job_id} passed its {self.deadline:.0f}s deadline, stopping it")
+        self._stop()
+
+
+class Monitor:
+    def __init__(self):
+        self._watches = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, job_id, stop, fallback_deadline, duration=None, expected_speed=None):
+        watch = Watch(job_id, stop, fallback_deadline, duration, expected_speed)
+        with self._lock:
+            self._watches.add(watch)
+            # Threads do not survive fork, so each worker starts its own on first use
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='stall-watchdog', daemon=True)
+                self._thread.start()
+        return watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            self._watches.discard(watch)
+
+    def _run(self):
+        while True:
+            time.sleep(CHECK_SECONDS)
+            now = time.monotonic()
+            with self._lock:
+                watches = list(self._watches)
+            for watch in watches:
+                reason = watch.reason is None and watch.check(now)
+                if reason:
+                    self.unwatch(watch)
+                    try:
+                        watch.trip(reason)
+                    except Exception as e:
+                        logger.error(f"Stopping stalled ffmpeg for {watch.job_id} failed: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            watched = len(self._watches)
+        with _stats_lock:
+            return {**_stats, 'watched': watched, 'stall_seconds': STALL_SECONDS,
+                    'startup_seconds': STARTUP_SECONDS, 'expected_speed': EXPECTED_SPEED,
+                    'deadline_factor': DEADLINE_FACTOR}
+
+
+monitor = Monitor()
@@ -20,42 +20,21 @@ echo "   Python: $(python3 --version)"
 echo "   Date: $(date)"
 echo ""
 
-# Check FFmpeg
-echo "🎬 FFmpeg Status:"
-if command -v ffmpeg &> /dev/null; then
-    echo "   ✅ FFmpeg found: $(ffmpeg -version | head -1)"
-else
-    echo "   ❌ FFmpeg not found"
+# FFmpeg, GPU, hardware acceleration and workspace checks run concurrently;
+# ffmpeg facts come from the capability snapshot built into the image and are
+# only re-probed if the ffmpeg binary changed. The app reuses the same snapshot.
+if ! python3 capabilities.py; then
     exit 1
 fi
 
-# Check GPU
-echo "🎮 GPU Status:"
-if command -v nvidia-smi &> /dev/null; then
-    GPU_NAME=$(nvidia-smi --query-gpu=name --format=csv,noheader,nounits 2>/dev/null || echo "Not detected")
-    echo "   ✅ GPU: $GPU_NAME"
-else
-    echo "   ⚠️  nvidia-smi not available (may work in container)"
-fi
-
-# Check hardware acceleration
-echo "🔧 Hardware Acceleration:"
-HWACCELS=$(ffmpeg -hwaccels 2>/dev/null | tail -n +2 | tr '\n' ' ')
-echo "   Available: $HWACCELS"
-
-# Check workspace
-echo "📁 Workspace:"
-if [ -d "/workspace" ]; then
-    FILE_COUNT=$(find /workspace -maxdepth 1 -type f \( -name "*.mp4" -o -name "*.avi" -o -name "*.mov" -o -name "*.mkv" \) 2>/dev/null | wc -l)
-    echo "   ✅ Workspace: /workspace ($FILE_COUNT video files)"
-else
-    echo "   ⚠️  Workspace not mounted: /workspace"
-fi
-
 echo ""
 echo "🔥 Starting Production Server..."
 echo "   Server: Gunicorn"
-echo "   Workers: 2"
+echo "   Workers: 1 (gthread, ${GUNICORN_THREADS:-32} threads)"
+echo "   GPU pool: ${FFMPEG_API_GPU_POOL_SIZE:-2} | Light pool: ${FFMPEG_API_LIGHT_POOL_SIZE:-8}"
+if [ "${FFMPEG_API_ADAPTIVE_CONCURRENCY:-1}" = "1" ]; then
+    echo "   Pool limits: adaptive (GPU max ${FFMPEG_API_GPU_POOL_MAX:-6})"
+fi
 echo "   Port: 5000"
 echo "   Timeout: 3600s (1 hour)"
 echo "   Mode: Production"
@@ -64,12 +43,11 @@ echo ""
 # Start Gunicorn with production settings
 exec gunicorn \
     --bind 0.0.0.0:5000 \
-    --workers 2 \
-    --worker-class sync \
+    --workers 1 \
+    --worker-class gthread \
+    --threads ${GUNICORN_THREADS:-32} \
     --timeout 3600 \
     --keep-alive 2 \
-    --max-requests 1000 \
-    --max-requests-jitter 100 \
     --preload \
     --access-logfile - \
     --error-logfile - \
@@ -0,0 +1,30 @@
+import flask
+import pytest
+
+import admission
+import pools
+
+
+@pytest.fixture
+def client():
+    app = flask.Flask(__name__)
+
+    @app.route('/jobs', methods=['POST'])
+    @admission.limited(pools.for_job)
+    def submit():
+        data = flask.request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {'status': 'error', 'message': 'Body must be a JSON object'}, 400
+        return {'status': 'success'}
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize('body', ['[]', '"x"', '3', 'null', 'not json'])
+def test_non_object_bodies_reach_the_view(client, body):
+    response = client.post('/jobs', data=body, content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_object_bodies_are_admitted(client):
+    assert client.post('/jobs', json={'input': 'a.mp4'}).status_code == 200
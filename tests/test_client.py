@@ -0,0 +1,101 @@
+import asyncio
+import http.server
+import json
+import threading
+
+import pytest
+
+from ffmpeg_api_client import APIError, AsyncClient, Client, RetryPolicy
+
+
+class StandInServer:
+    """Answers POSTs with the queued (status, body) pairs and records the request bodies."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                server.bodies.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                status, body = server.responses.pop(0)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(*responses):
+        servers.append(StandInServer(responses))
+        return servers[-1]
+
+    yield start
+    for s in servers:
+        s.httpd.shutdown()
+
+
+FAST_RETRY = RetryPolicy(attempts=5, backoff=0.001)
+
+
+def test_encode_always_sends_a_job_id_and_keeps_it_across_retries(server):
+    s = server((503, {'status': 'error', 'message': 'queue full'}), (200, {'status': 'success'}))
+    with Client(s.url, retry=FAST_RETRY) as api:
+        assert api.encode({'input': 'in.mp4', 'output': 'out.mp4'}) == {'status': 'success'}
+    assert len(s.bodies) == 2
+    assert s.bodies[0]['job_id'] and s.bodies[0]['job_id'] == s.bodies[1]['job_id']
+
+
+def test_encode_is_not_retried_on_500(server):
+    s = server((500, {'status': 'error', 'message': 'Encoding failed'}), (200, {'status': 'success'}))
+    with Client(s.url, retry=FAST_RETRY) as api:
+        with pytest.raises(APIError) as excinfo:
+            api.encode({'input': 'in.mp4', 'output': 'out.mp4'})
+    assert excinfo.value.status == 500
+    assert len(s.bodies) == 1
+
+
+def test_idempotent_calls_still_retry_500(server):
+    s = server((500, {'status': 'error'}), (200, {'status': 'success'}))
+    with Client(s.url, retry=FAST_RETRY) as api:
+        assert api.post('/cancel-like', {}) == {'status': 'success'}
+    assert len(s.bodies) == 2
+
+
+def test_error_body_with_200_raises(server):
+    s = server((200, {'status': 'error', 'returncode': 1, 'ffmpeg_stderr': 'Unknown encoder'}))
+    with Client(s.url, retry=FAST_RETRY) as api:
+        with pytest.raises(APIError, match='Unknown encoder') as excinfo:
+            api.trim({'input': 'in.mp4', 'output': 'out.mp4', 'start': 0, 'end': 1})
+    assert excinfo.value.payload['returncode'] == 1
+
+
+def test_async_client_matches(server):
+    s = server((500, {'status': 'error', 'message': 'Encoding failed'}),
+               (200, {'status': 'error', 'message': 'ffmpeg failed'}))
+
+    async def run():
+        async with AsyncClient(s.url, retry=FAST_RETRY) as api:
+            with pytest.raises(APIError, match='Encoding failed'):
+                await api.encode({'input': 'in.mp4', 'output': 'out.mp4'})
+            with pytest.raises(APIError, match='ffmpeg failed'):
+                await api.analyze({'input': 'in.mp4'})
+
+    asyncio.run(run())
+    assert all(body['job_id'] for body in s.bodies)
+    assert len(s.bodies) == 2
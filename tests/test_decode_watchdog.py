@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+import frames
+import media_probe
+import stall_watchdog
+import waveform
+
+
+@pytest.fixture
+def silent_input(tmp_path, monkeypatch):
+    # ffmpeg blocks opening a FIFO nobody writes to, so it never makes progress
+    path = tmp_path / 'silent.fifo'
+    os.mkfifo(path)
+    monkeypatch.setattr(media_probe, 'duration', lambda path: None)
+    monkeypatch.setattr(stall_watchdog, 'STARTUP_SECONDS', 0.5)
+    monkeypatch.setattr(stall_watchdog, 'CHECK_SECONDS', 0.1)
+    return str(path)
+
+
+@pytest.mark.skipif(waveform.np is None, reason='needs NumPy')
+def test_stalled_peaks_decode_is_stopped(silent_input):
+    with pytest.raises(stall_watchdog.Stopped) as e:
+        waveform._decode(silent_input, 8000, [256, 512])
+    assert e.value.reason == 'stalled'
+    assert stall_watchdog.monitor.snapshot()['watched'] == 0
+
+
+def test_stalled_frame_decode_is_stopped(silent_input):
+    reader = frames.FrameReader(silent_input, frames.options({}), hwaccel=False)
+    with pytest.raises(frames.FrameError, match='did not start'):
+        reader.start()
+    assert reader._watch.reason == 'stalled'
+    assert stall_watchdog.monitor.snapshot()['watched'] == 0
+
+
+def test_frame_decode_deadline_scales_with_duration(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_probe, 'duration', lambda path: 600.0)
+    with frames.FrameReader(str(tmp_path / 'in.mp4'), frames.options({'duration': 10}), hwaccel=False) as reader:
+        assert reader._watch.deadline == stall_watchdog.deadline_seconds(10.0, frames.DECODE_TIMEOUT)
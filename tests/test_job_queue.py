@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+import cancellation
+import job_queue
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, 'HEARTBEAT_INTERVAL', 0.05)
+    monkeypatch.setattr(job_queue, 'VISIBILITY_TIMEOUT', 0.5)
+    return job_queue.SQLiteQueueBackend(str(tmp_path / 'queue.db'))
+
+
+def cancellable_worker(backend, reasons):
+    def handler(payload):
+        # Stands in for run_encode: the job's run lasts until its token is cancelled
+        with cancellation.registry.scope(payload['job_id']) as token:
+            token._event.wait(5)
+            reasons.append(token.reason)
+            return {'status': 'cancelled', 'reason': token.reason}, 499
+
+    return job_queue.QueueWorker(backend, handler, dict, node_id='a')
+
+
+def start(worker, job):
+    thread = threading.Thread(target=worker._process, args=(job,))
+    thread.start()
+    return thread
+
+
+def test_duplicate_job_id_is_rejected(backend):
+    backend.enqueue({'job_id': 'dup'})
+    with pytest.raises(job_queue.DuplicateJob):
+        backend.enqueue({'job_id': 'dup'})
+
+
+def test_heartbeats_keep_the_lease(backend):
+    backend.enqueue({'job_id': 'kept'})
+    worker = job_queue.QueueWorker(backend, lambda payload: (time.sleep(1), ({'status': 'success'}, 200))[1],
+                                   dict, node_id='a')
+    worker._process(backend.lease('a', job_queue.VISIBILITY_TIMEOUT))
+    assert backend.get('kept')['state'] == 'done'
+
+
+def test_run_stops_when_another_node_takes_the_job_over(backend):
+    backend.enqueue({'job_id': 'taken'})
+    reasons = []
+    thread = start(cancellable_worker(backend, reasons), backend.lease('a', job_queue.VISIBILITY_TIMEOUT))
+    # Node a stalls past its lease (a paused VM, a partitioned volume) and node b picks the job up
+    backend._conn().execute("UPDATE jobs SET lease_expires = 0 WHERE id = 'taken'")
+    assert backend.lease('b', job_queue.VISIBILITY_TIMEOUT)['job_id'] == 'taken'
+    thread.join(5)
+    assert reasons == ['lease_lost']
+    job = backend.get('taken')
+    assert (job['state'], job['node_id']) == ('leased', 'b')
+
+
+def test_run_stops_when_heartbeats_fail_past_the_lease(backend, monkeypatch):
+    backend.enqueue({'job_id': 'unreachable'})
+    reasons = []
+    worker = cancellable_worker(backend, reasons)
+    job = backend.lease('a', job_queue.VISIBILITY_TIMEOUT)
+
+    def heartbeat(*args):
+        raise OSError('queue volume unreachable')
+
+    monkeypatch.setattr(backend, 'heartbeat', heartbeat)
+    started = time.monotonic()
+    start(worker, job).join(5)
+    assert reasons == ['lease_lost']
+    assert time.monotonic() - started >= job_queue.VISIBILITY_TIMEOUT
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import cancellation
+import pools
+
+
+def run_job(pool, job_id, hold, events):
+    with cancellation.registry.scope(job_id):
+        try:
+            with pool.slot():
+                events.append(('ran', job_id))
+                time.sleep(hold)
+        except cancellation.Cancelled:
+            events.append(('cancelled', job_id))
+
+
+def start(pool, job_id, hold, events):
+    jobs = pool.queued + pool.running
+    thread = threading.Thread(target=run_job, args=(pool, job_id, hold, events))
+    thread.start()
+    # Let it take its ticket before the next job queues
+    deadline = time.monotonic() + 2
+    while pool.queued + pool.running <= jobs and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return thread
+
+
+def test_slots_are_first_come_first_served():
+    pool, events = pools.Pool('test', 1, 10), []
+    threads = [start(pool, f'fifo-{i}', 0.05, events) for i in (1, 2, 3)]
+    for thread in threads:
+        thread.join()
+    assert events == [('ran', 'fifo-1'), ('ran', 'fifo-2'), ('ran', 'fifo-3')]
+
+
+def test_cancelled_job_gives_up_its_place_in_the_queue():
+    pool, events = pools.Pool('test', 1, 10), []
+    threads = [start(pool, f'queued-{i}', hold, events) for i, hold in ((1, 1.5), (2, 0), (3, 0))]
+    cancellation.registry.cancel('queued-2')
+    # Dropped while the first job still holds the only slot
+    deadline = time.monotonic() + pools.CANCEL_POLL_SECONDS + 0.5
+    while ('cancelled', 'queued-2') not in events and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert events == [('ran', 'queued-1'), ('cancelled', 'queued-2')]
+    for thread in threads:
+        thread.join()
+    assert events[-1] == ('ran', 'queued-3')
+    assert (pool.queued, pool.running) == (0, 0)
+
+
+def test_open_token_cancels_its_wait():
+    # Streams open their token up front and only queue under it (registry.running)
+    pool, events = pools.Pool('test', 1, 10), []
+    holder = start(pool, 'holder', 1.5, events)
+    token = cancellation.registry.open('stream')
+    outcome = []
+
+    def wait():
+        try:
+            with cancellation.registry.running(token):
+                pool.acquire()
+            outcome.append('acquired')
+        except cancellation.Cancelled as e:
+            outcome.append(e.reason)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    cancellation.registry.cancel('stream', 'client_disconnected')
+    waiter.join(pools.CANCEL_POLL_SECONDS + 0.5)
+    cancellation.registry.close(token)
+    assert outcome == ['client_disconnected']
+    assert holder.is_alive()
+    holder.join()
+    assert (pool.queued, pool.running) == (0, 0)
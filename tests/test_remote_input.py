@@ -0,0 +1,178 @@
+import http.server
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import remote_input
+
+DATA = os.urandom(10_000)
+CHUNK = 1000
+
+
+class Origin:
+    """Stand-in origin serving DATA; paths under /norange/ ignore Range, /redirect/<path> redirects."""
+
+    def __init__(self):
+        self.requests = []
+        self.location = None
+        origin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                origin.requests.append((self.path, self.headers.get('Range')))
+                if self.path.startswith('/redirect/'):
+                    self.send_response(302)
+                    self.send_header('Location', origin.location or self.path[len('/redirect'):])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                start, end = 0, len(DATA)
+                m = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range') or '')
+                if m and not self.path.startswith('/norange/'):
+                    start, end = int(m.group(1)), min(int(m.group(2)) + 1, len(DATA))
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(DATA)}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(end - start))
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                self.wfile.write(DATA[start:end])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def ranges(self):
+        return [r for path, r in self.requests if r != 'bytes=0-0']
+
+
+@pytest.fixture
+def origin(tmp_path, monkeypatch):
+    monkeypatch.setattr(remote_input, 'CHUNK_BYTES', CHUNK)
+    monkeypatch.setattr(remote_input, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(remote_input, 'PRIVATE_HOSTS', {'127.0.0.1'})
+    monkeypatch.setattr(remote_input, '_assets', {})
+    monkeypatch.setattr(remote_input, '_by_url', {})
+    server = Origin()
+    yield server
+    server.server.shutdown()
+
+
+def read(url, byte_range=None):
+    request = urllib.request.Request(url, headers={'Range': byte_range} if byte_range else {})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status, response.headers, response.read()
+
+
+def test_whole_asset_through_the_proxy(origin):
+    status, headers, body = read(remote_input.open_url(f'{origin.url}/media/a.mp4'))
+    assert (status, body) == (200, DATA)
+    assert headers['Accept-Ranges'] == 'bytes'
+
+
+@pytest.mark.parametrize('byte_range, start, end', [
+    ('bytes=2500-', 2500, 10_000),
+    ('bytes=999-2000', 999, 2001),
+    ('bytes=-1500', 8500, 10_000),
+    ('bytes=9000-99999', 9000, 10_000),
+])
+def test_ranges(origin, byte_range, start, end):
+    status, headers, body = read(remote_input.open_url(f'{origin.url}/a.mp4'), byte_range)
+    assert status == 206
+    assert headers['Content-Range'] == f'bytes {start}-{end - 1}/{len(DATA)}'
+    assert body == DATA[start:end]
+
+
+def test_unsatisfiable_range(origin):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        read(remote_input.open_url(f'{origin.url}/a.mp4'), 'bytes=10000-')
+    assert e.value.code == 416
+    assert e.value.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_chunks_are_fetched_once(origin):
+    url = remote_input.open_url(f'{origin.url}/a.mp4')
+    assert read(url)[2] == DATA
+    fetched = origin.ranges()
+    assert sorted(fetched) == sorted(f'bytes={i}-{i + CHUNK - 1}' for i in range(0, len(DATA), CHUNK))
+    assert read(url, 'bytes=1234-5678')[2] == DATA[1234:5679]
+    assert read(remote_input.open_url(f'{origin.url}/a.mp4'))[2] == DATA
+    assert origin.ranges() == fetched
+
+
+def test_origin_without_range_support_is_downloaded_once(origin):
+    url = remote_input.open_url(f'{origin.url}/norange/a.mp4')
+    assert read(url, 'bytes=4321-')[2] == DATA[4321:]
+    assert read(url)[2] == DATA
+    assert [r for path, r in origin.requests] == ['bytes=0-0', None]
+
+
+def test_fetch_does_not_buffer_a_full_response(origin, monkeypatch):
+    # The origin stopped honouring Range after the probe: the chunk fetch must not read the whole body
+    url = remote_input.open_url(f'{origin.url}/a.mp4')
+    asset = remote_input._assets[url.split('/')[3]]
+    asset.fetch_url = f'{origin.url}/norange/a.mp4'
+    reads = []
+    real_read = remote_input.http.client.HTTPResponse.read
+    monkeypatch.setattr(remote_input.http.client.HTTPResponse, 'read',
+                        lambda self, amt=None: reads.append(amt) or real_read(self, amt))
+    monkeypatch.setattr(remote_input, 'FETCH_ATTEMPTS', 1)
+    with pytest.raises(remote_input.RemoteInputError, match='HTTP 200'):
+        remote_input._fetch(asset, 0)
+    assert reads == []
+
+
+def test_redirects_are_followed(origin):
+    url = remote_input.open_url(f'{origin.url}/redirect/b.mp4')
+    assert read(url)[2] == DATA
+    assert remote_input.origin_url(url) == f'{origin.url}/redirect/b.mp4'
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1:1/a.mp4',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://10.0.0.5/a.mp4',
+    'http://[::1]/a.mp4',
+    'http://[::ffff:127.0.0.1]/a.mp4',
+])
+def test_non_public_addresses_are_refused(url, monkeypatch):
+    monkeypatch.setattr(remote_input, 'PRIVATE_HOSTS', set())
+    with pytest.raises(remote_input.RemoteInputError, match='not a public address') as e:
+        remote_input.open_url(url)
+    assert e.value.http_status == 400
+
+
+def test_redirect_to_a_private_address_is_refused(origin, monkeypatch):
+    # The first hop is allowed by name; the address the redirect lands on is not
+    monkeypatch.setattr(remote_input, 'PRIVATE_HOSTS', {'localhost'})
+    port = origin.server.server_address[1]
+    origin.location = f'http://127.0.0.1:{port}/b.mp4'
+    with pytest.raises(remote_input.RemoteInputError, match='not a public address') as e:
+        remote_input.open_url(f'http://localhost:{port}/redirect/b.mp4')
+    assert e.value.http_status == 400
+    assert [path for path, _ in origin.requests] == ['/redirect/b.mp4']
+
+
+def test_connection_to_a_rebound_address_is_refused(origin, monkeypatch):
+    # The name resolves to a public address for the check, then to loopback for the connection
+    monkeypatch.setattr(remote_input, 'PRIVATE_HOSTS', set())
+    answers = iter(['93.184.216.34'])
+    real_getaddrinfo = remote_input.socket.getaddrinfo
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        return real_getaddrinfo(next(answers, '127.0.0.1'), port, *args, **kwargs)
+
+    monkeypatch.setattr(remote_input.socket, 'getaddrinfo', getaddrinfo)
+    with pytest.raises(remote_input.RemoteInputError, match='not a public address'):
+        remote_input.open_url(f'http://media.example:{origin.server.server_address[1]}/a.mp4')
+    assert origin.requests == []
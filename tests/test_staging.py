@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+import pytest
+
+import pools
+import staging
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    workspace = tmp_path / 'workspace'
+    workspace.mkdir()
+    monkeypatch.setattr(staging, 'SCRATCH_DIR', str(tmp_path / 'scratch'))
+    monkeypatch.setattr(staging, 'ENABLED', True)
+    monkeypatch.setattr(staging, 'WORKSPACE', f'{workspace}/')
+    # Room for two 1000-byte inputs, not three
+    monkeypatch.setattr(staging, 'SCRATCH_MAX_BYTES', 2500)
+    monkeypatch.setattr(staging, '_pins', staging.collections.Counter())
+    return workspace
+
+
+def make_input(workspace, name):
+    path = workspace / name
+    path.write_bytes(os.urandom(1000))
+    return str(path)
+
+
+def test_queued_jobs_keep_their_staged_inputs(scratch):
+    # Each job stages its input, then queues for the one slot; staging the
+    # later inputs must not evict copies of jobs still waiting to run
+    pool, slot_free, opened = pools.Pool('test', 1, 10), threading.Event(), {}
+    inputs = [make_input(scratch, f'in{i}.mp4') for i in range(3)]
+
+    def job(path):
+        staged = staging.stage_input(path)
+        try:
+            with pool.slot():
+                slot_free.wait(5)
+                with open(staged, 'rb') as f, open(path, 'rb') as original:
+                    opened[path] = f.read() == original.read()
+        finally:
+            staging.release_input(staged)
+
+    threads = []
+    for path in inputs:
+        threads.append(threading.Thread(target=job, args=(path,)))
+        threads[-1].start()
+        time.sleep(0.1)
+    slot_free.set()
+    for thread in threads:
+        thread.join()
+    assert opened == {path: True for path in inputs}
+    assert not staging._pins
+
+
+def test_released_inputs_are_evicted_least_recently_used_first(scratch):
+    first, second, third = (make_input(scratch, f'in{i}.mp4') for i in range(3))
+    staged_first = staging.stage_input(first)
+    staging.release_input(staged_first)
+    staging.release_input(staging.stage_input(second))
+    staging.release_input(staging.stage_input(third))
+    assert not os.path.exists(staged_first)
+    assert staging.cache_bytes() == 2000
+
+
+def test_eviction_skips_copies_in_progress(scratch):
+    in_progress = os.path.join(staging._inputs_dir(), 'abc.mp4.1.2.tmp')
+    with open(in_progress, 'wb') as f:
+        f.write(os.urandom(2000))
+    os.utime(in_progress, (0, 0))
+    staging._evict_inputs(1000)
+    assert os.path.exists(in_progress)
@@ -0,0 +1,61 @@
+import os
+
+import subprocess
+
+import pytest
+
+import cancellation
+import ffmpeg_runner
+import media_probe
+import two_pass
+
+
+@pytest.fixture
+def prefix(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_probe, 'CACHE_DIR', str(tmp_path))
+    return two_pass.passlog_prefix('key')
+
+
+def fake_first_pass(returncode, stderr='', raises=None):
+    """Stand-in for run_ffmpeg that writes pass-one stats files like ffmpeg does, then ends as told."""
+    def run(cmd, job_id, timeout=3600, **kwargs):
+        passlog = cmd[cmd.index('-passlogfile') + 1]
+        for name in ('-0.log', '-0.log.mbtree'):
+            with open(passlog + name, 'w') as f:
+                f.write('stats')
+        if raises:
+            raise raises
+        return ffmpeg_runner.RunResult(returncode, '', stderr, {'summary': {}})
+    return run
+
+
+def leftovers(prefix):
+    directory = os.path.dirname(prefix)
+    return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+
+def test_first_pass_stats_are_cached(prefix, monkeypatch):
+    monkeypatch.setattr(ffmpeg_runner, 'run_ffmpeg', fake_first_pass(0))
+    assert two_pass.ensure_stats(['ffmpeg', '-i', 'in.mp4'], prefix, 'job', 60)['first_pass'] == 'ran'
+    assert leftovers(prefix) == ['key-0.log', 'key-0.log.mbtree']
+    assert two_pass.ensure_stats(['ffmpeg', '-i', 'in.mp4'], prefix, 'job', 60) == {'first_pass': 'cached'}
+
+
+def test_failed_first_pass_raises_with_stderr_and_cleans_up(prefix, monkeypatch):
+    monkeypatch.setattr(ffmpeg_runner, 'run_ffmpeg', fake_first_pass(1, stderr='x' * 2000 + 'Invalid option'))
+    with pytest.raises(two_pass.FirstPassError) as excinfo:
+        two_pass.ensure_stats(['ffmpeg', '-i', 'in.mp4'], prefix, 'job', 60)
+    assert excinfo.value.stderr.endswith('Invalid option')
+    assert len(excinfo.value.stderr) == 1000
+    assert leftovers(prefix) == []
+    assert two_pass._pass_locks == {}
+
+
+@pytest.mark.parametrize('error', [cancellation.Cancelled('job', 'requested'),
+                                   subprocess.TimeoutExpired(['ffmpeg'], 30)])
+def test_stopped_first_pass_propagates_and_cleans_up(prefix, monkeypatch, error):
+    monkeypatch.setattr(ffmpeg_runner, 'run_ffmpeg', fake_first_pass(0, raises=error))
+    with pytest.raises(type(error)):
+        two_pass.ensure_stats(['ffmpeg', '-i', 'in.mp4'], prefix, 'job', 60)
+    assert leftovers(prefix) == []
+    assert two_pass._pass_locks == {}
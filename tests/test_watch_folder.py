@@ -0,0 +1,65 @@
+import os
+import time
+
+import pytest
+
+import watch_folder
+
+
+@pytest.fixture
+def watcher(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch_folder, 'SETTLE_SECONDS', 0.05)
+    monkeypatch.setattr(watch_folder, 'STABLE_SECONDS', 0.05)
+    folder = {'path': str(tmp_path / 'in'), 'preset': {}, 'output_dir': str(tmp_path / 'out'), 'extension': '.mp4'}
+    os.makedirs(folder['path'])
+    os.makedirs(folder['output_dir'])
+    submitted = []
+    watcher = watch_folder.FolderWatcher([folder], lambda data: submitted.append(data['input']) or {})
+    watcher.submitted = submitted
+    yield watcher
+    watcher._executor.shutdown(wait=True)
+
+
+def drop(watcher, name):
+    path = os.path.join(next(iter(watcher.folders)), name)
+    with open(path, 'wb') as f:
+        f.write(b'media')
+    return path
+
+
+def settle(watcher):
+    folder = next(iter(watcher.folders.values()))
+    watcher._scan(folder)
+    watcher._check_pending()
+    time.sleep(0.1)
+    watcher._check_pending()
+    time.sleep(0.1)
+    watcher._check_pending()
+
+
+def test_rescan_forgets_files_that_are_gone(watcher):
+    kept, removed, moved = (drop(watcher, f'{name}.mp4') for name in ('kept', 'removed', 'moved'))
+    settle(watcher)
+    assert set(watcher._handled) == {kept, removed, moved}
+    os.remove(removed)
+    os.rename(moved, os.path.join(os.path.dirname(moved), '..', 'elsewhere.mp4'))
+    watcher._scan(next(iter(watcher.folders.values())))
+    assert set(watcher._handled) == {kept}
+    assert not watcher._pending
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def test_delete_events_forget_dispatched_files(watcher):
+    watcher.start()
+    if watcher._inotify is None:
+        pytest.skip('inotify unavailable')
+    path = drop(watcher, 'a.mp4')
+    assert wait_for(lambda: path in watcher._handled)
+    os.remove(path)
+    assert wait_for(lambda: path not in watcher._handled)
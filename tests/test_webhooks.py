@@ -0,0 +1,145 @@
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+import webhooks
+
+
+class Receiver:
+    """Stand-in webhook receiver answering with the queued statuses, then 200."""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        receiver = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                receiver.requests.append((self.headers, body))
+                self.send_response(receiver.statuses.pop(0) if receiver.statuses else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/hook'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def events(self):
+        return [event for _, body in self.requests for event in json.loads(body)['events']]
+
+
+@pytest.fixture
+def receiver():
+    receivers = []
+
+    def start(statuses=()):
+        receivers.append(Receiver(statuses))
+        return receivers[-1]
+
+    yield start
+    for r in receivers:
+        r.server.shutdown()
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    monkeypatch.setattr(webhooks, 'SECRET', 'test-secret')
+    monkeypatch.setattr(webhooks, 'BATCH_WINDOW', 0.05)
+    monkeypatch.setattr(webhooks, 'BACKOFF_BASE', 0.01)
+    return webhooks.Dispatcher()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_verify_accepts_own_signature():
+    body = b'{"events": []}'
+    timestamp = str(int(time.time()))
+    signature = 'sha256=' + webhooks.sign('secret', timestamp, body)
+    assert webhooks.verify('secret', timestamp, body, signature)
+
+
+@pytest.mark.parametrize('secret, body, age, timestamp', [
+    ('other', b'{"events": []}', 0, None),
+    ('secret', b'{"events": [1]}', 0, None),
+    ('secret', b'{"events": []}', 3600, None),
+    ('secret', b'{"events": []}', 0, 'not-a-number'),
+])
+def test_verify_rejects_tampering_and_replays(secret, body, age, timestamp):
+    signed_at = str(int(time.time()) - age)
+    signature = 'sha256=' + webhooks.sign('secret', signed_at, b'{"events": []}')
+    assert not webhooks.verify(secret, timestamp or signed_at, body, signature)
+
+
+def test_verify_rejects_missing_signature():
+    assert not webhooks.verify('secret', str(int(time.time())), b'{}', None)
+
+
+def test_delivery_is_signed_and_batched(dispatcher, receiver):
+    r = receiver()
+    dispatcher.notify(r.url, 'progress', 'job', percent=25)
+    dispatcher.notify(r.url, 'completed', 'job', output_file='/workspace/out.mp4')
+    wait_for(lambda: dispatcher.stats['delivered'] == 2)
+    assert len(r.requests) == 1
+    headers, body = r.requests[0]
+    assert webhooks.verify('test-secret', headers[webhooks.TIMESTAMP_HEADER], body,
+                           headers[webhooks.SIGNATURE_HEADER])
+    assert [e['event'] for e in r.events()] == ['progress', 'completed']
+
+
+def test_retryable_failures_back_off_and_retry(dispatcher, receiver):
+    r = receiver([503, 429])
+    dispatcher.notify(r.url, 'completed', 'job')
+    wait_for(lambda: dispatcher.stats['delivered'] == 1)
+    assert dispatcher.stats['retries'] == 2
+    assert len(r.requests) == 3
+    assert dispatcher.snapshot()['pending_retries'] == 0
+
+
+def test_client_errors_are_not_retried(dispatcher, receiver):
+    r = receiver([400])
+    dispatcher.notify(r.url, 'failed', 'job')
+    wait_for(lambda: dispatcher.stats['failed'] == 1)
+    assert dispatcher.stats['retries'] == 0
+    assert len(r.requests) == 1
+
+
+def test_gives_up_after_max_attempts(dispatcher, receiver, monkeypatch):
+    monkeypatch.setattr(webhooks, 'MAX_ATTEMPTS', 3)
+    r = receiver([500] * 10)
+    dispatcher.notify(r.url, 'completed', 'job')
+    wait_for(lambda: dispatcher.stats['failed'] == 1)
+    assert len(r.requests) == 3
+    assert dispatcher.stats['retries'] == 2
+
+
+def test_backoff_grows_exponentially(dispatcher, monkeypatch):
+    delays = []
+    monkeypatch.setattr(webhooks, 'BACKOFF_BASE', 2)
+    monkeypatch.setattr(webhooks.random, 'uniform', lambda a, b: 1.0)
+    monkeypatch.setattr(webhooks.heapq, 'heappush', lambda heap, item: delays.append(item[0] - time.monotonic()))
+    # Nothing listens on port 1, so every attempt fails with a connection error
+    for attempt in (1, 2, 3):
+        dispatcher._send('http://127.0.0.1:1/hook', [{'event': 'completed'}], attempt)
+    assert [round(d) for d in delays] == [2, 4, 8]
+
+
+def test_full_queue_drops_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(webhooks, 'QUEUE_SIZE', 1)
+    dispatcher = webhooks.Dispatcher()
+    # Keep the batching thread from draining the queue
+    monkeypatch.setattr(dispatcher, '_ensure_thread', lambda: None)
+    dispatcher.notify('http://127.0.0.1:1/hook', 'completed', 'a')
+    dispatcher.notify('http://127.0.0.1:1/hook', 'completed', 'b')
+    assert (dispatcher.stats['queued'], dispatcher.stats['dropped']) == (1, 1)
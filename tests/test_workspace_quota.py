@@ -0,0 +1,65 @@
+import types
+
+import pytest
+
+import workspace_quota
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace_quota, 'STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setattr(workspace_quota, 'WORKSPACE', str(tmp_path))
+    monkeypatch.setattr(workspace_quota, 'MIN_FREE_BYTES', 0)
+    monkeypatch.setattr(workspace_quota, 'QUOTA_BYTES', 0)
+    monkeypatch.setattr(workspace_quota, 'OUTPUT_MAX_AGE', 0)
+    free = {'bytes': 10 ** 12}
+    monkeypatch.setattr(workspace_quota.shutil, 'disk_usage', lambda path: types.SimpleNamespace(free=free['bytes']))
+    return types.SimpleNamespace(path=tmp_path, free=free)
+
+
+def generated_output(workspace, name, size):
+    tmp = workspace.path / f'.{name}.partial'
+    tmp.write_bytes(b'\0' * size)
+    output = workspace.path / name
+    workspace_quota.commit_output(str(tmp), str(output))
+    return output
+
+
+def test_reserve_fits_without_evicting(workspace):
+    output = generated_output(workspace, 'old.mp4', 600)
+    workspace_quota.reserve('job', 500)
+    assert output.exists()
+    assert workspace_quota.disk_status()['reserved_bytes'] == 500
+
+
+def test_no_retention_policy_never_evicts(workspace):
+    output = generated_output(workspace, 'old.mp4', 600)
+    workspace.free['bytes'] = 500
+    with pytest.raises(workspace_quota.InsufficientSpace):
+        workspace_quota.reserve('job', 1000)
+    assert output.exists()
+
+
+def test_quota_evicts_oldest_output_to_make_room(workspace, monkeypatch):
+    monkeypatch.setattr(workspace_quota, 'QUOTA_BYTES', 1000)
+    old = generated_output(workspace, 'old.mp4', 300)
+    newer = generated_output(workspace, 'newer.mp4', 300)
+    workspace_quota.touch(str(newer))
+    workspace_quota.reserve('job', 600)
+    assert not old.exists()
+    assert newer.exists()
+
+
+def test_no_eviction_when_it_would_not_make_room(workspace, monkeypatch):
+    monkeypatch.setattr(workspace_quota, 'QUOTA_BYTES', 1000)
+    output = generated_output(workspace, 'old.mp4', 600)
+    with pytest.raises(workspace_quota.InsufficientSpace):
+        workspace_quota.reserve('job', 1200)
+    assert output.exists()
+    assert workspace_quota.eviction_count() == 0
+
+
+def test_release_frees_the_reservation(workspace):
+    workspace_quota.reserve('job', 500)
+    workspace_quota.release('job')
+    assert workspace_quota.disk_status()['reserved_bytes'] == 0
@@ -0,0 +1,157 @@
+# Smart-cut trimming
+# Only the partial GOPs at the in and out points are re-encoded (with the
+# source's codec, profile, pixel format and bitrate); every whole GOP in
+# between is stream-copied. The pieces carry their parameter sets in-band, are
+# joined with the concat demuxer and get the audio copied from the source
+# range, so a short clip from a long file costs two tiny encodes and a remux.
+
+import concurrent.futures
+import contextvars
+import os
+import shutil
+import tempfile
+import logging
+
+import ffmpeg_runner
+import filter_catalog
+import keyframe_index
+import media_probe
+
+logger = logging.getLogger(__name__)
+
+# Source codec -> (encoders to try for the boundary GOPs, preferred first; Annex B bitstream filter)
+BOUNDARY_ENCODERS = {
+    'h264': (('h264_nvenc', 'libx264'), 'h264_mp4toannexb'),
+    'hevc': (('hevc_nvenc', 'libx265'), 'hevc_mp4toannexb'),
+}
+PROFILES = {'constrained baseline': 'baseline', 'baseline': 'baseline', 'main': 'main', 'high': 'high',
+            'main 10': 'main10'}
+# A boundary piece shorter than this is dropped instead of encoded (about one frame)
+MIN_SEGMENT_SECONDS = 0.001
+
+
+class TrimError(Exception):
+    pass
+
+
+def plan(index, start, end):
+    """Split [start, end) into encode/copy segments along the index's keyframes."""
+    first = index.keyframe_at_or_after(start)
+    if index.duration and end >= index.duration - MIN_SEGMENT_SECONDS:
+        # The clip runs to the end of the file, so the last GOP is whole too
+        last, copy_end = len(index), index.duration
+    else:
+        last = index.keyframe_at_or_before(end)
+        copy_end = index.times[last]
+    if first is None or index.times[first] >= copy_end:
+        # No whole GOP inside the range: it is shorter than one GOP, encode it all
+        return [{'mode': 'encode', 'start': start, 'end': end}]
+    segments = []
+    if index.times[first] - start > MIN_SEGMENT_SECONDS:
+        segments.append({'mode': 'encode', 'start': start, 'end': index.times[first]})
+    # Copying by packet count (known from the index) stops exactly at the next keyframe
+    segments.append({'mode': 'copy', 'start': index.times[first], 'end': copy_end,
+                     'packets': sum(index.gop_packets[first:last])})
+    if end - copy_end > MIN_SEGMENT_SECONDS:
+        segments.append({'mode': 'encode', 'start': copy_end, 'end': end})
+    return segments
+
+
+def boundary_encoder_args(stream):
+    """Encoder options that make re-encoded pieces decodable alongside the copied GOPs."""
+    codec = stream.get('codec_name')
+    candidates = BOUNDARY_ENCODERS[codec][0]
+    catalog = filter_catalog.catalog
+    available = [e for e in candidates if not catalog.load() or e in catalog.encoders]
+    if not available:
+        raise TrimError(f"No encoder available for '{codec}' (tried {', '.join(candidates)})")
+    encoder = available[0]
+    # Without a global header the encoder repeats SPS/PPS before every keyframe
+    args = ['-c:v', encoder, '-flags:v', '-global_header']
+    if 'nvenc' in encoder:
+        args += ['-preset', 'fast']
+    if stream.get('pix_fmt'):
+        args += ['-pix_fmt', stream['pix_fmt']]
+    profile = PROFILES.get(str(stream.get('profile', '')).lower())
+    if profile:
+        args += ['-profile:v', profile]
+    if str(stream.get('bit_rate', '')).isdigit():
+        args += ['-b:v', stream['bit_rate']]
+    return encoder, args
+
+
+def _segment_command(input_file, segment, path, encoder, encoder_args, annexb_filter):
+    cmd = ['ffmpeg', '-y']
+    if segment['mode'] == 'encode' and 'nvenc' in encoder:
+        cmd += ['-hwaccel', 'cuda']
+    cmd += ['-ss', f"{segment['start']:.6f}", '-i', input_file, '-map', '0:v:0', '-an', '-sn', '-dn']
+    if segment['mode'] == 'encode':
+        cmd += ['-t', f"{segment['end'] - segment['start']:.6f}", *encoder_args]
+    else:
+        cmd += ['-frames:v', str(segment['packets']), '-c:v', 'copy']
+    # In-band parameter sets on every piece let pieces from different encoders share one stream
+    return cmd + ['-bsf:v', annexb_filter, '-f', 'nut', path]
+
+
+def smart_trim(input_file, output_file, start, end, job_id, timeout=600):
+    """Write input_file[start:end] to output_file; returns a summary of the segments used."""
+    stream = media_probe.video_stream(input_file)
+    if stream is None:
+        raise TrimError('Input has no video stream')
+    codec = stream.get('codec_name')
+    if codec not in BOUNDARY_ENCODERS:
+        raise TrimError(f"Smart cut is not supported for '{codec}' video")
+    duration = media_probe.duration(input_file)
+    if duration is not None:
+        end = min(end, duration)
+    if not 0 <= start < end:
+        raise TrimError(f'Invalid range: start={start}, end={end}')
+
+    index = keyframe_index.get_index(input_file)
+    segments = plan(index, start, end)
+    encoder, encoder_args = (None, [])
+    if any(s['mode'] == 'encode' for s in segments):
+        encoder, encoder_args = boundary_encoder_args(stream)
+
+    work_dir = tempfile.mkdtemp(prefix=f'trim_{job_id}_')
+    try:
+        commands = []
+        for i, segment in enumerate(segments):
+            segment['file'] = os.path.join(work_dir, f'{i}.nut')
+            commands.append(_segment_command(input_file, segment, segment['file'], encoder, encoder_args,
+                                             BOUNDARY_ENCODERS[codec][1]))
+
+        # The pieces are independent, so the boundary encodes run alongside the copy; each
+        # runs in a copy of the caller's context so its progress counts towards the caller's pool
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, ffmpeg_runner.run_ffmpeg, cmd,
+                                   f'{job_id}-part{i}', timeout)
+                       for i, cmd in enumerate(commands)]
+            results = [f.result() for f in futures]
+        for segment, result in zip(segments, results):
+            if result.returncode != 0:
+                raise TrimError(f"{segment['mode']} of {segment['start']:.3f}-{segment['end']:.3f}s failed: "
+                                f"{result.stderr[-1000:]}")
+
+        concat_list = os.path.join(work_dir, 'list.txt')
+        with open(concat_list, 'w') as f:
+            for segment in segments:
+                f.write(f"file '{segment['file']}'\nduration {segment['end'] - segment['start']:.6f}\n")
+        length = f'{end - start:.6f}'
+        join_cmd = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list,
+                    '-ss', f'{start:.6f}', '-t', length, '-i', input_file,
+                    '-map', '0:v:0', '-map', '1:a?', '-c', 'copy', '-t', length, output_file]
+        result = ffmpeg_runner.run_ffmpeg(join_cmd, job_id, timeout)
+        if result.returncode != 0:
+            raise TrimError(f'Joining segments failed: {result.stderr[-1000:]}')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'encoder': encoder,
+        'segments': [{k: (round(v, 6) if isinstance(v, float) else v) for k, v in s.items() if k != 'file'}
+                     for s in segments],
+        'copied_seconds': round(sum(s['end'] - s['start'] for s in segments if s['mode'] == 'copy'), 3),
+        'encoded_seconds': round(sum(s['end'] - s['start'] for s in segments if s['mode'] == 'encode'), 3),
+        'timeline': result.timeline['summary'],
+    }
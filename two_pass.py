@@ -0,0 +1,211 @@
+# Target-size and two-pass encoding
+# A target size becomes a video bitrate from the probed duration, less the
+# audio and a margin for container overhead. Encoders that support ffmpeg's
+# -pass/-passlogfile get a real analysis pass whose stats are cached per input
+# and video pipeline (encoder, options, filter chain), so re-targeting the same
+# source at another size only runs pass two. NVENC encoders use their built-in
+# two-pass rate control instead, other encoders a single ABR pass.
+
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import logging
+
+import cancellation
+import ffmpeg_runner
+import media_probe
+import workspace_quota
+
+logger = logging.getLogger(__name__)
+
+PASSLOG_ENCODERS = ('libx264', 'libvpx', 'libvpx-vp9', 'libaom-av1')
+# Muxing overhead reserved out of the target size
+CONTAINER_OVERHEAD = float(os.environ.get('FFMPEG_API_TARGET_OVERHEAD', '0.02'))
+MIN_VIDEO_KBPS = 32
+# Cached first-pass stats (x264's mbtree files grow with frame count and resolution)
+CACHE_MAX_BYTES = int(os.environ.get('FFMPEG_API_PASSLOG_CACHE_BYTES', str(2 * 1024 ** 3)))
+# Options that change how pass two spends bits but not what pass one measures
+_RATE_OPTIONS = ('-b:v', '-maxrate', '-bufsize', '-c:a', '-b:a', '-af')
+_SIZE_UNITS = {'': 1, 'k': 1e3, 'kb': 1e3, 'm': 1e6, 'mb': 1e6, 'g': 1e9, 'gb': 1e9,
+               'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3}
+
+_lock = threading.Lock()
+_pass_locks = {}
+
+
+class TargetSizeError(ValueError):
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+
+
+class FirstPassError(Exception):
+    def __init__(self, stderr):
+        super().__init__('First pass failed')
+        self.stderr = stderr
+
+
+def parse_size(value):
+    """'25MB' / '25M' (10^6 bytes), '24MiB' (2^20), '800k' or a byte count -> bytes."""
+    m = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', str(value))
+    if not m or m.group(2).lower() not in _SIZE_UNITS:
+        return None
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2).lower()])
+
+
+def rate_control(video_codec):
+    if video_codec in PASSLOG_ENCODERS:
+        return 'two_pass'
+    if 'nvenc' in video_codec:
+        return 'nvenc_multipass'
+    return 'single_pass_abr'
+
+
+def plan(data, input_file):
+    """Bitrate and rate-control mode for a target_size / two_pass request; raises TargetSizeError."""
+    if data.get('audio_only'):
+        raise TargetSizeError('target_size', 'target_size and two_pass need a video output')
+    video_codec = data.get('video_codec', 'h264_nvenc')
+    target = {'rate_control': rate_control(video_codec)}
+    if data.get('target_size') is None:
+        # Plain two-pass at the requested bitrate
+        if not workspace_quota.parse_bitrate(data.get('bitrate')):
+            raise TargetSizeError('bitrate', 'two_pass needs a bitrate or a target_size')
+        target['video_kbps'] = round(workspace_quota.parse_bitrate(data['bitrate']) / 1000)
+        return target
+
+    target_bytes = parse_size(data['target_size'])
+    if not target_bytes:
+        raise TargetSizeError('target_size', 'target_size must be a size such as "25MB", "24MiB" or a byte count')
+    duration = media_probe.duration(input_file)
+    if not duration:
+        raise TargetSizeError('target_size', 'target_size needs an input with a known duration')
+    audio_bps = 0
+    if not data.get('video_only') and media_probe.audio_stream(input_file) is not None:
+        audio_codec = data.get('audio_codec', 'aac')
+        audio_bps = (workspace_quota.PCM_BYTES_PER_SECOND.get(audio_codec, 0) * 8
+                     or workspace_quota.parse_bitrate(data.get('audio_bitrate', '128k')) or 0)
+    video_bps = target_bytes * 8 * (1 - CONTAINER_OVERHEAD) / duration - audio_bps
+    if video_bps < MIN_VIDEO_KBPS * 1000:
+        raise TargetSizeError('target_size', f'target_size {data["target_size"]} leaves '
+                                             f'{max(video_bps, 0) / 1000:.0f} kbps for {duration:.1f}s of video '
+                                             f'(minimum {MIN_VIDEO_KBPS} kbps)')
+    target.update({'target_bytes': target_bytes, 'duration': duration, 'video_kbps': int(video_bps / 1000),
+                   'audio_kbps': round(audio_bps / 1000)})
+    return target
+
+
+def rate_args(target):
+    """Encoder rate-control options replacing the usual -b:v/-crf."""
+    kbps = target['video_kbps']
+    args = ['-b:v', f'{kbps}k']
+    if target['rate_control'] == 'nvenc_multipass':
+        args += ['-rc', 'vbr', '-multipass', 'fullres', '-maxrate', f'{int(kbps * 1.5)}k',
+                 '-bufsize', f'{kbps * 2}k']
+    return args
+
+
+def stats_key(cmd, inputs):
+    """Cache key for first-pass stats: the command minus rate options, with inputs by content identity."""
+    signature, skip = [], False
+    for arg in cmd:
+        if skip:
+            skip = False
+        elif arg in _RATE_OPTIONS:
+            skip = True
+        elif arg in inputs:
+            signature.append(media_probe.identity_key(arg))
+        else:
+            signature.append(arg)
+    return hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+
+
+def passlog_prefix(key):
+    return media_probe.cache_path('passlog', key, '')
+
+
+def _complete(prefix):
+    # ffmpeg names stats files <prefix>-<stream>.log (plus x264's .mbtree); the .log is renamed last
+    return os.path.exists(f'{prefix}-0.log')
+
+
+def second_pass_args(prefix):
+    return ['-pass', '2', '-passlogfile', prefix]
+
+
+def ensure_stats(cmd, prefix, job_id, timeout):
+    """Run pass one for cmd (no output yet) unless its stats are cached; returns a summary of what ran."""
+    if _complete(prefix):
+        _touch(prefix)
+        return {'first_pass': 'cached'}
+    with _lock:
+        pass_lock = _pass_locks.setdefault(prefix, threading.Lock())
+    try:
+        with pass_lock:
+            if _complete(prefix):
+                _touch(prefix)
+                return {'first_pass': 'cached'}
+            tmp = f'{prefix}.{job_id}'
+            start = time.monotonic()
+            try:
+                result = ffmpeg_runner.run_ffmpeg(cmd + ['-an', '-pass', '1', '-passlogfile', tmp, '-f', 'null', '-'],
+                                                  f'{job_id}-pass1', timeout)
+            except (cancellation.Cancelled, subprocess.TimeoutExpired):
+                # Cancelled, or stopped by the stall watchdog: no partial stats are left behind
+                for path in glob.glob(glob.escape(tmp) + '-*'):
+                    os.remove(path)
+                raise
+            files = sorted(glob.glob(glob.escape(tmp) + '-*'), key=lambda p: p.endswith('.log'))
+            if result.returncode != 0 or not files:
+                for path in files:
+                    os.remove(path)
+                raise FirstPassError(result.stderr[-1000:])
+            for path in files:
+                os.replace(path, prefix + path[len(tmp):])
+    finally:
+        with _lock:
+            _pass_locks.pop(prefix, None)
+    _prune()
+    return {'first_pass': 'ran', 'first_pass_seconds': round(time.monotonic() - start, 2),
+            'first_pass_timeline': result.timeline['summary']}
+
+
+def _touch(prefix):
+    for path in glob.glob(glob.escape(prefix) + '-*'):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+def _prune():
+    # Least recently used stats go first once the cache is over its budget; a key's
+    # files (.log and .mbtree) are removed together so no half set is left behind
+    directory = os.path.join(media_probe.CACHE_DIR, 'passlog')
+    groups = {}
+    try:
+        for entry in os.scandir(directory):
+            key = entry.name.partition('-')[0]
+            if entry.is_file() and '.' not in key:
+                st = entry.stat()
+                group = groups.setdefault(key, {'paths': [], 'bytes': 0, 'mtime': 0})
+                group['paths'].append(entry.path)
+                group['bytes'] += st.st_size
+                group['mtime'] = max(group['mtime'], st.st_mtime)
+    except OSError:
+        return
+    total = sum(g['bytes'] for g in groups.values())
+    for group in sorted(groups.values(), key=lambda g: g['mtime']):
+        if total <= CACHE_MAX_BYTES:
+            break
+        for path in sorted(group['paths'], key=lambda p: not p.endswith('.log')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= group['bytes']
@@ -0,0 +1,266 @@
+# Watch-folder ingestion
+# inotify reports files dropped into configured folders; once a file is
+# completely written (close_write/moved_to, then a short settle with an
+# unchanged size) it is encoded with the folder's preset. Jobs go through the
+# normal encode path with bounded concurrency, so nothing polls the API.
+
+import concurrent.futures
+import ctypes
+import json
+import os
+import select
+import struct
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+WATCH_CONFIG = os.environ.get('FFMPEG_API_WATCH_CONFIG', '')
+CONCURRENCY = int(os.environ.get('FFMPEG_API_WATCH_CONCURRENCY', '2'))
+# Quiet time after the last write before a file counts as complete
+SETTLE_SECONDS = float(os.environ.get('FFMPEG_API_WATCH_SETTLE', '0.3'))
+# Files with no close_write (e.g. written over a network share) must stay unchanged this long
+STABLE_SECONDS = float(os.environ.get('FFMPEG_API_WATCH_STABLE', '2'))
+POLL_INTERVAL = 2.0
+MEDIA_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.m4v', '.wmv', '.3gp',
+                    '.wav', '.mp3', '.aac', '.flac', '.mxf', '.ts')
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal inotify binding over libc; raises OSError where inotify is unavailable."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout):
+        """Return [(directory, name, mask)] for events arriving within timeout seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset + _EVENT.size <= len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            name = buf[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            events.append((self.paths.get(wd), os.fsdecode(name), mask))
+        return events
+
+
+def load_config(path=WATCH_CONFIG):
+    """Read the watch config: {"folders": [{"path", "preset", "output_dir", "extension"}]}."""
+    if not path:
+        return []
+    with open(path) as f:
+        config = json.load(f)
+    folders = []
+    for entry in config.get('folders', []):
+        folder = os.path.realpath(entry['path'])
+        folders.append({
+            'path': folder,
+            'preset': entry.get('preset', {}),
+            'output_dir': os.path.realpath(entry.get('output_dir', os.path.join(os.path.dirname(folder), 'encoded'))),
+            'extension': entry.get('extension', '.mp4'),
+        })
+    return folders
+
+
+class FolderWatcher:
+    """Watches folders and submits one encode per completed file, at most `concurrency` at a time."""
+
+    def __init__(self, folders, submit, concurrency=CONCURRENCY):
+        self.folders = {f['path']: f for f in folders}
+        self.submit = submit
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency,
+                                                               thread_name_prefix='watch-job')
+        self._pending = {}  # path -> {'folder', 'closed', 'first_seen', 'last_event', 'size'}
+        self._handled = {}  # path -> mtime_ns when it was last dispatched, so rescans skip it
+        self._lock = threading.Lock()
+        self._inotify = None
+        self._thread = None
+        self.stats = {'detected': 0, 'submitted': 0, 'succeeded': 0, 'failed': 0, 'skipped': 0,
+                      'running': 0, 'total_latency_ms': 0.0}
+
+    def start(self):
+        for folder in self.folders.values():
+            os.makedirs(folder['path'], exist_ok=True)
+            os.makedirs(folder['output_dir'], exist_ok=True)
+        try:
+            self._inotify = Inotify()
+            for path in self.folders:
+                self._inotify.add_watch(path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY |
+                                        IN_DELETE | IN_MOVED_FROM)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable ({e}); watch folders fall back to polling every {POLL_INTERVAL}s")
+            self._inotify = None
+        # Files dropped while the API was down
+        for folder in self.folders.values():
+            self._scan(folder)
+        self._thread = threading.Thread(target=self._run, name='watch-folder', daemon=True)
+        self._thread.start()
+        logger.info(f"Watching {', '.join(self.folders)} for new media")
+
+    def _scan(self, folder):
+        try:
+            present = set()
+            for entry in os.scandir(folder['path']):
+                present.add(entry.path)
+                if entry.is_file() and self._handled.get(entry.path) != entry.stat().st_mtime_ns:
+                    self._note(folder, entry.path, closed=False, from_scan=True)
+        except OSError as e:
+            logger.error(f"Scanning watch folder {folder['path']} failed: {e}")
+            return
+        # Forget files deleted or moved away since they were dispatched, or the map only ever grows
+        for path in [p for p in self._handled if os.path.dirname(p) == folder['path'] and p not in present]:
+            del self._handled[path]
+
+    def _note(self, folder, path, closed, from_scan=False):
+        name = os.path.basename(path)
+        if name.startswith('.') or not name.lower().endswith(MEDIA_EXTENSIONS):
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pending.get(path)
+            if entry is not None and from_scan:
+                return  # a rescan is not a write; the size check decides when it settles
+            if entry is None:
+                entry = self._pending[path] = {'folder': folder, 'closed': False, 'first_seen': now, 'size': -1}
+            entry['last_event'] = now
+            entry['closed'] = entry['closed'] or closed
+            if closed:
+                # The writer closed it: one quiet period with this size is enough
+                try:
+                    entry['size'] = os.path.getsize(path)
+                except OSError:
+                    pass
+
+    def _run(self):
+        while True:
+            try:
+                if self._inotify is not None:
+                    for directory, name, mask in self._inotify.read(self._next_timeout()):
+                        if mask & IN_Q_OVERFLOW:
+                            for folder in self.folders.values():
+                                self._scan(folder)
+                            continue
+                        if mask & IN_ISDIR or directory not in self.folders:
+                            continue
+                        if mask & (IN_DELETE | IN_MOVED_FROM):
+                            self._handled.pop(os.path.join(directory, name), None)
+                            continue
+                        self._note(self.folders[directory], os.path.join(directory, name),
+                                   closed=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+                else:
+                    time.sleep(POLL_INTERVAL)
+                    for folder in self.folders.values():
+                        self._scan(folder)
+                self._check_pending()
+            except Exception as e:
+                logger.error(f"Watch folder loop error: {e}")
+                time.sleep(1)
+
+    def _next_timeout(self):
+        with self._lock:
+            if not self._pending:
+                return None
+            deadlines = [e['last_event'] + (SETTLE_SECONDS if e['closed'] else STABLE_SECONDS)
+                         for e in self._pending.values()]
+        return max(min(deadlines) - time.monotonic(), 0.05)
+
+    def _check_pending(self):
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, entry in list(self._pending.items()):
+                wait = SETTLE_SECONDS if entry['closed'] else STABLE_SECONDS
+                if now - entry['last_event'] < wait:
+                    continue
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    del self._pending[path]  # removed or renamed away before it settled
+                    continue
+                if size != entry['size'] or size == 0:
+                    # Still growing (or not written yet): check again after another quiet period
+                    entry['size'] = size
+                    entry['last_event'] = now
+                    continue
+                del self._pending[path]
+                ready.append((path, entry))
+        for path, entry in ready:
+            self._dispatch(path, entry)
+
+    def output_for(self, folder, path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(folder['output_dir'], stem + folder['extension'])
+
+    def _dispatch(self, path, entry):
+        folder = entry['folder']
+        output = self.output_for(folder, path)
+        try:
+            self._handled[path] = os.stat(path).st_mtime_ns
+            if os.path.getmtime(output) >= os.path.getmtime(path):
+                self._count(skipped=1)
+                return  # already encoded (e.g. seen again after a restart)
+        except OSError:
+            pass
+        self._count(detected=1)
+        data = {**folder['preset'], 'input': path, 'output': output}
+        logger.info(f"Watch folder: {path} complete ({time.monotonic() - entry['first_seen']:.2f}s after "
+                    f"first seen), submitting encode to {output}")
+        self._executor.submit(self._run_job, data, entry['last_event'])
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    def _run_job(self, data, last_write):
+        # Latency from the file's last write to its encode starting
+        self._count(submitted=1, running=1, total_latency_ms=(time.monotonic() - last_write) * 1000)
+        try:
+            ok = self.submit(data)
+        except Exception as e:
+            logger.error(f"Watch folder job for {data['input']} failed: {e}")
+            ok = False
+        self._count(running=-1, **{'succeeded' if ok else 'failed': 1})
+
+    def snapshot(self):
+        with self._lock:
+            pending = len(self._pending)
+            counts = dict(self.stats)
+        latency = counts.pop('total_latency_ms')
+        return {
+            'folders': list(self.folders),
+            'mode': 'inotify' if self._inotify is not None else 'polling',
+            'pending_files': pending,
+            **counts,
+            'avg_detect_to_start_ms': round(latency / counts['submitted'], 1) if counts['submitted'] else None,
+        }
@@ -0,0 +1,290 @@
+# Audio waveform peaks
+# ffmpeg decodes the first audio stream to mono 16-bit PCM on a pipe. The PCM
+# is read in fixed-size chunks and each chunk is reduced with NumPy to min, max
+# and RMS per bucket at the finest zoom level; every coarser level is derived
+# from the one below it, so all levels come out of one decode and memory does
+# not grow with the input length. The levels are stored in one packed binary
+# file keyed by the input's identity.
+
+import math
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # optional; /files/<name>/peaks reports 503 without it
+    np = None
+
+import media_probe
+import stall_watchdog
+
+logger = logging.getLogger(__name__)
+
+# Samples per peak of each stored zoom level; each must be a multiple of the one before
+LEVELS = sorted(int(v) for v in os.environ.get('FFMPEG_API_PEAKS_LEVELS',
+                                               '256,512,1024,2048,4096,8192,16384,32768').split(','))
+# 0 keeps the input's own sample rate
+SAMPLE_RATE = int(os.environ.get('FFMPEG_API_PEAKS_SAMPLE_RATE', '0'))
+# PCM samples reduced per step (rounded up to a whole number of the coarsest buckets)
+CHUNK_SAMPLES = int(os.environ.get('FFMPEG_API_PEAKS_CHUNK_SAMPLES', str(1 << 20)))
+# Deadline when the input duration is unknown (the stall watchdog scales it otherwise)
+DECODE_TIMEOUT = int(os.environ.get('FFMPEG_API_PEAKS_TIMEOUT', '3600'))
+MEMORY_CACHE_SIZE = 16
+
+MAGIC = b'WPK1'
+# magic, sample rate, level count, total samples
+HEADER = struct.Struct('<4sIIQ')
+# samples per peak, peak count
+LEVEL = struct.Struct('<II')
+# audiowaveform .dat version 1 header: version, flags (0: 16-bit), sample rate, samples per pixel, length
+DAT_HEADER = struct.Struct('<iIiiI')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_build_locks = {}
+
+
+class PeaksError(Exception):
+    pass
+
+
+def _check_levels(levels):
+    for finer, coarser in zip(levels, levels[1:]):
+        if coarser % finer:
+            raise ValueError(f'FFMPEG_API_PEAKS_LEVELS: {coarser} is not a multiple of {finer}')
+
+
+_check_levels(LEVELS)
+
+
+class Peaks:
+    """min/max/RMS per bucket at several zoom levels; levels maps samples per peak -> int16 array (n, 3)."""
+
+    def __init__(self, sample_rate, sample_count, levels):
+        self.sample_rate = sample_rate
+        self.sample_count = sample_count
+        self.levels = levels
+
+    @property
+    def duration(self):
+        return self.sample_count / self.sample_rate if self.sample_rate else 0.0
+
+    def choose_level(self, samples_per_peak=None, width=None, start=0.0, end=None):
+        """The stored level for an exact samples_per_peak, or the coarsest one giving at least width peaks."""
+        available = sorted(self.levels)
+        if samples_per_peak is not None:
+            if samples_per_peak not in self.levels:
+                raise PeaksError(f"samples_per_peak must be one of {', '.join(map(str, available))}")
+            return samples_per_peak
+        span = ((end if end is not None else self.duration) - start) * self.sample_rate
+        fitting = [spp for spp in available if span / spp >= (width or 0)]
+        return fitting[-1] if fitting else available[0]
+
+    def window(self, samples_per_peak, start=0.0, end=None):
+        """(index of the first peak, peaks) of one level between start and end seconds."""
+        peaks = self.levels[samples_per_peak]
+        lo = int(max(start, 0.0) * self.sample_rate // samples_per_peak)
+        hi = len(peaks) if end is None else int(math.ceil(end * self.sample_rate / samples_per_peak))
+        return min(lo, len(peaks)), peaks[lo:hi]
+
+    def to_dict(self, samples_per_peak, start=0.0, end=None):
+        first, peaks = self.window(samples_per_peak, start, end)
+        # Field names follow audiowaveform's JSON output, so waveform viewers can read it directly
+        return {
+            'version': 2,
+            'channels': 1,
+            'sample_rate': self.sample_rate,
+            'samples_per_pixel': samples_per_peak,
+            'bits': 16,
+            'length': len(peaks),
+            'start': round(first * samples_per_peak / self.sample_rate, 6),
+            'duration': round(self.duration, 6),
+            'levels': sorted(self.levels),
+            'data': peaks[:, :2].ravel().tolist(),
+            'rms': peaks[:, 2].tolist(),
+        }
+
+    def to_dat(self, samples_per_peak, start=0.0, end=None):
+        """One level in audiowaveform's binary .dat (version 1) layout: interleaved int16 min/max."""
+        _, peaks = self.window(samples_per_peak, start, end)
+        return (DAT_HEADER.pack(1, 0, self.sample_rate, samples_per_peak, len(peaks))
+                + np.ascontiguousarray(peaks[:, :2], dtype='<i2').tobytes())
+
+
+def _write(path, peaks):
+    levels = sorted(peaks.levels)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, peaks.sample_rate, len(levels), peaks.sample_count))
+        for spp in levels:
+            f.write(LEVEL.pack(spp, len(peaks.levels[spp])))
+        for spp in levels:
+            f.write(peaks.levels[spp].astype('<i2', copy=False).tobytes())
+    os.replace(tmp, path)
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            magic, sample_rate, count, sample_count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                return None
+            sizes = [LEVEL.unpack(f.read(LEVEL.size)) for _ in range(count)]
+            levels = {}
+            for spp, n in sizes:
+                data = np.fromfile(f, dtype='<i2', count=n * 3)
+                if len(data) != n * 3:
+                    return None
+                levels[spp] = data.astype(np.int16, copy=False).reshape(n, 3)
+    except (OSError, EOFError, struct.error, ValueError):
+        return None
+    return Peaks(sample_rate, sample_count, levels)
+
+
+def _bucket(samples, samples_per_peak):
+    """Per-bucket (min, max, sum of squares, sample count); a trailing partial bucket is included."""
+    full = len(samples) // samples_per_peak * samples_per_peak
+    rows = samples[:full].reshape(-1, samples_per_peak)
+    squares = np.square(rows, dtype=np.float64)
+    parts = [(rows.min(axis=1), rows.max(axis=1), squares.sum(axis=1),
+              np.full(len(rows), samples_per_peak, dtype=np.int64))]
+    if full < len(samples):
+        rest = samples[full:]
+        parts.append((rest.min(keepdims=True), rest.max(keepdims=True),
+                      np.square(rest, dtype=np.float64).sum(keepdims=True), np.array([len(rest)], dtype=np.int64)))
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def _combine(aggregates, factor):
+    """Merge each run of factor consecutive buckets (the last run may be shorter)."""
+    mins, maxs, sumsq, counts = aggregates
+    starts = np.arange(0, len(mins), factor)
+    return (np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts),
+            np.add.reduceat(sumsq, starts), np.add.reduceat(counts, starts))
+
+
+def _finish(aggregates):
+    mins, maxs, sumsq, counts = aggregates
+    rms = np.minimum(np.rint(np.sqrt(sumsq / np.maximum(counts, 1))), 32767)
+    return np.stack([mins, maxs, rms]).T.astype(np.int16)
+
+
+def _read_full(stream, view):
+    # Pipe reads return whatever is buffered; keep reading until the chunk is full or the stream ends
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def _decode(path, sample_rate, levels):
+    chunk = CHUNK_SAMPLES + (-CHUNK_SAMPLES) % math.lcm(*levels)
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-i', path, '-map', '0:a:0', '-vn', '-sn', '-dn',
+           '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:1']
+    parts = {spp: [] for spp in levels}
+    sample_count = 0
+    buffer = bytearray(chunk * 2)
+    view = memoryview(buffer)
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+        watch = stall_watchdog.monitor.watch(f'peaks {os.path.basename(path)}', process.kill, DECODE_TIMEOUT,
+                                             media_probe.duration(path))
+        try:
+            while True:
+                filled = _read_full(process.stdout, view)
+                if filled < 2:
+                    break
+                samples = np.frombuffer(buffer, dtype='<i2', count=filled // 2)
+                sample_count += len(samples)
+                watch.progress({'out_time_s': sample_count / sample_rate, 'frame': 0})
+                # Chunks hold whole buckets at every level, so only the last one can end mid-bucket
+                aggregates = _bucket(samples, levels[0])
+                parts[levels[0]].append(_finish(aggregates))
+                for finer, coarser in zip(levels, levels[1:]):
+                    aggregates = _combine(aggregates, coarser // finer)
+                    parts[coarser].append(_finish(aggregates))
+                if filled < len(buffer):
+                    break
+            process.wait()
+        finally:
+            stall_watchdog.monitor.unwatch(watch)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if process.returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode(errors='replace').strip()
+            if watch.reason:
+                raise stall_watchdog.Stopped(cmd, watch, message)
+            raise PeaksError(f'Audio decode failed: {message[-500:]}')
+    if not sample_count:
+        raise PeaksError('Audio stream decoded to no samples')
+    return Peaks(sample_rate, sample_count,
+                 {spp: np.concatenate(chunks) if chunks else np.zeros((0, 3), np.int16)
+                  for spp, chunks in parts.items()})
+
+
+def _cache_file(path):
+    return media_probe.cache_path(
+        'peaks', f"{media_probe.identity_key(path)}_{SAMPLE_RATE}_{'-'.join(map(str, LEVELS))}", '.wpk')
+
+
+def build(path):
+    """Decode path's audio and write its peaks to the cache."""
+    stream = media_probe.audio_stream(path)
+    if stream is None:
+        raise PeaksError('Input has no audio stream')
+    sample_rate = SAMPLE_RATE or int(stream.get('sample_rate') or 48000)
+    peaks = _decode(path, sample_rate, LEVELS)
+    _write(_cache_file(path), peaks)
+    logger.info(f"Waveform peaks for {path}: {peaks.sample_count} samples at {sample_rate} Hz, "
+                f"{len(peaks.levels[LEVELS[0]])} peaks at the finest level")
+    _remember(path, peaks)
+    return peaks
+
+
+def _remember(path, peaks):
+    key = _cache_file(path)
+    with _lock:
+        _cache[key] = peaks
+        _cache.move_to_end(key)
+        while len(_cache) > MEMORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def lookup(path):
+    """Cached peaks for path's current contents, or None if they have not been built."""
+    key = _cache_file(path)
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    peaks = _read(key)
+    if peaks is not None:
+        _remember(path, peaks)
+    return peaks
+
+
+def get_peaks(path):
+    """Cached peaks for path, decoding once if needed (concurrent callers share one decode)."""
+    peaks = lookup(path)
+    if peaks is not None:
+        return peaks
+    key = _cache_file(path)
+    with _lock:
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+    with build_lock:
+        peaks = lookup(path)
+        if peaks is None:
+            peaks = build(path)
+    with _lock:
+        _build_locks.pop(key, None)
+    return peaks
@@ -0,0 +1,226 @@
+# Job completion webhooks
+# Events for jobs that set "callback_url" go into a bounded queue. A background
+# thread batches events per URL, signs each batch with HMAC-SHA256 and POSTs it,
+# retrying failed deliveries with exponential backoff. Run this module directly
+# for a stand-in receiver that verifies signatures and prints what it gets.
+
+import concurrent.futures
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import logging
+
+logger = logging.getLogger(__name__)
+
+SECRET = os.environ.get('FFMPEG_API_WEBHOOK_SECRET', '')
+QUEUE_SIZE = int(os.environ.get('FFMPEG_API_WEBHOOK_QUEUE_SIZE', '1000'))
+BATCH_WINDOW = float(os.environ.get('FFMPEG_API_WEBHOOK_BATCH_WINDOW', '0.5'))
+BATCH_MAX = int(os.environ.get('FFMPEG_API_WEBHOOK_BATCH_MAX', '50'))
+MAX_ATTEMPTS = int(os.environ.get('FFMPEG_API_WEBHOOK_MAX_ATTEMPTS', '6'))
+BACKOFF_BASE = float(os.environ.get('FFMPEG_API_WEBHOOK_BACKOFF', '1'))
+BACKOFF_MAX = 300
+TIMEOUT = 10
+SENDERS = 4
+
+EVENTS = ('completed', 'failed', 'progress')
+SIGNATURE_HEADER = 'X-FFmpeg-API-Signature'
+TIMESTAMP_HEADER = 'X-FFmpeg-API-Timestamp'
+
+
+def sign(secret, timestamp, body):
+    """Signature of a delivery: hex HMAC-SHA256 over "<timestamp>.<body>"."""
+    return hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+
+
+def verify(secret, timestamp, body, signature, tolerance=300):
+    """Receiver-side check of a delivery's signature header (rejects replays older than tolerance)."""
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except (TypeError, ValueError):
+        return False
+    expected = 'sha256=' + sign(secret, timestamp, body)
+    return hmac.compare_digest(expected, signature or '')
+
+
+def check_url(url):
+    """Error message for an unusable callback URL, or None."""
+    parsed = urllib.parse.urlparse(str(url))
+    if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+        return 'callback_url must be an http(s) URL'
+    return None
+
+
+class Dispatcher:
+    """Bounded event queue drained by one batching thread and a few sender threads."""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._retries = []  # heap of (due, seq, url, events, attempt)
+        self._seq = itertools.count()
+        self._senders = concurrent.futures.ThreadPoolExecutor(max_workers=SENDERS, thread_name_prefix='webhook-send')
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'queued': 0, 'dropped': 0, 'delivered': 0, 'batches': 0, 'retries': 0, 'failed': 0}
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='webhook-dispatch', daemon=True)
+                self._thread.start()
+
+    def notify(self, url, event, job_id, **fields):
+        """Queue an event for delivery; never blocks the caller (drops it if the queue is full)."""
+        payload = {'event': event, 'job_id': job_id, 'timestamp': time.time(), **fields}
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((url, payload))
+            self._count(queued=1)
+        except queue.Full:
+            self._count(dropped=1)
+            logger.warning(f"Webhook queue full, dropped {event} event for job {job_id}")
+
+    def _run(self):
+        while True:
+            # Sleep until the next event or the next retry becomes due
+            with self._lock:
+                timeout = max(self._retries[0][0] - time.monotonic(), 0) if self._retries else None
+            batches = {}
+            try:
+                first = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                first = None
+            if first is not None:
+                # Whatever else arrives within the window joins the same per-URL batches
+                items, deadline = [first], time.monotonic() + BATCH_WINDOW
+                while len(items) < BATCH_MAX:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        items.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                for url, payload in items:
+                    if url is not None:
+                        batches.setdefault(url, []).append(payload)
+            for url, events in batches.items():
+                self._senders.submit(self._send, url, events, 1)
+            self._submit_due_retries()
+
+    def _submit_due_retries(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._retries and self._retries[0][0] <= now:
+                due.append(heapq.heappop(self._retries))
+        for _, _, url, events, attempt in due:
+            self._senders.submit(self._send, url, events, attempt)
+
+    def _send(self, url, events, attempt):
+        body = json.dumps({'events': events}).encode()
+        timestamp = str(int(time.time()))
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'ffmpeg-api-webhooks',
+                   TIMESTAMP_HEADER: timestamp}
+        if SECRET:
+            headers[SIGNATURE_HEADER] = 'sha256=' + sign(SECRET, timestamp, body)
+        try:
+            request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                response.read()
+            self._count(delivered=len(events), batches=1)
+            return
+        except urllib.error.HTTPError as e:
+            error = f'HTTP {e.code}'
+            retryable = e.code >= 500 or e.code in (408, 429)
+        except (urllib.error.URLError, OSError) as e:
+            error, retryable = str(e), True
+        if not retryable or attempt >= MAX_ATTEMPTS:
+            self._count(failed=len(events))
+            logger.error(f"Webhook delivery to {url} failed after {attempt} attempt(s): {error}")
+            return
+        # Exponential backoff with jitter so a recovering receiver is not hit by every retry at once
+        delay = min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX) * random.uniform(0.8, 1.2)
+        logger.warning(f"Webhook delivery to {url} failed ({error}), retry {attempt} in {delay:.1f}s")
+        self._count(retries=1)
+        with self._lock:
+            heapq.heappush(self._retries, (time.monotonic() + delay, next(self._seq), url, events, attempt + 1))
+        self._wake()
+
+    def _wake(self):
+        # An item without a URL makes the dispatcher re-read the retry heap
+        try:
+            self._queue.put_nowait((None, None))
+        except queue.Full:
+            pass
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.stats)
+            pending_retries = len(self._retries)
+        return {**counts, 'pending': self._queue.qsize(), 'pending_retries': pending_retries,
+                'signed': bool(SECRET)}
+
+
+dispatcher = Dispatcher()
+
+
+class ProgressNotifier:
+    """on_progress callback that emits a webhook each time encode progress crosses a milestone."""
+
+    def __init__(self, url, job_id, duration, milestones=(25, 50, 75)):
+        self.url = url
+        self.job_id = job_id
+        self.duration = duration
+        self.pending = sorted(float(m) for m in milestones)
+
+    def __call__(self, sample):
+        if not self.duration or not sample.get('out_time_s') or not self.pending:
+            return
+        percent = sample['out_time_s'] / self.duration * 100
+        crossed = [m for m in self.pending if percent >= m]
+        if crossed:
+            self.pending = [m for m in self.pending if percent < m]
+            dispatcher.notify(self.url, 'progress', self.job_id, percent=round(max(crossed), 1),
+                              fps=sample.get('fps'), speed=sample.get('speed'))
+
+
+def _serve(port, secret):
+    # Stand-in receiver for local testing: python webhooks.py 8099
+    import http.server
+
+    class Receiver(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            valid = verify(secret, self.headers.get(TIMESTAMP_HEADER), body,
+                           self.headers.get(SIGNATURE_HEADER)) if secret else None
+            for event in json.loads(body).get('events', []):
+                print(json.dumps({'signature_valid': valid, **event}), flush=True)
+            self.send_response(200 if valid is not False else 401)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    print(f'Listening for webhooks on http://0.0.0.0:{port}/', flush=True)
+    http.server.ThreadingHTTPServer(('0.0.0.0', port), Receiver).serve_forever()
+
+
+if __name__ == '__main__':
+    import sys
+    _serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8099, SECRET)
@@ -0,0 +1,272 @@
+# Disk-space admission control and retention for /workspace outputs
+# Each encode reserves its estimated output size before ffmpeg starts, writes
+# to a hidden temp file that is renamed into place on success, and is recorded
+# in a manifest so old generated outputs can be evicted to stay under a quota.
+
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import re
+import shutil
+import stat
+import time
+import uuid
+import logging
+
+import media_probe
+
+logger = logging.getLogger(__name__)
+
+WORKSPACE = '/workspace'
+STATE_DIR = os.environ.get('FFMPEG_API_STATE_DIR', '/tmp/ffmpeg_api_state')
+QUOTA_BYTES = int(float(os.environ.get('FFMPEG_API_WORKSPACE_QUOTA_GB', '0')) * 1024 ** 3)
+MIN_FREE_BYTES = int(float(os.environ.get('FFMPEG_API_MIN_FREE_GB', '1')) * 1024 ** 3)
+OUTPUT_MAX_AGE = float(os.environ.get('FFMPEG_API_OUTPUT_MAX_AGE_HOURS', '0')) * 3600
+SAFETY_FACTOR = float(os.environ.get('FFMPEG_API_ESTIMATE_SAFETY', '1.25'))
+RESERVATION_TTL = 6 * 3600
+
+# Bytes per second for PCM outputs, which ignore -b:a
+PCM_BYTES_PER_SECOND = {'pcm_s16le': 48000 * 2 * 2, 'pcm_s24le': 48000 * 3 * 2, 'pcm_f32le': 48000 * 4 * 2}
+
+
+class InsufficientSpace(Exception):
+    def __init__(self, needed, available):
+        super().__init__(f'Not enough space in {WORKSPACE}: need ~{needed / 1024 ** 3:.2f} GB, '
+                         f'{available / 1024 ** 3:.2f} GB available')
+        self.needed = needed
+        self.available = available
+
+
+@contextlib.contextmanager
+def _state(name):
+    # JSON state shared by all gunicorn workers, guarded by an exclusive flock
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = os.path.join(STATE_DIR, name)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        yield state
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+
+def parse_bitrate(value):
+    """'5M' / '800k' / '128000' -> bits per second."""
+    if value is None:
+        return None
+    m = re.fullmatch(r'\s*([\d.]+)\s*([kKmMgG]?)\s*', str(value))
+    if not m:
+        return None
+    return float(m.group(1)) * {'': 1, 'k': 1e3, 'm': 1e6, 'g': 1e9}[m.group(2).lower()]
+
+
+def _profile_key(data):
+    if data.get('audio_only'):
+        return f"audio:{data.get('audio_codec', 'aac')}:{data.get('audio_bitrate', '128k')}"
+    return (f"video:{data.get('video_codec', 'h264_nvenc')}:{data.get('crf', '23')}:"
+            f"{data.get('preset', 'fast')}:{data.get('scale', '')}")
+
+
+def estimate_output_bytes(data, input_file):
+    """Estimate output size from explicit bitrates x duration, else from past jobs with the same settings."""
+    duration = media_probe.duration(input_file) if media_probe.is_input(input_file) else None
+    input_size = media_probe.input_size(input_file)
+
+    audio_codec = data.get('audio_codec', 'aac')
+    audio_bps = 0 if data.get('video_only') else (
+        PCM_BYTES_PER_SECOND.get(audio_codec, 0) * 8 or parse_bitrate(data.get('audio_bitrate', '128k')) or 0)
+    video_bps = 0 if data.get('audio_only') else parse_bitrate(data.get('bitrate'))
+
+    if duration and (data.get('audio_only') or video_bps):
+        estimate = duration * ((video_bps or 0) + audio_bps) / 8
+        source = 'bitrate'
+    else:
+        with _state('ratios.json') as ratios:
+            learned = ratios.get(_profile_key(data))
+        if duration and learned:
+            estimate = duration * learned
+            source = 'history'
+        else:
+            # No bitrate and no history: assume the output is about the size of the input
+            estimate = input_size
+            source = 'input_size'
+    return int(estimate * SAFETY_FACTOR), source
+
+
+def learn(data, output_bytes, input_file):
+    duration = media_probe.duration(input_file) if media_probe.is_input(input_file) else None
+    if not duration or output_bytes <= 0:
+        return
+    rate = output_bytes / duration
+    with _state('ratios.json') as ratios:
+        key = _profile_key(data)
+        previous = ratios.get(key)
+        # Exponential moving average of output bytes per second of input
+        ratios[key] = rate if previous is None else 0.7 * previous + 0.3 * rate
+
+
+def _live_reservations(reservations):
+    now = time.time()
+    for job_id, r in list(reservations.items()):
+        alive = True
+        try:
+            os.kill(r['pid'], 0)
+        except ProcessLookupError:
+            alive = False
+        except PermissionError:
+            pass
+        if not alive or r['expires'] < now:
+            del reservations[job_id]
+    return reservations
+
+
+def disk_status():
+    usage = shutil.disk_usage(WORKSPACE)
+    with _state('reservations.json') as reservations:
+        reserved = sum(r['bytes'] for r in _live_reservations(reservations).values())
+    with _state('outputs.json') as outputs:
+        generated = sum(o['bytes'] for o in outputs.values())
+    return {
+        'free_bytes': usage.free,
+        'reserved_bytes': reserved,
+        'available_bytes': max(usage.free - reserved - MIN_FREE_BYTES, 0),
+        'generated_output_bytes': generated,
+        'generated_outputs': len(outputs),
+        'quota_bytes': QUOTA_BYTES or None,
+    }
+
+
+def reserve(job_id, estimate):
+    """Reserve space for an encode; raises InsufficientSpace.
+
+    With a retention policy configured (quota or max age), old generated outputs are
+    evicted to make room, but only when evicting them would make the reservation fit.
+    """
+    for attempt in range(2):
+        with _state('reservations.json') as reservations:
+            _live_reservations(reservations)
+            reserved = sum(r['bytes'] for r in reservations.values())
+            available = shutil.disk_usage(WORKSPACE).free - reserved - MIN_FREE_BYTES
+            if QUOTA_BYTES:
+                with _state('outputs.json') as outputs:
+                    used = sum(o['bytes'] for o in outputs.values())
+                available = min(available, QUOTA_BYTES - used - reserved)
+            if estimate <= available:
+                reservations[job_id] = {'bytes': estimate, 'pid': os.getpid(), 'expires': time.time() + RESERVATION_TTL}
+                return
+        shortfall = estimate - available
+        if attempt or not (QUOTA_BYTES or OUTPUT_MAX_AGE) or evictable_bytes() < shortfall:
+            break
+        evict(shortfall)
+    raise InsufficientSpace(estimate, max(available, 0))
+
+
+def release(job_id):
+    with _state('reservations.json') as reservations:
+        reservations.pop(job_id, None)
+
+
+def temp_path(output_file, job_id):
+    # Same directory (so rename is atomic) and same extension (so ffmpeg picks the muxer)
+    if '%' in output_file or not output_file.startswith(WORKSPACE + '/'):
+        return None  # image sequences and device outputs are written directly
+    directory, name = os.path.split(output_file)
+    base, ext = os.path.splitext(name)
+    # Unique per run: a node that lost a queued job's lease must not remove the new owner's file
+    return os.path.join(directory, f'.{base}.partial-{job_id}-{uuid.uuid4().hex[:8]}{ext}')
+
+
+def commit_output(tmp_file, output_file):
+    os.replace(tmp_file, output_file)
+    size = os.path.getsize(output_file)
+    with _state('outputs.json') as outputs:
+        outputs[output_file] = {'bytes': size, 'created': time.time(), 'last_used': time.time()}
+    return size
+
+
+def discard_output(tmp_file):
+    try:
+        os.remove(tmp_file)
+    except FileNotFoundError:
+        pass
+
+
+def discard_direct_output(output_file, since):
+    """Remove what a stopped job wrote straight to output_file (every image of a sequence pattern)."""
+    pattern = glob.escape(output_file)
+    if '%' in output_file:
+        pattern = re.sub(r'%0?\d*d', '*', pattern)
+    for path in glob.glob(pattern):
+        try:
+            st = os.stat(path)
+            # Only regular files this job created or rewrote; never devices or older frames
+            if stat.S_ISREG(st.st_mode) and st.st_mtime >= since:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def touch(path):
+    # Generated outputs that are used as inputs again count as recently used
+    with _state('outputs.json') as outputs:
+        if path in outputs:
+            outputs[path]['last_used'] = time.time()
+
+
+def evictable_bytes():
+    """Total size of the generated outputs that eviction could remove."""
+    with _state('outputs.json') as outputs:
+        return sum(o['bytes'] for path, o in outputs.items() if os.path.exists(path))
+
+
+def evict(bytes_needed=0):
+    """Remove generated outputs, oldest use first: expired ones always, then until bytes_needed and the quota are met."""
+    now = time.time()
+    removed = []
+    with _state('outputs.json') as outputs:
+        for path, o in list(outputs.items()):
+            if not os.path.exists(path):
+                del outputs[path]
+        used = sum(o['bytes'] for o in outputs.values())
+        over_quota = used - QUOTA_BYTES if QUOTA_BYTES else 0
+        to_free = max(bytes_needed, over_quota, 0)
+        for path, o in sorted(outputs.items(), key=lambda item: item[1]['last_used']):
+            expired = OUTPUT_MAX_AGE and now - o['last_used'] > OUTPUT_MAX_AGE
+            if not expired and to_free <= 0:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not evict {path}: {e}")
+                continue
+            to_free -= o['bytes']
+            removed.append(path)
+            del outputs[path]
+    if removed:
+        logger.info(f"Evicted {len(removed)} generated output(s): {', '.join(removed)}")
+        with _state('eviction_stats.json') as counters:
+            counters['evicted_files'] = counters.get('evicted_files', 0) + len(removed)
+    return removed
+
+
+def eviction_loop(interval=300):
+    while True:
+        time.sleep(interval)
+        try:
+            evict()
+        except Exception as e:
+            logger.warning(f"Periodic eviction failed: {e}")
+
+
+def eviction_count():
+    with _state('eviction_stats.json') as counters:
+        return counters.get('evicted_files', 0)